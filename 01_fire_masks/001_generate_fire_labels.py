@@ -1,13 +1,14 @@
 import datetime
 import os
+import sys
 import yaml
 import time
 import random
 import argparse
 import pandas as pd
-import geopandas as gpd
-from fire_labels import FireLabels
-from utils import get_time_series, get_random_timestamps
+from fire_labels import FireLabels, FireLabelsCache
+from utils import get_time_series, get_random_timestamps, get_day_seed
+from label_store import get_store_path, is_day_complete, write_day, combine_years
 import warnings
 import logging as log
 from concurrent.futures import ThreadPoolExecutor
@@ -31,71 +32,107 @@ with open("config/fire_labels_auth.yml", 'r') as stream:
     except yaml.YAMLError as exc:
         log.error(exc)
 
-# main function to get the data
-def main(fire_labels: FireLabels, aoi:dict, year:int, seed: int):
+def process_day(fire_labels: FireLabels, aoi:dict, current_date: datetime.date, seed: int) -> pd.DataFrame:
+    """
+    Returns the labelled fire events of one day (None if the day has no fires). The random timestamps are drawn from
+    a generator seeded with (seed, date) so the result does not depend on which worker processes the day or in which
+    order. Raises RuntimeError if a request failed, so that a failed day is not stored as a day without fires
+    """
+    rng = random.Random(get_day_seed(seed, current_date))
+
+    # get 4 random time stamps for each of the 6 hours intervals in a day
+    time_series = get_random_timestamps(timestamps=TIMESTAMPS, intervals=INTERVALS, rng=rng)
+
+    fires = []
+    # Print the current date in the "YYYY-MM-DD-HHMM" format using timeseries generated above
+    for HHMM in time_series:
+        DATE = f"{current_date.strftime('%Y-%m-%d-')}{HHMM}"
+        log.info(f"Requesting data for {DATE}")
+
+        # request clusters data within the timeframe
+        clusters_data = fire_labels.get_clusters_data(coordinates=aoi, n_minutes= 10, date=DATE)
+        if clusters_data is None:
+            # failed after the retries or not cached in offline mode
+            raise RuntimeError(f"Request for clusters data failed for {DATE}")
+        preprocess_clusters_data = fire_labels.preprocess_clusters(clusters_data, DATE)
+
+        if preprocess_clusters_data is None:
+            continue
+        
+        # request fire events data for all the clusters of this DATE concurrently
+        fire_events_responses = fire_labels.get_fire_events_data_bulk(preprocess_clusters_data["cluster_id"])
+        failed = [cluster_id for cluster_id, response in fire_events_responses.items() if response is None]
+        if failed:
+            raise RuntimeError(f"Request for fire events data failed for {len(failed)} clusters of {DATE}")
+
+        # preprocess the fire events of all the clusters at once
+        preprocess_fire_events_data = fire_labels.preprocess_fire_events_bulk(fire_events_responses, DATE, TIMEDELTA)
+        if preprocess_fire_events_data is None:
+            continue
+
+        # merge the clusters and fire events data
+        fire_clusters_df = pd.merge(preprocess_clusters_data, preprocess_fire_events_data, left_on="cluster_id", right_on="fire_cluster_id", how="right")
+        fires.append(fire_clusters_df)
+
+    if len(fires) == 0:
+        return None
+    return pd.concat(fires, ignore_index=True)
+
+
+def store_day(fire_labels: FireLabels, aoi:dict, current_date: datetime.date, seed: int) -> int:
+    """
+    Processes one day and appends it to the label store of the seed. Returns the no. of fire events of the day. A day
+    whose requests failed raises and is not marked as completed, so the next run retries it
+    """
+    day_fires = process_day(fire_labels, aoi, current_date, seed)
+    write_day(get_store_path(seed), current_date, day_fires)
+    return 0 if day_fires is None else len(day_fires)
+
 
+def schedule_year(executor: ThreadPoolExecutor, fire_labels: FireLabels, aoi:dict, year:int, seed: int) -> list:
+    """
+    Submits one task per day of the year that is not yet in the label store and returns the futures
+    """
     # Define start and end dates for the year
     start_date = datetime.date(year, 1, 1)
     end_date = datetime.date(year, 12, 31)
 
-    # Iterate through the days in the year
+    store = get_store_path(seed)
+    futures = []
     current_date = start_date
-
-    # Define a dictionary to store the data for each day with clusters and fire_events metadata
-    fires = []
     while current_date <= end_date:
-
-        # get 4 random time stamps for each of the 6 hours intervals in a day
-        time_series = get_random_timestamps(timestamps=TIMESTAMPS, intervals=INTERVALS)
-        
-        # Print the current date in the "YYYY-MM-DD-HHMM" format using timeseries generated above
-        for HHMM in time_series:
-            DATE = f"{current_date.strftime('%Y-%m-%d-')}{HHMM}"
-            log.info(f"Requesting data for {DATE}")
-
-            # request clusters data within the timeframe
-            clusters_data = fire_labels.get_clusters_data(coordinates=aoi, n_minutes= 10, date=DATE)
-            if clusters_data is None:
-                continue
-            preprocess_clusters_data = fire_labels.preprocess_clusters(clusters_data, DATE)
-
-            if preprocess_clusters_data is None:
-                continue
-            
-            # request fire events data within the timeframe
-            for i in preprocess_clusters_data["cluster_id"]:
-                fire_events_data = fire_labels.get_fire_events_data(id=i)
-                cluster_oldest_time = datetime.datetime.strptime((preprocess_clusters_data[preprocess_clusters_data["cluster_id"]==i]["cluster_oldest_acquisition"]).iloc[0],"%Y-%m-%dT%H:%M:%SZ").strftime("%Y-%m-%d-%H%M")
-                if fire_events_data is None:
-                    continue
-                
-                preprocess_fire_events_data = fire_labels.preprocess_fire_events(fire_events_data, DATE, TIMEDELTA, i, cluster_oldest_time)
-                if preprocess_fire_events_data is None:
-                    continue
-
-                # merge the clusters and fire events data
-                fire_clusters_df = pd.merge(preprocess_clusters_data, preprocess_fire_events_data, left_on="cluster_id", right_on="fire_cluster_id", how="right")
-                fires.append(fire_clusters_df)  
-            
+        if is_day_complete(store, current_date):
+            log.info(f"{current_date} already exists in {store}")
+        else:
+            futures.append(executor.submit(store_day, fire_labels, aoi, current_date, seed))
         # Move to the next day
         current_date += datetime.timedelta(days=1)
-    if len(fires) == 0:
-        log.info(f"No data for {year}")
-        return
-    labelled_year_data = gpd.GeoDataFrame(pd.concat(fires,ignore_index=True))
-    log.info(f"Total no. of fire_events for {year} are {len(labelled_year_data)}")
-    labelled_year_data.to_file(f"data/fire_masks/{year}_labelled_data_{seed}.geojson", driver="GeoJSON")
+
+    return futures
+
+
+# main function to get the data
+def main(day_futures: list, year:int, seed: int) -> int:
+
+    # wait for all the days of the year, each day is already written to the label store when it completes
+    no_of_fire_events = 0
+    failed_days = 0
+    for future in day_futures:
+        try:
+            no_of_fire_events += future.result()
+        except Exception as e:
+            failed_days += 1
+            log.error(f"{e}. The day is not stored and is retried by the next run")
+    log.info(f"Total no. of new fire_events for {year} are {no_of_fire_events} in {get_store_path(seed)}")
+    if failed_days:
+        log.warning(f"{failed_days} days of {year} failed, rerun with --SEED {seed} to retry them")
+    return failed_days
 
 
 def combine_all_years(YEARS:list, seed:int):
 
-    labelled_year_data_list = []
-    for year in YEARS:
-        labelled_year_data_list.append(gpd.read_file(f"data/fire_masks/{year}_labelled_data_{seed}.geojson"))
-    # merge the data for all the years
-    labelled_data_all_years = gpd.GeoDataFrame(pd.concat(labelled_year_data_list,ignore_index=True))
-    log.info(f"Total no. of fire_events for all years are {len(labelled_data_all_years)}")
-    labelled_data_all_years.to_file(f"data/fire_masks/2020_2021_2022_combined_{seed}.geojson", driver="GeoJSON")
+    # the years are exposed as one dataset by a manifest, the label store is not rewritten
+    combine_years(get_store_path(seed), YEARS, f"data/fire_masks/2020_2021_2022_combined_{seed}.json")
 
 
 if __name__ == "__main__":
@@ -103,7 +140,13 @@ if __name__ == "__main__":
     # Parse the arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("--TIMESTAMPS", type=int, default=4, help="No of time stamps to be considered for each of 6 hours intervals in a day")
-    # parser.add_argument("--SEED", type=int, default=42, help="Random seed to pick these time stamps")
+    parser.add_argument("--MAX_IN_FLIGHT", type=int, default=8, help="Maximum no of concurrent API requests")
+    parser.add_argument("--NO_CACHE", action="store_true", help="Do not use the on-disk cache of API responses")
+    parser.add_argument("--OFFLINE", action="store_true", help="Serve API responses only from the on-disk cache")
+    parser.add_argument("--CACHE_TTL_DAYS", type=float, default=None, help="Refetch cached API responses older than this many days")
+    parser.add_argument("--CACHE_MAX_GB", type=float, default=None, help="Evict least recently used API responses above this cache size")
+    parser.add_argument("--WORKERS", type=int, default=16, help="No of days processed concurrently")
+    parser.add_argument("--SEED", type=int, default=None, help="Random seed to pick these time stamps, defaults to the timestamp of the run")
     args = parser.parse_args()
 
     # Define the CONSTANTS
@@ -116,21 +159,35 @@ if __name__ == "__main__":
     # INTERVALS = CONFIG["INTERVALS"]
     INTERVALS = CONFIG["INTERVALS"]
 
-    SEED = int(time.time())
+    SEED = args.SEED if args.SEED is not None else int(time.time())
     # SEED = 1703273207 # use this for reproducibility
 
-    random.seed(SEED)
+    # every day gets its own seed derived from (SEED, date), the global random state is not used
     log.info(f"SEED used is {SEED}")
 
-    # Create the FireLabels object
-    fire_labels = FireLabels(api_key=API_KEY)
-
-    # get fire labels for each year
-    with ThreadPoolExecutor(max_workers=3) as executor:
+    # Create the FireLabels object, past cluster event histories don't change so responses are cached on disk
+    cache = None
+    if not args.NO_CACHE:
+        cache = FireLabelsCache(
+            cache_dir="data/fire_masks/api_cache",
+            ttl_seconds=args.CACHE_TTL_DAYS * 24 * 3600 if args.CACHE_TTL_DAYS is not None else None,
+            max_size_bytes=int(args.CACHE_MAX_GB * 1024**3) if args.CACHE_MAX_GB is not None else None,
+            offline=args.OFFLINE
+        )
+    fire_labels = FireLabels(api_key=API_KEY, base_url=CONFIG.get("API_URL", "https://app.ororatech.com"), max_in_flight=args.MAX_IN_FLIGHT, cache=cache)
+
+    # get fire labels for each year, the days of all the years are spread over one worker pool
+    with ThreadPoolExecutor(max_workers=args.WORKERS) as executor:
+        # already completed days are skipped, pass the --SEED of an interrupted run to resume it
+        year_futures = {}
         for year in YEARS:
-            if os.path.exists(f"data/fire_masks/{year}_labelled_data_{SEED}.geojson"):
-                log.info(f"data/fire_masks/{year}_labelled_data_{SEED}.geojson already exists")
-                continue
-            executor.submit(main, fire_labels, AOI, year, SEED)
+            year_futures[year] = schedule_year(executor, fire_labels, AOI, year, SEED)
+
+        failed_days = 0
+        for year, day_futures in year_futures.items():
+            failed_days += main(day_futures, year, SEED)
 
-    combine_all_years(YEARS, SEED)
\ No newline at end of file
+    combine_all_years(YEARS, SEED)
+    # the labels are incomplete until the failed days are retried
+    if failed_days:
+        sys.exit(1)
\ No newline at end of file
@@ -1,4 +1,5 @@
-import geopandas as gpd
+import pyarrow as pa
+from label_store import LabelFilter, filter_labels
 from datetime import datetime
 import os
 import json
@@ -14,44 +15,47 @@ log.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 
+# remove satellites that we don't want, labels which has OT-AI as algorithm, clusters that are not relevant and
+# clusters that are older than 2022/12/13/1720 as we don't have h8 data
+LABEL_FILTER = LabelFilter(
+    satellite_deny=["GK2A", "Meteosat-8", "MetOp-B", "MetOp-C", "MetOp-A", "LANDSAT-9", "LANDSAT-8"],
+    algorithm_deny=["OT-AI"],
+    type_allow=[0,1,5,6,7,8,13],
+    date_max=datetime.strptime('2022/12/13/1720', '%Y/%m/%d/%H%M')
+)
+
+def add_time_diff(table: pa.Table) -> pa.Table:
+    """
+    Adds the difference in minutes between acquisition_time and cluster_oldest_acquisition (to see the trend of time from 0 to t)
+    """
+    time_diff = table["acquisition_time"].to_pandas() - table["cluster_oldest_acquisition"].to_pandas()
+    time_diff = time_diff.dt.total_seconds()/60
+    return table.append_column("time_diff", pa.array(time_diff.to_numpy(), type=pa.float64()))
+
 def main(seed: int, minute: str):
 
     
-    if os.path.exists(f"data/fire_masks/2020_2021_2022_combined_{seed}_{minute}_preprocessed.geojson"):
-            log.info(f"data/fire_masks/2020_2021_2022_combined_{seed}_{minute}_preprocessed.geojson already exists")
+    if os.path.exists(f"data/fire_masks/2020_2021_2022_combined_{seed}_{minute}_preprocessed.parquet"):
+            log.info(f"data/fire_masks/2020_2021_2022_combined_{seed}_{minute}_preprocessed.parquet already exists")
             return 
-    
-    seed_data = gpd.read_file(f"reprocess_data_2/fire_labels/{minute}/2020_2021_2022_combined_{seed}.geojson")
-
-    # remove satellites that we don't want
-    preprocessed_data = seed_data[(seed_data["satellite"] != "GK2A") & (seed_data["satellite"] != "Meteosat-8") & (seed_data["satellite"] != "MetOp-B") & (seed_data["satellite"] != "MetOp-C") & (seed_data["satellite"] != "MetOp-A") & (seed_data["satellite"] != "LANDSAT-9") & (seed_data["satellite"] != "LANDSAT-8")]
-    # remove labels which has OT-AI as algorithm
-    preprocessed_data = preprocessed_data[preprocessed_data["algorithm"] != "OT-AI"]
-    # plot a graph to see the trend of time from 0 to t by taking difference between acquition_time and cluster_oldest_acquisition for the dataframe
-    preprocessed_data["time_diff"] = preprocessed_data["acquisition_time"] - preprocessed_data["cluster_oldest_acquisition"]    
-    preprocessed_data["time_diff"] = preprocessed_data["time_diff"].dt.total_seconds()/60
-
-    # only keep clusters that are relavant
-    type_values = [0,1,5,6,7,8,13]
-    finalized_data = preprocessed_data[preprocessed_data["types"].isin(type_values)]
-
-    # remove clusters that are older than 2022/12/13/1720 as we don't have h8 data
-    reference_date = datetime.strptime('2022/12/13/1720', '%Y/%m/%d/%H%M')
-    finalized_data = finalized_data[finalized_data["date"] < reference_date]
 
+    # filter and write the labels in one streaming pass, the filter is applied by the parquet reader
+    # input is the manifest of 001_generate_fire_labels.py (formerly reprocess_data_2/fire_labels/{minute}/), the
+    # labels are always ten minute clusters so minute only names the outputs
+    unique_dates_list = filter_labels(
+        f"data/fire_masks/2020_2021_2022_combined_{seed}.json",
+        LABEL_FILTER,
+        f"data/fire_masks/2020_2021_2022_combined_{seed}_{minute}_preprocessed.parquet",
+        transform=add_time_diff
+    )
 
     # check for unique dates from (365*4)*(3) = 4380 dates
-    unique_dates = finalized_data["date"].nunique()
-    log.info(f"Out of 4380 queried DATEs, we finally have {unique_dates} DATEs after preprcoessing")
-    unique_dates_list = finalized_data["date"].dt.strftime("%Y/%m/%d/%H%M/").unique().tolist()
+    log.info(f"Out of 4380 queried DATEs, we finally have {len(unique_dates_list)} DATEs after preprcoessing")
     file_path = f"data/fire_masks/unique_dates_{minute}.json"
 
     # Write the list to the JSON file
     with open(file_path, 'w') as json_file:
         json.dump(unique_dates_list, json_file)
-        
-    log.info(f"Total no of fire events after finalzing the labels are {len(finalized_data)}")
-    finalized_data.to_file(f"data/fire_masks/2020_2021_2022_combined_{seed}_{minute}_preprocessed.geojson", driver="GeoJSON")
 
 if __name__ == "__main__":
 
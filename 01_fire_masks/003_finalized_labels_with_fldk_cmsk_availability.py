@@ -3,10 +3,8 @@ import time
 import os
 from datetime import datetime, timedelta
 import pandas as pd
-import geopandas as gpd
-import boto3
-from botocore.client import Config
-from botocore import UNSIGNED
+from label_store import read_labels
+from h8_s3 import H8BucketIndex, FLDK_DIR, CLOUD_PRODUCT_DIR
 from concurrent.futures import ThreadPoolExecutor
 import logging as log
 
@@ -19,10 +17,6 @@ log.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S"
 )
-# Define the S3 bucket and directory
-BUCKET_NAME = 'noaa-himawari8'
-FLDK_DIR = 'AHI-L1b-FLDK'
-CLOUD_PRODUCT_DIR = 'AHI-L2-FLDK-Clouds'
 
 def get_child_timestamps(timestamp_str):
     """
@@ -40,62 +34,48 @@ def get_child_timestamps(timestamp_str):
 
     return sorted(intervals)
 
-def main(timestamp:str):
+def main(timestamp:str, index: H8BucketIndex) -> bool:
     """ 
-    Downloads the fldk and cloud product data for the given timestamps
-
+    Returns True if the fldk data of all child timestamps and the cloud product data of the timestamp are available.
+    Availability is answered from the local index of the bucket
     """
-    s3 = boto3.client("s3",config=Config(signature_version=UNSIGNED),region_name='us-east-1')
-
     child_timestamps = get_child_timestamps(timestamp)
 
+    available = True
     for child_timestamp in child_timestamps:
 
-        data_files = []
-        # Download the fldk data
-        fldk_url = f'{FLDK_DIR}/{child_timestamp}'
-        fldk_response = s3.list_objects(Bucket=BUCKET_NAME, Prefix=fldk_url)
-        if fldk_response.get('Contents') is None:
+        # check the fldk data
+        if not index.list_keys(FLDK_DIR, child_timestamp):
             log.info(f"No FLDK data for child_timestamp {child_timestamp} with main timestamp {timestamp}")
-            delete_timestamps.append(timestamp)
+            available = False
             continue
-         # Filter objects based on the naming convention
-        fldk_files = [obj['Key'] for obj in fldk_response.get('Contents', [])
-                if '_B07_' in obj['Key'] or '_B11_' in obj['Key'] or '_B12_' in obj['Key'] or '_B13_' in obj['Key'] or '_B14_' in obj['Key'] or '_B15_' in obj['Key']]
-        data_files.extend(fldk_files)
 
-        # Download the cloud product data only for the last timestamp
+        # check the cloud product data only for the last timestamp
         if child_timestamp == timestamp:
-            cloud_url = f'{CLOUD_PRODUCT_DIR}/{child_timestamp}'
-            cloud_response = s3.list_objects(Bucket=BUCKET_NAME, Prefix=cloud_url)
-            if cloud_response.get('Contents') is None:
+            if not index.list_keys(CLOUD_PRODUCT_DIR, child_timestamp):
                 log.info(f"No CLOUD data for timestamp {timestamp}")
-                delete_timestamps.append(timestamp)
-                continue
-            cloud_files = [obj['Key'] for obj in cloud_response.get('Contents', [])
-                    if '-CMSK_' in obj['Key'] or '_CLOUD_MASK_' in obj['Key']]
-            data_files.extend(cloud_files)
-    
+                available = False
+
+    return available
 
 
-        
-   
 if __name__ == "__main__":
 
 
     with open("data/fire_masks/unique_dates_ten_minute.json") as json_file:
         timestamps = json.load(json_file)
     
-    delete_timestamps = []
+    # the workers only return the availability, the timestamps to delete are collected in this thread
+    index = H8BucketIndex()
     t = time.time()
     with ThreadPoolExecutor(max_workers=16) as executor:
-        for timestamp in timestamps:
-            executor.submit(main, timestamp)
-    delete_timestamps = list(set(delete_timestamps))
+        availability = list(executor.map(main, timestamps, [index]*len(timestamps)))
+    delete_timestamps = sorted(set(timestamp for timestamp, available in zip(timestamps, availability) if not available))
+    log.info(f"Checked the availability of {len(timestamps)} timestamps in {(time.time()-t)/60} minutes")
     log.info(f"Got all the deleted timestamps: {delete_timestamps}")
     log.info(f"No of timestamps to be deleted: {len(delete_timestamps)}")
 
-    labels_data = gpd.read_file("data/fire_masks/2020_2021_2022_combined_1703273207_ten_minute_preprocessed.geojson")
+    labels_data = read_labels("data/fire_masks/2020_2021_2022_combined_1703273207_ten_minute_preprocessed.parquet")
     labels_data["date"] = labels_data["date"].dt.strftime("%Y/%m/%d/%H%M/")
     labels_data = labels_data[~labels_data["date"].isin(delete_timestamps)]
 
@@ -105,7 +85,7 @@ if __name__ == "__main__":
     labels_data["date"] = pd.to_datetime(labels_data["date"], format="%Y/%m/%d/%H%M/")
 
     # save the updated labels data to a new file
-    labels_data.to_file("data/fire_masks/2020_2021_2022_combined_1703273207_ten_minute_preprocessed_finalized.geojson", driver="GeoJSON")
+    labels_data.to_parquet("data/fire_masks/2020_2021_2022_combined_1703273207_ten_minute_preprocessed_finalized.parquet", index=False)
     log.info(f"Saved the updated labels data to a new file")
 
     # save unique dates to a new file
@@ -2,10 +2,17 @@ import requests
 import datetime
 import time
 import os
+import json
+import glob
+import hashlib
+import random
+import threading
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
+from requests.adapters import HTTPAdapter
 from requests.models import Response
+from concurrent.futures import ThreadPoolExecutor
 from pytz import UTC
 import warnings
 import logging as log
@@ -23,16 +30,189 @@ log.basicConfig(
 warnings.filterwarnings("ignore")
 
 
+class FireLabelsCache():
+    """
+    Persistent content-addressed cache for the raw JSON responses of the fire labels API.
+    Entries are stored as data/fire_masks/api_cache/<k[:2]>/<k>.json where k is the sha256 of the request URL and query parameters
+    """
+    def __init__(self, cache_dir:str = "data/fire_masks/api_cache", ttl_seconds:float = None, max_size_bytes:int = None, offline:bool = False):
+        """
+        args:
+            cache_dir: str (directory of the cache)
+            ttl_seconds: float (entries older than this are refetched, None keeps them forever)
+            max_size_bytes: int (least recently used entries are evicted above this size, None disables eviction)
+            offline: bool (serve only from the cache and never hit the API)
+        """
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = max_size_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._entries())
+
+    def _entries(self) -> list:
+        return glob.glob(f"{self.cache_dir}/*/*.json")
+
+    def _path(self, key: str) -> str:
+        return f"{self.cache_dir}/{key[:2]}/{key}.json"
+
+    @staticmethod
+    def key(url: str, params: dict) -> str:
+        """
+        Returns the cache key for the request URL (base URL and endpoint, so that responses of different servers are
+        kept apart) and the query parameters (AOI, date, minutes, cluster id, ...)
+        """
+        canonical = json.dumps({"url": url, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str) -> bytes:
+        """
+        Returns the cached response body or None if it is missing or expired. Expired entries are still served in offline mode
+        """
+        path = self._path(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if self.ttl_seconds is not None and age > self.ttl_seconds and not self.offline:
+                return None
+            with open(path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # reading refreshes the access time which is used for eviction
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            # evicted by another worker after the read
+            pass
+        return content
+
+    def put(self, key: str, content: bytes):
+        """
+        Writes the response body atomically and evicts old entries if the cache is over its size limit
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += len(content) - previous_size
+            over_limit = self.max_size_bytes is not None and self._size > self.max_size_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes expired entries and then the least recently used entries until the cache fits into max_size_bytes
+        """
+        with self._lock:
+            entries = []
+            for path in self._entries():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_mtime, stat.st_size, path))
+            entries.sort()
+
+            size = sum(entry[2] for entry in entries)
+            now = time.time()
+            for atime, mtime, entry_size, path in entries:
+                expired = self.ttl_seconds is not None and now - mtime > self.ttl_seconds
+                over_limit = self.max_size_bytes is not None and size > self.max_size_bytes
+                if not (expired or over_limit):
+                    continue
+                os.remove(path)
+                size -= entry_size
+            self._size = size
+        log.info(f"Evicted fire labels cache entries, cache size is now {size} bytes")
+
+
 class FireLabels():
-    def __init__(self, api_key:str):
+    def __init__(self, api_key:str, base_url:str = "https://app.ororatech.com", max_in_flight:int = 8, max_retries:int = 5, backoff_base:float = 1.0, backoff_max:float = 60.0, cache: FireLabelsCache = None):
+        """
+        args:
+            api_key: str (OroraTech API key)
+            base_url: str (API host, can be pointed to a local stub server for testing)
+            max_in_flight: int (maximum number of concurrent requests across all threads using this object)
+            max_retries: int (number of attempts per request)
+            backoff_base, backoff_max: float (seconds, exponential backoff between retries is capped at backoff_max)
+            cache: FireLabelsCache (optional on-disk cache of the raw responses)
+        """
         self.api_key = api_key
-    
+        self.base_url = base_url.rstrip("/")
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cache = cache
+
+        # one keep-alive session shared by all the requests, the pool is sized to the in-flight limit
+        self.session = requests.Session()
+        self.session.headers.update({"apikey": self.api_key})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        # separate random generator for the jitter so that the global random state (used to pick timestamps) is untouched
+        self._jitter = random.Random()
+
+    def _backoff(self, attempt: int) -> float:
+        """
+        Returns the jittered exponential backoff (in seconds) for the given attempt
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return self._jitter.uniform(0.5, 1.5) * delay
+
+    def _get(self, endpoint: str, params: dict, description: str) -> Response:
+        """
+        GET request on the shared session with jittered exponential backoff. Returns None if all retries fail
+        """
+        if self.cache is not None:
+            key = self.cache.key(f"{self.base_url}{endpoint}", params)
+            content = self.cache.get(key)
+            if content is not None:
+                response = Response()
+                response.status_code = 200
+                response._content = content
+                response.url = f"{self.base_url}{endpoint}"
+                return response
+            if self.cache.offline:
+                log.warning(f"Offline mode and no cached data for {description}")
+                return None
+
+        url = f"{self.base_url}{endpoint}"
+        for i in range(self.max_retries):
+            try:
+                with self._in_flight:
+                    response = self.session.get(url, params=params, timeout=60)
+                if response.status_code == 200:
+                    if self.cache is not None:
+                        self.cache.put(key, response.content)
+                    return response
+                else:
+                    raise RuntimeError(
+                        "API request not successful, status code " + str(response.status_code) + " for " + description
+                    )
+            except (RuntimeError, requests.exceptions.RequestException) as e:
+                log.error(e)
+                if i < self.max_retries - 1:
+                    delay = self._backoff(i)
+                    log.warning(f"Retrying {i+1} time in {delay:.1f} seconds")
+                    time.sleep(delay)
+                else:
+                    log.warning(f"Max retries reached! Could not get data for {description}")
+                    return None
+
     def get_clusters_data(self, coordinates:list, n_minutes: int, date: str) -> Response :
         """
         Returns a response with clusters metadata data using the filters provided
         """
-        url = "https://app.ororatech.com/v1/clusters/"
-        header = {"apikey" : self.api_key}
+        endpoint = "/v1/clusters/"
         
         xmin, ymin, xmax, ymax = coordinates
         params = {
@@ -46,25 +226,7 @@ class FireLabels():
             "select": ["confidence","types","oldest_acquisition","newest_acquisition"]
         }
         
-        # Retry the request 5 times if it fails
-        max_retries = 5
-        for i in range(max_retries):
-            try:
-                response = requests.get(url, params=params, headers=header)
-                if response.status_code == 200:
-                    return response
-                else:
-                    raise RuntimeError(
-                        "API request not successful, status code " + str(response.status_code) + " for date " + str(date)
-                    )
-            except RuntimeError as e:
-                log.error(e)
-                if i < max_retries - 1:
-                    log.warning(f"Retrying {i+1} time")
-                    time.sleep(5)
-                else:
-                    log.warning("Max retries reached! Could not get clusters data for the date")
-                    return None
+        return self._get(endpoint, params, "date " + str(date))
     
     def preprocess_clusters(self, data: Response, DATE: datetime.datetime) -> gpd.GeoDataFrame:
         """ Returns preprocessed clusters data which fullfills either the clusters confidence >= 0.6 or classified as fire
@@ -88,8 +250,9 @@ class FireLabels():
         log.info(f"No. of Clusters before pre-processing for {DATE} are {len(gdf)}")
 
         # preprocess the clusters that are active in future 
+        date = pd.to_datetime(DATE, format="%Y-%m-%d-%H%M")
         gdf["newest_acquisition"] = pd.to_datetime(gdf["newest_acquisition"], format="%Y-%m-%dT%H:%M:%SZ")
-        condition_1 = gdf["newest_acquisition"] >= DATE
+        condition_1 = gdf["newest_acquisition"] >= date
         gdf = gdf[condition_1]
         if gdf.empty:
             log.info(f"No clusters after  pre-prcoessing for {DATE} because of condition 1")
@@ -104,7 +267,7 @@ class FireLabels():
             log.info(f"No clusters after  pre-processing for {DATE} because of condition 2 and 3")
             return None
         
-        gdf_preprocessed["date"] = pd.to_datetime(DATE, format="%Y-%m-%d-%H%M")
+        gdf_preprocessed["date"] = date
         gdf_preprocessed = gdf_preprocessed.rename(columns={"id":"cluster_id", "newest_acquisition":"cluster_newest_acquisition", "oldest_acquisition":"cluster_oldest_acquisition"})
         gdf_preprocessed = gdf_preprocessed[['date', 'cluster_id', 'num_fires', 'confidence', 'types','cluster_newest_acquisition','cluster_oldest_acquisition']]
         gdf_preprocessed['types'] = gdf_preprocessed['types'].str.strip('[]')
@@ -117,75 +280,82 @@ class FireLabels():
         """
         Returns a filtered dataframe of fire events
         """
-        header = {"apikey" : self.api_key}
-        endpoint = "https://app.ororatech.com/v1/clusters/"
-        url = f"{endpoint}{id}" 
+        endpoint = f"/v1/clusters/{id}"
 
         params = {
             "select" : "events"
         }
 
-         # Retry the request 5 times if it fails
-        max_retries = 5
-        for i in range(max_retries):
-            try:
-                response = requests.get(url, params=params, headers=header)
-                if response.status_code == 200:
-                    return response
-                else:
-                    raise RuntimeError(
-                        "API request not successful, status code " + str(response.status_code) +  " for cluster id " + str(id)
-                    )
-            except RuntimeError as e:
-                log.error(e)
-                if i < max_retries - 1:
-                    log.warning(f"Retrying {i+1} time")
-                    time.sleep(5)
-                else:
-                    log.warning("Max retries reached! Could not get clusters data for the date")
-                    return None
+        return self._get(endpoint, params, "cluster id " + str(id))
+
+    def get_fire_events_data_bulk(self, ids: list) -> dict:
+        """
+        Returns a dictionary of cluster id -> response (None if the request failed). The requests are sent
+        concurrently and limited by max_in_flight
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(ids))) as executor:
+            responses = list(executor.map(self.get_fire_events_data, ids))
+
+        return dict(zip(ids, responses))
     
-    def preprocess_fire_events(self, data: Response, time: datetime.datetime, TIMEDELTA: int, cluster_id: int, cluster_oldest_time: str) -> gpd.GeoDataFrame:
+    def preprocess_fire_events(self, data: Response, time: datetime.datetime, TIMEDELTA: int, cluster_id: int, cluster_oldest_time: str = None) -> gpd.GeoDataFrame:
             
             """ 
-            Returns preprocessed fire events data
+            Returns preprocessed fire events data of a single cluster
             """
-            time = datetime.datetime.strptime(time, "%Y-%m-%d-%H%M")
-            time = pd.Timestamp(time, tz=UTC)
-            cluster_oldest_time = datetime.datetime.strptime(cluster_oldest_time, "%Y-%m-%d-%H%M")
-            cluster_oldest_time = pd.Timestamp(cluster_oldest_time, tz=UTC)
-    
-            data = data.json()["properties"]["fire_events"]
-            geometry = [Point(xy) for xy in zip([d['lon'] for d in data], [d['lat'] for d in data])]
-            fire_events = gpd.GeoDataFrame(data, geometry=geometry, crs="EPSG:4326")
+            return self.preprocess_fire_events_bulk({cluster_id: data}, time, TIMEDELTA)
+
+    def preprocess_fire_events_bulk(self, responses: dict, time: str, TIMEDELTA: int) -> gpd.GeoDataFrame:
+        """
+        Returns preprocessed fire events data of all the clusters queried for the same 'time'
+
+        The raw events of all clusters are collected into one frame and filtered once. The geometry is only
+        built for the events that pass the filter.
+        args:
+            responses: dict (cluster id -> fire events response as returned by get_fire_events_data_bulk)
+            time: str (queried DATE in "%Y-%m-%d-%H%M" format)
+            TIMEDELTA: int (only the fire events detected TIMEDELTA minutes before 'time' are kept)
+        """
+        time = pd.Timestamp(datetime.datetime.strptime(time, "%Y-%m-%d-%H%M"), tz=UTC)
 
-            if "frp" not in fire_events.columns:
+        cluster_ids = []
+        records = []
+        for cluster_id, data in responses.items():
+            if data is None:
+                continue
+            events = data.json()["properties"]["fire_events"]
+            if not any("frp" in event for event in events):
                 log.info(f"No fire events data after pre-processing for cluster_id {cluster_id} at {time} because no frp column found")
-                return None
-            
-            length_before = len(fire_events)
-            fire_events = fire_events[['id','gsd', 'acquisition_time','frp', 'product_id', 'satellite', 'algorithm', 'geometry']]
-            fire_events.rename(columns={"id":"fire_event_id"}, inplace=True)
-            fire_events["acquisition_time"] = pd.to_datetime(fire_events["acquisition_time"])
+                continue
+            cluster_ids.append(np.full(len(events), cluster_id))
+            records.extend(events)
 
-            # only collect the fire events that are detected (TIMEDELTA) minutes before the 'time'
-            
-            # if (time -cluster_oldest_time).total_seconds() // 60 < TIMEDELTA:
-            #     if (time -cluster_oldest_time).total_seconds() // 60 < 40:
-            #         TIMEDELTA = 40
-            #     else:
-            #         TIMEDELTA = (time -cluster_oldest_time).total_seconds() // 60
-                
-            fire_events_condition = (fire_events["acquisition_time"] >= time - datetime.timedelta(minutes=TIMEDELTA)) & (fire_events["acquisition_time"] <= time)
-            fire_events = fire_events[fire_events_condition]
-            fire_events["acquisition_time"] = fire_events["acquisition_time"].astype(str)
-
-            if fire_events.empty:
-                log.info(f"No fire events data after pre-processing for cluster_id {cluster_id} at {time}")
-                return None
-            
-            fire_events["fire_cluster_id"] = cluster_id   
-            log.info(f"Preprocessed fire events data for {time} has {len(fire_events)} fire events out of {length_before} for cluster id {cluster_id}")
+        if not records:
+            return None
+
+        fire_events = pd.DataFrame(records, columns=['id','gsd', 'acquisition_time','frp', 'product_id', 'satellite', 'algorithm', 'lon', 'lat'])
+        fire_events["fire_cluster_id"] = np.concatenate(cluster_ids)
+        length_before = len(fire_events)
+
+        # only collect the fire events that are detected (TIMEDELTA) minutes before the 'time'
+        acquisition_time = pd.to_datetime(fire_events["acquisition_time"], format="ISO8601", utc=True)
+        fire_events_condition = (acquisition_time >= time - datetime.timedelta(minutes=TIMEDELTA)) & (acquisition_time <= time)
+        fire_events = fire_events[fire_events_condition.to_numpy()]
+
+        if fire_events.empty:
+            log.info(f"No fire events data after pre-processing for {len(responses)} clusters at {time}")
+            return None
 
-            return fire_events
+        fire_events["acquisition_time"] = acquisition_time[fire_events_condition].astype(str).to_numpy()
+        fire_events = gpd.GeoDataFrame(
+            fire_events.drop(columns=["lon", "lat"]).rename(columns={"id":"fire_event_id"}),
+            geometry=gpd.points_from_xy(fire_events["lon"], fire_events["lat"]),
+            crs="EPSG:4326"
+        )
+        fire_events = fire_events[['fire_event_id','gsd', 'acquisition_time','frp', 'product_id', 'satellite', 'algorithm', 'geometry', 'fire_cluster_id']]
+        log.info(f"Preprocessed fire events data for {time} has {len(fire_events)} fire events out of {length_before} for {len(responses)} clusters")
 
+        return fire_events
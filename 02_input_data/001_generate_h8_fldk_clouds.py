@@ -1,12 +1,12 @@
 import os
-import json
 import time
+import argparse
 from datetime import datetime, timedelta
-import geopandas as gpd
-import boto3
-from botocore.client import Config
-from botocore import UNSIGNED
-from concurrent.futures import ThreadPoolExecutor
+from label_store import read_labels
+from h8_s3 import H8BucketIndex, TransferGovernor, BUCKET_NAME, FLDK_DIR, CLOUD_PRODUCT_DIR, is_fldk_band_key, is_cloud_mask_key, get_object_store_path, download_object
+from utils import get_timestamps, link_file
+from manifest import get_manifest
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging as log
 
 WORKDIR = os.getcwd()
@@ -18,16 +18,11 @@ log.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S"
 )
-# Define the S3 bucket and directory
-BUCKET_NAME = 'noaa-himawari8'
-FLDK_DIR = 'AHI-L1b-FLDK'
-CLOUD_PRODUCT_DIR = 'AHI-L2-FLDK-Clouds'
-
 def read_timestamps(labels_path:str) -> list:
     """
     Returns a list of unique timestamps of the labels
     """
-    labels = gpd.read_file(labels_path)
+    labels = read_labels(labels_path, columns=["date", "geometry"])
     time_stamps = labels["date"].dt.strftime('%Y/%m/%d/%H%M/')
     unique_time_stamps= list(time_stamps.unique().astype(str))
     
@@ -49,45 +44,95 @@ def get_child_timestamps(timestamp_str):
 
     return sorted(intervals)
 
-def main(timestamp:str):
-    """ 
-    Downloads the fldk and cloud product data for the given timestamps
-
+def get_timestamp_files(timestamp:str, index: H8BucketIndex) -> list:
+    """
+    Returns (object key, local file path) of the fldk and cloud product data for the given timestamp
     """
-    s3 = boto3.client("s3",config=Config(signature_version=UNSIGNED),region_name='us-east-1')
-
     child_timestamps = get_child_timestamps(timestamp)
 
+    timestamp_files = []
     for child_timestamp in child_timestamps:
 
         data_files = []
-        # Download the fldk data
-        fldk_url = f'{FLDK_DIR}/{child_timestamp}'
-        fldk_response = s3.list_objects(Bucket=BUCKET_NAME, Prefix=fldk_url)
-         # Filter objects based on the naming convention
-        fldk_files = [obj['Key'] for obj in fldk_response.get('Contents', [])
-                if '_B07_' in obj['Key'] or '_B11_' in obj['Key'] or '_B12_' in obj['Key'] or '_B13_' in obj['Key'] or '_B14_' in obj['Key'] or '_B15_' in obj['Key']]
+        # fldk data, the object keys come from the local index of the bucket
+        fldk_files = [key for key in index.list_keys(FLDK_DIR, child_timestamp) if is_fldk_band_key(key)]
         data_files.extend(fldk_files)
 
-        # Download the cloud product data only for the last timestamp
+        # cloud product data only for the last timestamp
         if child_timestamp == timestamp:
-            cloud_url = f'{CLOUD_PRODUCT_DIR}/{child_timestamp}'
-            cloud_response = s3.list_objects(Bucket=BUCKET_NAME, Prefix=cloud_url)
-            cloud_files = [obj['Key'] for obj in cloud_response.get('Contents', [])
-                    if '-CMSK_' in obj['Key'] or '_CLOUD_MASK_' in obj['Key']]
+            cloud_files = [key for key in index.list_keys(CLOUD_PRODUCT_DIR, child_timestamp) if is_cloud_mask_key(key)]
             data_files.extend(cloud_files)
-    
-        # Download desired files
+
+        path = f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/"
         for file_key in data_files:
-            path = f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/"
-            if not os.path.exists(path):
-                os.makedirs(path)
-            local_file_path = path + file_key.split('/')[-1]  # Specify local download path
-            if not os.path.exists(local_file_path):
-                s3.download_file(BUCKET_NAME, file_key, local_file_path)
-                log.info(f"Downloaded {file_key.split('/')[-1]} to {local_file_path}")
-            else:
-                log.info(f"File {local_file_path} already exists")
+            timestamp_files.append((file_key, path + file_key.split('/')[-1]))
+
+    return timestamp_files
+
+def plan_downloads(timestamps:list, index: H8BucketIndex, executor: ThreadPoolExecutor) -> dict:
+    """
+    Returns a dictionary of object key -> local file paths. Parent timestamps that are 10-30 minutes apart share
+    child timestamps, every shared object is downloaded only once
+    """
+    plan = {}
+    for timestamp_files in executor.map(get_timestamp_files, timestamps, [index]*len(timestamps)):
+        for file_key, local_file_path in timestamp_files:
+            plan.setdefault(file_key, []).append(local_file_path)
+
+    return plan
+
+def main(file_key:str, local_file_paths:list, index: H8BucketIndex, governor: TransferGovernor):
+    """ 
+    Downloads the object once into the object store and links it into every timestamp directory that uses it
+
+    """
+    s3 = index.s3
+    size, etag = index.get_object(file_key)
+
+    # files of the wrong size are leftovers of killed runs and are replaced
+    missing_paths = [local_file_path for local_file_path in local_file_paths if not os.path.exists(local_file_path) or os.path.getsize(local_file_path) != size]
+    if not missing_paths:
+        log.info(f"File {file_key.split('/')[-1]} already exists in all {len(local_file_paths)} timestamp directories")
+        if is_cloud_mask_key(file_key):
+            # files of earlier runs (or whose registration failed) are registered as well
+            for local_file_path in local_file_paths:
+                get_manifest().register_path(local_file_path, "cloud_nc")
+        return
+
+    store_path = get_object_store_path(file_key)
+    if not os.path.exists(store_path):
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        download_object(s3, BUCKET_NAME, file_key, store_path, size, etag, governor)
+        log.info(f"Downloaded {file_key.split('/')[-1]} to {store_path}")
+
+    for local_file_path in missing_paths:
+        link_file(store_path, local_file_path)
+        if is_cloud_mask_key(file_key):
+            get_manifest().register_path(local_file_path, "cloud_nc")
+    log.info(f"Linked {file_key.split('/')[-1]} into {len(missing_paths)} timestamp directories")
+
+def download_all(plan: dict, index: H8BucketIndex, governor: TransferGovernor, executor: ThreadPoolExecutor, max_rounds: int) -> dict:
+    """
+    Downloads all the planned objects. Failed objects are collected and retried up to max_rounds times.
+    Returns the objects that still failed
+    """
+    failed = plan
+    for download_round in range(max_rounds):
+        futures = {executor.submit(main, file_key, local_file_paths, index, governor): file_key for file_key, local_file_paths in failed.items()}
+        errors = {}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.error(f"Failed to download {futures[future]}: {e}")
+                errors[futures[future]] = e
+        failed = {file_key: plan[file_key] for file_key in errors}
+        if not failed:
+            break
+        log.warning(f"{len(failed)} objects failed in round {download_round+1}, retrying")
+        time.sleep(2 ** download_round)
+
+    return failed
 
         
    
@@ -100,19 +145,29 @@ if __name__ == "__main__":
     # labels_path = 'data/fire_labels/combined_data/finalized_data/2021_2022_combined_12_preprocessed.geojson'
     # timestamps = read_timestamps(labels_path)
 
-    # using locally saved unique timestamps for seed 12 
-    with open("data/fire_masks/unique_dates_ten_minute_finalized.json") as json_file:
-        timestamps = json.load(json_file)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--WORKERS", type=int, default=64, help="No of threads used to plan and download")
+    parser.add_argument("--MAX_CONCURRENT_DOWNLOADS", type=int, default=32, help="Maximum no of objects downloaded at the same time")
+    parser.add_argument("--MAX_MB_PER_SECOND", type=float, default=None, help="Maximum total download bandwidth")
+    parser.add_argument("--MAX_ROUNDS", type=int, default=5, help="No of times failed downloads are retried")
+    args = parser.parse_args()
+
+    # unique timestamps of the years to process (GEO_DL_YEARS)
+    timestamps = get_timestamps()
     log.info(f"Downloading FLDK and CMSK for {len(timestamps)} timestamps")
+    index = H8BucketIndex()
+    governor = TransferGovernor(
+        max_concurrent=args.MAX_CONCURRENT_DOWNLOADS,
+        max_bytes_per_second=args.MAX_MB_PER_SECOND * 1024**2 if args.MAX_MB_PER_SECOND is not None else None
+    )
     t = time.time()
-    with ThreadPoolExecutor(max_workers=32) as executor:
-        for timestamp in timestamps:
-            executor.submit(main, timestamp)
+    with ThreadPoolExecutor(max_workers=args.WORKERS) as executor:
+        plan = plan_downloads(timestamps, index, executor)
+        no_of_links = sum(len(local_file_paths) for local_file_paths in plan.values())
+        log.info(f"Planned {len(plan)} unique objects for {no_of_links} files (overlap factor {no_of_links/max(len(plan),1):.2f})")
+        failed = download_all(plan, index, governor, executor, args.MAX_ROUNDS)
+
+    if failed:
+        log.error(f"Could not download {len(failed)} objects: {list(failed)}")
     log.info(f"Downloaded all files in {(time.time()-t)/60} minutes")
     # main(BUCKET_NAME, FLDK_DIR, CLOUD_PRODUCT_DIR, timestamps)
-
-
-
-
-
-
@@ -2,13 +2,15 @@ import satpy
 import glob
 import os
 import rasterio
-import json
 import numpy as np
+import time
+import dask
+import argparse
 import concurrent.futures
-from utils import get_child_timestamps
-from rasterio.mask import mask
-from rasterio.io import MemoryFile
-import geopandas as gpd
+from utils import get_child_timestamps, get_timestamps, link_file, timed
+from h8_s3 import release_object, is_fldk_band_key, get_key_segment, FLDK_BANDS, NO_OF_SEGMENTS
+from aoi_grid import get_aoi_grid
+from manifest import get_manifest
 import logging as log
 
 WORKDIR = os.getcwd()
@@ -21,7 +23,18 @@ log.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 
-def unzip_covert_to_tiff(filenames, timestamp, child_timestamp):
+# stages reported by process_scene, in full_disk mode the lazy calibration is done while writing the GeoTIFFs
+STAGES = ["decompress", "calibrate", "write", "stack", "mask"]
+
+def delete_bz2_files(filenames):
+    """
+    Deletes the downloaded .bz2 files and their object store copy once no other timestamp links to it
+    """
+    for filename in filenames:
+        os.remove(filename)
+        release_object(filename)
+
+def unzip_covert_to_tiff(filenames, timestamp, child_timestamp, timings=None):
     
     # check if the files are already unzipped and if yes, then skip
     len_files = len(glob.glob(f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/B*.tif"))
@@ -31,8 +44,7 @@ def unzip_covert_to_tiff(filenames, timestamp, child_timestamp):
         if len(filenames) != 0:
             # delete all .bz2 files
             log.info(f"Deleting .bz2 files for {timestamp}{child_timestamp.split('/')[-2]}")
-            for filename in filenames:
-                os.remove(filename)
+            delete_bz2_files(filenames)
         else:
             log.info(f"No .bz2 files to delete for {timestamp}{child_timestamp.split('/')[-2]}")
         return
@@ -41,106 +53,228 @@ def unzip_covert_to_tiff(filenames, timestamp, child_timestamp):
     log.info(f"Unzipping for {timestamp}{child_timestamp.split('/')[-2]}")
     
     # unzip the files
-    scene = satpy.Scene(reader='ahi_hsd', filenames=filenames)
+    with timed(timings, "decompress"):
+        scene = satpy.Scene(reader='ahi_hsd', filenames=filenames)
 
-    scene.load(scene.available_dataset_names(),calibration='brightness_temperature')
+    with timed(timings, "calibrate"):
+        scene.load(scene.available_dataset_names(),calibration='brightness_temperature')
     log.info("loaded Scenes")
 
     # save datasets as geotiffs   
-    scene.save_datasets(writer='geotiff', dtype= np.float32, enhance= False, base_dir=f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}")
+    with timed(timings, "write"):
+        scene.save_datasets(writer='geotiff', dtype= np.float32, enhance= False, base_dir=f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}")
     log.info("saved datasets")
 
     # after unzipping delete al .bz2 files
     log.info(f"Deleting .bz2 files for {timestamp}{child_timestamp.split('/')[-2]}")
-    for filename in filenames:
-        os.remove(filename)
+    delete_bz2_files(filenames)
 
 
-def stack_bands_and_mask(files, timestamp, child_timestamp):
-
+def stack_bands_and_mask(files, timestamp, child_timestamp, timings=None):
+    """
+    Reads the AOI window of every band straight into one (bands, H, W) buffer, sets the pixels outside the AOI to
+    the nodata value of the bands and writes the stack. The full disk bands are never read completely
+    """
     # check if the files are already stacked and masked and if yes, then skip
-    len_files = len(glob.glob(f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/{timestamp.replace('/','_')}{child_timestamp.split('/')[-2]}_stacked_masked.tif"))
-    if len_files>0:
+    stacked_path = get_stacked_path(timestamp, child_timestamp)
+    if os.path.exists(stacked_path):
         log.info(f"files already stacked and masked for {timestamp}{child_timestamp.split('/')[-2]}")
         return
-    # Open all bands and stack them
-    band_stack = [rasterio.open(band_path).read(1) for band_path in files]
-    band_stack = np.stack(band_stack, axis=0)
+    if len(files) == 0:
+        log.warning(f"No band files to stack for {timestamp}{child_timestamp.split('/')[-2]}")
+        return
 
-    # Get metadata from one of the bands to use in the stacked file
-    with rasterio.open(files[0]) as src:
-        meta = src.meta.copy()
-    
-    # Update metadata for the stacked file
-    meta.update({
-        'count': band_stack.shape[0],  # Number of bands in the stacked file
-        'dtype': np.float32  # Adjust dtype if needed
-    })
+    band_stack = np.empty((len(files), *AOI_GRID.shape), dtype=np.float32)
+    with timed(timings, "stack"):
+        for i, band_path in enumerate(files):
+            with rasterio.open(band_path) as src:
+                if src.shape != AOI_GRID.full_shape:
+                    raise ValueError(f"{band_path} is not on the full disk 2 km grid of the AOI")
+                src.read(1, window=AOI_GRID.window, out=band_stack[i])
+                if i == 0:
+                    # Get metadata from one of the bands to use in the stacked file
+                    meta = src.meta.copy()
 
-    # Create an in-memory file to store the stacked bands
-    with MemoryFile() as memfile:
-        with memfile.open(**meta) as dst:
-            dst.write(band_stack)
+    with timed(timings, "mask"):
+        band_stack[:, AOI_GRID.outside] = meta["nodata"] if meta.get("nodata") is not None else 0
 
-        # Apply mask to the stacked bands in memory
-        with memfile.open() as src:
-            masked_raster, masked_transform = rasterio.mask.mask(src, AOI_H8_GEOM, crop=True)
-            masked_meta = src.meta.copy()
+    with timed(timings, "write"):
+        write_stack(band_stack, meta, stacked_path)
+    log.info(f"saved stacked and masked raster for timestamp: {timestamp}{child_timestamp.split('/')[-2]}")
 
-    # Update metadata for the masked raster
+def write_stack(band_stack, meta, stacked_path):
+    """
+    Writes the cropped stack atomically so that an interrupted run never leaves a partial stacked file
+    """
+    masked_meta = AOI_GRID.get_meta(meta)
     masked_meta.update({
-        "driver": "GTiff",
-        "height": masked_raster.shape[1],
-        "width": masked_raster.shape[2],
-        "transform": masked_transform
+        "count": band_stack.shape[0],
+        "dtype": np.float32
     })
+    tmp_path = f"{os.path.dirname(stacked_path)}/.{os.path.basename(stacked_path)}.tmp"
+    with rasterio.open(tmp_path, 'w', **masked_meta) as dst:
+        dst.write(band_stack)
+    os.replace(tmp_path, stacked_path)
+
+def get_aoi_segments(window, height: int) -> list:
+    """
+    Returns the numbers of the HSD segments that contain the rows of the window
+    """
+    rows_per_segment = height // NO_OF_SEGMENTS
+    row_start = int(window.row_off)
+    row_stop = int(window.row_off + window.height)
+    return list(range(row_start // rows_per_segment + 1, (row_stop - 1) // rows_per_segment + 2))
+
+def decode_roi(filenames, timestamp, child_timestamp, timings=None):
+    """
+    Decodes only the segments of FLDK_BANDS that intersect the AOI, calibrates them to brightness temperature and
+    writes the cropped and masked stack directly, without the full disk GeoTIFFs of unzip_covert_to_tiff
+    """
+    stacked_path = get_stacked_path(timestamp, child_timestamp)
+    if os.path.exists(stacked_path):
+        log.info(f"files already stacked and masked for {timestamp}{child_timestamp.split('/')[-2]}")
+        if len(filenames) != 0:
+            delete_bz2_files(filenames)
+        return
+
+    segments = get_aoi_segments(AOI_GRID.window, AOI_GRID.full_shape[0])
+    roi_filenames = [filename for filename in filenames if is_fldk_band_key(os.path.basename(filename)) and get_key_segment(filename) in segments]
+    missing_bands = [band for band in FLDK_BANDS if not any(f"_{band}_" in os.path.basename(filename) for filename in roi_filenames)]
+    if len(missing_bands) != 0:
+        log.warning(f"Bands {missing_bands} missing for {timestamp}{child_timestamp.split('/')[-2]}, not decoding it")
+        return
+    # the reader pads a missing segment with NaN rows, the stack would be written as complete
+    missing_segments = {
+        band: [segment for segment in segments if not any(f"_{band}_" in os.path.basename(filename) and get_key_segment(filename) == segment for filename in roi_filenames)]
+        for band in FLDK_BANDS
+    }
+    missing_segments = {band: band_segments for band, band_segments in missing_segments.items() if len(band_segments) != 0}
+    if len(missing_segments) != 0:
+        log.warning(f"Segments {missing_segments} (band: segments) missing for {timestamp}{child_timestamp.split('/')[-2]}, not decoding it")
+        return
+
+    log.info(f"Decoding segments {segments} of {timestamp}{child_timestamp.split('/')[-2]}")
+    # segments that are not passed to the reader are padded and never decompressed
+    with timed(timings, "decompress"):
+        scene = satpy.Scene(reader='ahi_hsd', filenames=roi_filenames)
 
-    # Save the masked raster as a new GeoTIFF file
-    with rasterio.open(f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/{timestamp.replace('/','_')}{child_timestamp.split('/')[-2]}_stacked_masked.tif", 'w', **masked_meta) as dst:
-        dst.write(masked_raster)
+    band_stack = np.empty((len(FLDK_BANDS), *AOI_GRID.shape), dtype=np.float32)
+    with timed(timings, "calibrate"):
+        scene.load(FLDK_BANDS, calibration='brightness_temperature')
+        for i, band in enumerate(FLDK_BANDS):
+            # only the chunks of the window are calibrated
+            band_stack[i] = AOI_GRID.crop(scene[band].data)
+    with timed(timings, "mask"):
+        band_stack[:, AOI_GRID.outside] = AOI_GRID.nodata if AOI_GRID.nodata is not None else 0
+    log.info("decoded AOI")
+
+    with timed(timings, "write"):
+        write_stack(band_stack, {"nodata": AOI_GRID.nodata}, stacked_path)
     log.info(f"saved stacked and masked raster for timestamp: {timestamp}{child_timestamp.split('/')[-2]}")
 
-def process_timestamp(timestamp):
+    log.info(f"Deleting .bz2 files for {timestamp}{child_timestamp.split('/')[-2]}")
+    delete_bz2_files(filenames)
 
-    log.info(f"Processing timestamp: {timestamp}")
-    # get the files for the timestamp
-    child_timestamps = get_child_timestamps(timestamp)
-    for child_timestamp in child_timestamps:
-        filenames = sorted(glob.glob(f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/*.bz2"))
-        unzip_covert_to_tiff(filenames, timestamp, child_timestamp)
+def get_stacked_path(timestamp, child_timestamp):
+    return f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/{timestamp.replace('/','_')}{child_timestamp.split('/')[-2]}_stacked_masked.tif"
+
+def plan_scenes(timestamps) -> dict:
+    """
+    Returns a dictionary of child timestamp -> parent timestamps. Parents that are 10-30 minutes apart share child scenes
+    """
+    scenes = {}
+    for timestamp in timestamps:
+        for child_timestamp in get_child_timestamps(timestamp):
+            scenes.setdefault(child_timestamp, []).append(timestamp)
+    return scenes
+
+def init_worker():
+    """
+    Initializer of the worker processes: one dask worker per process (the processes already use all cores) and the
+    AOI loaded once per process
+    """
+    global AOI_GRID
+    dask.config.set(scheduler="synchronous")
+    AOI_GRID = get_aoi_grid()
+
+def process_scene(child_timestamp, timestamps, decode_mode="full_disk") -> dict:
+    """
+    Decodes, stacks and masks the child scene once in the directory of the first parent timestamp and links the
+    stacked file into the directories of the other parents. Returns the seconds spent in each of STAGES
+    args:
+        decode_mode: str ("full_disk" saves every band of the full disk and crops the stack, "roi" decodes only the AOI)
+    """
+    log.info(f"Processing scene: {child_timestamp} for {len(timestamps)} timestamps")
+    timings = dict.fromkeys(STAGES, 0.0)
+    timestamp = timestamps[0]
+    filenames = sorted(glob.glob(f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/*.bz2"))
+    if decode_mode == "roi":
+        decode_roi(filenames, timestamp, child_timestamp, timings)
+    else:
+        unzip_covert_to_tiff(filenames, timestamp, child_timestamp, timings)
         tif_files = sorted(glob.glob(f"data/himawari8/{timestamp}{child_timestamp.split('/')[-2]}/B*.tif"))
-        stack_bands_and_mask(tif_files,timestamp,child_timestamp)
+        stack_bands_and_mask(tif_files,timestamp,child_timestamp, timings)
+
+    stacked_path = get_stacked_path(timestamp, child_timestamp)
+    if not os.path.exists(stacked_path):
+        log.warning(f"No stacked and masked raster for scene {child_timestamp}, not linking it into the other timestamps")
+        return timings
+    manifest = get_manifest()
+    manifest.register(timestamp, child_timestamp.split('/')[-2], "stacked_masked", stacked_path)
+    for other_timestamp in timestamps[1:]:
+        other_stacked_path = get_stacked_path(other_timestamp, child_timestamp)
+        if not os.path.exists(other_stacked_path):
+            link_file(stacked_path, other_stacked_path)
+            log.info(f"Linked stacked and masked raster of {child_timestamp} into {other_timestamp}")
+        manifest.register(other_timestamp, child_timestamp.split('/')[-2], "stacked_masked", other_stacked_path)
+        # the downloaded files of the other parents are the same scene and are not decoded again
+        delete_bz2_files(sorted(glob.glob(f"data/himawari8/{other_timestamp}{child_timestamp.split('/')[-2]}/*.bz2")))
+    return timings
 
 
 if __name__=="__main__":
 
-    # load aoi
-    AOI_H8 = gpd.read_file("02_input_data/aoi_h8_updated.geojson")
-    AOI_H8_GEOM = AOI_H8["geometry"]
-    print(AOI_H8_GEOM)
-    log.info("loaded AOI")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--DECODE_MODE", choices=["full_disk", "roi"], default="full_disk", help="Decode the full disk of all bands or only the AOI segments of the used bands")
+    parser.add_argument("--EXECUTOR", choices=["thread", "process"], default="thread", help="Process the scenes in threads or in processes with one dask worker each")
+    parser.add_argument("--WORKERS", type=int, default=23, help="No of scenes processed concurrently")
+    args = parser.parse_args()
+
+    # AOI window and mask are computed once (and persisted) and used by every scene
+    AOI_GRID = get_aoi_grid()
+    log.info(f"loaded AOI grid {AOI_GRID.window}")
     
-    # using locally saved unique timestamps 
-    with open("data/fire_masks/unique_dates_ten_minute_finalized.json") as json_file:
-        timestamps = json.load(json_file)
+    # unique timestamps of the years to process (GEO_DL_YEARS), only 2022 by default due to storage constraints
+    timestamps = get_timestamps()
+    log.info(f"Total timestamps to be processed: {len(timestamps)}")
 
-    # remove timestamps for 2022 due to storage constraints | processing 2022 timestamps separately
-    timestamps_2022 = []
-    for timestamp in timestamps:
-        if timestamp.split("/")[0] == "2022":
-            timestamps_2022.append(timestamp)
+    # every child scene is processed once even if it belongs to several parent timestamps
+    scenes = plan_scenes(timestamps)
+    log.info(f"Total child scenes to be processed: {len(scenes)}")
 
-    log.info(f"Total timestamps to be processed for 2022: {len(timestamps_2022)}")
+    if args.EXECUTOR == "process":
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.WORKERS, initializer=init_worker)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.WORKERS)
 
-    # Create a ThreadPoolExecutor with 23 threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=23) as executor:
-        # Submit tasks for each timestamp
-        futures = [executor.submit(process_timestamp, timestamp) for timestamp in timestamps_2022]
+    start = time.perf_counter()
+    total_timings = dict.fromkeys(STAGES, 0.0)
+    with executor:
+        # Submit tasks for each scene
+        futures = [executor.submit(process_scene, child_timestamp, scene_timestamps, args.DECODE_MODE) for child_timestamp, scene_timestamps in scenes.items()]
 
         # Wait for all tasks to finish
-        concurrent.futures.wait(futures)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                for stage, seconds in future.result().items():
+                    total_timings[stage] += seconds
+            except Exception as e:
+                log.error(f"Processing scene failed: {e}")
+    wall_time = time.perf_counter() - start
 
-    log.info("Done processing all timestamps")
+    log.info(f"Done processing all timestamps: {len(scenes)} scenes in {wall_time:.1f}s with {args.WORKERS} {args.EXECUTOR} workers ({len(scenes) / wall_time:.2f} scenes/s)")
+    for stage, seconds in total_timings.items():
+        log.info(f"{stage}: {seconds:.1f}s in total, {seconds / max(len(scenes), 1):.2f}s per scene")
 
     # for timestamp in timestamps_2022:
 
@@ -1,12 +1,15 @@
 import os
+import argparse
 import rasterio
 import logging as log
 import numpy as np
 import geopandas as gpd
-import rasterio.mask
-from shapely.geometry import shape
-from rasterio.features import rasterize
-from utils import get_h8_proj4_string, create_empty_h8_mask
+import concurrent.futures
+from rasterio.errors import WindowError
+from utils import get_h8_proj4_string, create_empty_h8_mask, get_timestamps
+from label_store import read_labels
+from sparse_labels import SparseLabels, get_labels_path, write_sparse_labels
+from label_rasterization import get_labels_window, rasterize_geometries
 
 WORKDIR = os.getcwd()
 log_file = f"{WORKDIR}/04_pre_processing/rasterize_labels.txt"  # Path to the log file
@@ -18,94 +21,75 @@ log.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 
+EMPTY_RASTER_PATH = "data/himawari8/empty_mask_h8_aoi_updated.tif"
+AHI_ALGORITHM = "GA-AHI-SRSS"
+
+
+def init_worker():
+    """
+    Loads the grid of the empty AOI raster once per worker process
+    """
+    global META
+    with rasterio.open(EMPTY_RASTER_PATH) as src:
+        META = src.meta.copy()
+
+def rasterize_labels(date, geometries, product: str) -> str:
+    """
+    Rasterizes the fire geometries of one date inside their bounding window and writes the sparse labels of the
+    product ("ahi_labels" or "non_ahi_labels")
+    """
+    date_str = date.strftime("%Y/%m/%d/%H%M")
+    shape = (META["height"], META["width"])
+
+    labels = SparseLabels.empty(shape)
+    try:
+        window = get_labels_window(geometries, META)
+    except WindowError:
+        # all the fires are outside of the AOI
+        window = None
+    if window is not None:
+        labels = SparseLabels(*rasterize_geometries(geometries, META, window), shape)
+
+    write_sparse_labels(labels, date, product)
+    return date_str
+
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--WORKERS", type=int, default=os.cpu_count(), help="No of processes rasterizing the dates")
+    args = parser.parse_args()
+
     # create empty raster for reference
     create_empty_h8_mask()
 
     # read and rasterize labels
-    labels = gpd.read_file("data/fire_masks/2020_2021_2022_combined_1703273207_ten_minute_preprocessed_finalized.geojson")
+    labels = read_labels("data/fire_masks/2020_2021_2022_combined_1703273207_ten_minute_preprocessed_finalized.parquet", columns=["date", "algorithm", "geometry"])
     log.info("Read labels")
 
     reprojected_labels = labels.to_crs(get_h8_proj4_string())
     log.info("Reprojected labels")
 
-    non_ahi_data = reprojected_labels[reprojected_labels["algorithm"]!= "GA-AHI-SRSS"]
-    ahi_data = reprojected_labels[reprojected_labels["algorithm"] == "GA-AHI-SRSS"]
-    non_ahi_data_unique_dates = non_ahi_data["date"].unique()
-    ahi_data_unique_dates = ahi_data["date"].unique()
-    log.info(f"Separated AHI and NON-AHI labels")
-
-    EMPTY_RASTER = rasterio.open('data/himawari8/empty_mask_h8_aoi_updated.tif')
-    WIDTH = EMPTY_RASTER.width
-    HEIGHT = EMPTY_RASTER.height
-    COUNT = EMPTY_RASTER.count
-    TRANSFORM = EMPTY_RASTER.transform
-    CRS = EMPTY_RASTER.crs
-
-    log.info(f"Rasterizing NON-AHI labels")
-    for date in non_ahi_data_unique_dates:
-        date_labels = non_ahi_data[non_ahi_data["date"]==date]
-        date_fires = [shape(geometry) for geometry in date_labels["geometry"]]
-        date_str = date.strftime("%Y/%m/%d/%H%M")
-        date_lbl = date.strftime("%Y_%m_%d_%H%M")
-        log.info(f"Rasterizing {date_str}")
-        # rasterize the labels
-        if not os.path.exists(f"data/himawari8/{date_str}/{date_lbl}_non_ahi_labels.tif"):
-            try:
-                with rasterio.open(f"data/himawari8/{date_str}/{date_lbl}_non_ahi_labels.tif", "w", driver='GTiff', 
-                        width=WIDTH, height=HEIGHT, count=COUNT, 
-                        dtype=rasterio.uint8, 
-                        crs=CRS, 
-                        transform=TRANSFORM) as dest:
-                    rasterized = rasterize(
-                        shapes=date_fires,
-                        out_shape=(HEIGHT, WIDTH),
-                        fill=0,
-                        transform=TRANSFORM,
-                        default_value=1
-                    
-                    )
-                    dest.write(rasterized,indexes=1)
-                    dest.write(EMPTY_RASTER.read(2),indexes=2)
-                log.info(f"Rasterized {date_str}")
-            except Exception as e:
-                log.error(f"Error rasterizing {date_str}: {e}")
-                continue
-        else:
-            log.warning(f"Raster {date_str} already exists")
-
-    
-    log.info(f"Rasterizing AHI labels")
-    for date in ahi_data_unique_dates:
-        date_labels = ahi_data[ahi_data["date"]==date]
-        date_fires = [shape(geometry) for geometry in date_labels["geometry"]]
+    # AHI and NON-AHI labels are rasterized by the same tasks, one per (date, product)
+    reprojected_labels["product"] = np.where(reprojected_labels["algorithm"] == AHI_ALGORITHM, "ahi_labels", "non_ahi_labels")
+    # only the dates of the years to process (GEO_DL_YEARS)
+    timestamps = set(get_timestamps())
+    tasks = []
+    for (product, date), date_labels in reprojected_labels.groupby(["product", "date"], sort=True):
         date_str = date.strftime("%Y/%m/%d/%H%M")
-        date_lbl = date.strftime("%Y_%m_%d_%H%M")
-        log.info(f"Rasterizing {date_str}")
-        # rasterize the labels
-        if not os.path.exists(f"data/himawari8/{date_str}/{date_lbl}_ahi_labels.tif"):
+        if f"{date_str}/" not in timestamps:
+            continue
+        if os.path.exists(get_labels_path(date, product)):
+            log.warning(f"Labels {product} {date_str} already exist")
+            continue
+        tasks.append((date, list(date_labels.geometry), product))
+    log.info(f"Rasterizing {len(tasks)} AHI and NON-AHI labels")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.WORKERS, initializer=init_worker) as executor:
+        futures = {executor.submit(rasterize_labels, *task): task for task in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            date, _, product = futures[future]
             try:
-                with rasterio.open(f"data/himawari8/{date_str}/{date_lbl}_ahi_labels.tif", "w", driver='GTiff', 
-                        width=WIDTH, height=HEIGHT, count=COUNT, 
-                        dtype=rasterio.uint8, 
-                        crs=CRS, 
-                        transform=TRANSFORM) as dest:
-                    rasterized = rasterize(
-                        shapes=date_fires,
-                        out_shape=(HEIGHT, WIDTH),
-                        fill=0,
-                        transform=TRANSFORM,
-                        default_value=1
-                    
-                    )
-                    dest.write(rasterized,indexes=1)
-                    dest.write(EMPTY_RASTER.read(2),indexes=2)
-                log.info(f"Rasterized {date_str}")
+                log.info(f"Rasterized {product} {future.result()}")
             except Exception as e:
-                log.error(f"Error rasterizing {date_str}: {e}")
-                continue
-        else:
-            log.warning(f"Raster {date_str} already exists")
-
-
+                log.error(f"Error rasterizing {product} {date.strftime('%Y/%m/%d/%H%M')}: {e}")
@@ -1,11 +1,12 @@
 import os
-import glob
+import argparse
 import rasterio
-import numpy as np
-import geopandas as gpd
-from scipy.ndimage import label, generate_binary_structure
-from scipy.ndimage import label, generate_binary_structure, find_objects
-from scipy.signal import correlate2d
+import concurrent.futures
+from label_store import read_labels
+from sparse_labels import SparseLabels, get_labels_path, read_sparse_labels, write_sparse_labels
+from manifest import get_manifest
+from ahi_label_shift import shift_labels
+from utils import get_timestamps
 import logging as log
 
 WORKDIR = os.getcwd()
@@ -19,88 +20,67 @@ log.basicConfig(
 )
 
 
-def calculate_shift(fldk_slice,labels_slice)-> np.array:
+def process_date(date) -> int:
     """
-    Calculate the shift between two arrays using cross-correlation
+    Shifts the AHI labels of the date onto its B07 band and writes the updated labels. Returns the no of features
     """
-    # Compute cross-correlation
-    cross_corr = correlate2d(fldk_slice, labels_slice)
+    date_str = date.strftime("%Y/%m/%d/%H%M")
 
-    # Find the peak
-    y_shift, x_shift = np.unravel_index(np.argmax(cross_corr), cross_corr.shape)
+    # read labels data
+    ahi_labels = read_sparse_labels(date, "ahi_labels")
+    if ahi_labels is None:
+        log.info(f"Missing ahi labels for {date_str}")
+        return 0
 
-    # Calculate the shift relative to the center
-    y_shift -= fldk_slice.shape[0] - 1
-    x_shift -= fldk_slice.shape[1] - 1
+    # read corresponding B07 data
+    stacked_path = get_manifest().get(date.strftime("%Y/%m/%d/%H%M/"), date.strftime("%H%M"), "stacked_masked")
+    if stacked_path is None:
+        raise FileNotFoundError(f"No stacked and masked raster registered for {date_str}")
+    with rasterio.open(stacked_path) as src:
+        ahi_b7_raster_data = src.read(1)
 
-    # Apply the shift to array2
-    shifted_array2 = np.roll(np.roll(labels_slice, y_shift, axis=0), x_shift, axis=1)
+    ahi_labels_raster_data, num_features = shift_labels(ahi_labels.to_dense(), ahi_b7_raster_data)
+    log.info(f"Calculated shift for all {num_features} labels in {date_str}")
 
-    return shifted_array2
+    # write the updated labels
+    write_sparse_labels(SparseLabels.from_dense(ahi_labels_raster_data), date, "updated_ahi_labels")
+    return num_features
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--WORKERS", type=int, default=os.cpu_count(), help="No of processes shifting the labels of different dates")
+    args = parser.parse_args()
+
     # read labels
-    labels_data = gpd.read_file("data/fire_masks/2020_2021_2022_combined_1703273207_ten_minute_preprocessed_finalized.geojson")
+    labels_data = read_labels("data/fire_masks/2020_2021_2022_combined_1703273207_ten_minute_preprocessed_finalized.parquet", columns=["date", "algorithm", "geometry"], filters=[("algorithm", "==", "GA-AHI-SRSS")])
 
     # read ahi-labels
     ahi_data = labels_data[labels_data["algorithm"] == "GA-AHI-SRSS"]
     ahi_data_dates = ahi_data["date"].unique()
     log.info("Read ahi labels")
 
-    # as profile and background is same for all rasters, we will use the first raster as sample to get the profile and background
-    ahi_labels_background = rasterio.open("data/himawari8/2020/01/01/0500/2020_01_01_0500_non_ahi_labels.tif").read(2)
-    ahi_labels_profile = rasterio.open("data/himawari8/2020/01/01/0500/2020_01_01_0500_non_ahi_labels.tif").profile 
-
-    # consider the diagonal pixels as well for label clustering using binary structure below
-    s = generate_binary_structure(2,2)
-
-    # for each date update the raster by the computed shift
+    # for each date of the years to process (GEO_DL_YEARS) update the raster by the computed shift
+    timestamps = set(get_timestamps())
+    dates = []
     for date in ahi_data_dates:
-        # dont process any date in 2022 | process 2022 dataset
-        if date.year == 2022:
+        if date.strftime("%Y/%m/%d/%H%M/") in timestamps:
 
             # check if the date is already processed
-            if os.path.exists(f"data/himawari8/{date.strftime('%Y/%m/%d/%H%M')}/{date.strftime('%Y_%m_%d_%H%M')}_updated_ahi_labels.tif"):
+            if os.path.exists(get_labels_path(date, "updated_ahi_labels")):
                 log.info(f"Already created updated labels for {date.strftime('%Y/%m/%d/%H%M')}")
                 continue
-
-            date_str = date.strftime("%Y/%m/%d/%H%M")
-            date_lbl = date.strftime("%Y_%m_%d_%H%M")
-
-            # read labels data
-            ahi_labels_raster_data = rasterio.open(f"data/himawari8/{date_str}/{date_lbl}_ahi_labels.tif").read(1)
-
-            # read corresponding B07 data
-            ahi_b7_raster_data = rasterio.open(glob.glob(f"data/himawari8/{date_str}/{date_str.split('/')[-1]}/*_masked.tif")[0]).read(1)
-
-
-            # generate different numbers for the labels that are different in the same raster
-            labeled_array, num_features = label(ahi_labels_raster_data, structure=s)
-            log.info(f"Number of features for date {date} are: {num_features}")
-
-
-            # Get bounding box indices for each labeled feature and update the labels with the shift calculated
-            for feature in range(1,num_features+1):
-                labeled_feature_indices = find_objects(labeled_array == feature)[0]
-
-                # Dynamically add two rows and two columns to the bounding box (16 neighborhood)
-                expanded_indices = (
-                    slice(max(0, labeled_feature_indices[0].start - 2), min(labeled_array.shape[0], labeled_feature_indices[0].stop + 2)),
-                    slice(max(0, labeled_feature_indices[1].start - 2), min(labeled_array.shape[1], labeled_feature_indices[1].stop + 2))
-                )
-
-                ahi_labels_raster_data[expanded_indices] = calculate_shift(ahi_b7_raster_data[expanded_indices],ahi_labels_raster_data[expanded_indices])
-            
-            log.info(f"Calculated shift for all labels in {date_str}")
-
-            # Create a jnew output GeoTIFF file for the updated labels
-            with rasterio.open(f"data/himawari8/{date_str}/{date_lbl}_updated_ahi_labels.tif", 'w', **ahi_labels_profile) as dst:
-                # Write the modified Band 1 to the output file
-                dst.write(ahi_labels_raster_data, 1)
-                dst.write(ahi_labels_background, 2)
-
-            log.info(f"Updated labels for {date_str}")
-
-    log.info("Updated labels files for 2022")
+            dates.append(date)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.WORKERS) as executor:
+        futures = {executor.submit(process_date, date): date for date in dates}
+        for future in concurrent.futures.as_completed(futures):
+            date_str = futures[future].strftime("%Y/%m/%d/%H%M")
+            try:
+                future.result()
+                log.info(f"Updated labels for {date_str}")
+            except Exception as e:
+                log.error(f"Error updating labels for {date_str}: {e}")
+
+    log.info(f"Updated labels files for {len(dates)} dates")
@@ -0,0 +1,92 @@
+"""
+Fused label post processing: merge (003), cloud mask (005) and no data (006) in one pass
+
+For every timestamp the AHI and NON-AHI labels and the cloud mask are read once, merged and cloud masked in memory,
+and only the final cmsk_applied_labels are written. The intermediate products of the three separate steps are
+written only if asked for with --INTERMEDIATES.
+"""
+import os
+import argparse
+import rasterio
+import concurrent.futures
+import logging as log
+from sparse_labels import get_labels_path, read_sparse_labels, write_sparse_labels, write_dense
+from manifest import get_manifest
+from utils import get_timestamps
+
+WORKDIR = os.getcwd()
+log_file = f"{WORKDIR}/04_pre_processing/finalize_labels_2022.txt"  # Path to the log file
+
+log.basicConfig(
+    filename=log_file,
+    level=log.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+
+# intermediate products of 003, 005 and 006 that can be written in addition to cmsk_applied_labels
+INTERMEDIATES = ["finalized_labels", "cmsk4_applied_labels", "with_nan"]
+
+
+def process_timestamp(timestamp: str, intermediates: list) -> bool:
+    """
+    Merges the labels of the timestamp, applies the cloud mask and writes the cmsk_applied_labels (and the asked
+    intermediates). Returns False if an input is missing
+    """
+    if os.path.exists(get_labels_path(timestamp, "cmsk_applied_labels")):
+        log.info(f"Cloud mask already applied to the labels for {timestamp}")
+        return True
+
+    # get cloud mask for the timestamp, both bands are read at once
+    cloud_mask_file = get_manifest().get(timestamp, timestamp.split('/')[-2], "cd_mask")
+    if cloud_mask_file is None:
+        log.info(f"Missing cloud mask for {timestamp}")
+        return False
+    with rasterio.open(cloud_mask_file) as src:
+        cloud_mask_4, cloud_mask_2 = src.read([1, 2])
+
+    # get labels for the timestamp and merge them (union of the fire pixels)
+    labels = [read_sparse_labels(timestamp, product) for product in ["non_ahi_labels", "updated_ahi_labels"]]
+    labels = [product_labels for product_labels in labels if product_labels is not None]
+    if len(labels) == 0:
+        log.info(f"Missing labels for {timestamp}")
+        return False
+    finalized_labels = labels[0] if len(labels) == 1 else labels[0].union(labels[1])
+
+    # binary cloud mask applied on labels
+    cmsk_applied_labels = finalized_labels.drop(cloud_mask_2 == 1)
+
+    if "finalized_labels" in intermediates:
+        write_sparse_labels(finalized_labels, timestamp, "finalized_labels")
+    if "cmsk4_applied_labels" in intermediates:
+        # in four category cloud mask, we only consider CLOUDY (3) category as the cloud mask
+        write_sparse_labels(finalized_labels.drop(cloud_mask_4 == 3), timestamp, "cmsk4_applied_labels")
+    if "with_nan" in intermediates:
+        write_dense(cmsk_applied_labels, f"data/himawari8/{timestamp}{timestamp.replace('/','_')}_cmsk_applied_labels_with_nan.tif", nan_outside_space=True)
+
+    # written last as it marks the timestamp as done
+    write_sparse_labels(cmsk_applied_labels, timestamp, "cmsk_applied_labels")
+    log.info(f"Finalized the labels for {timestamp}")
+    return True
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--INTERMEDIATES", nargs="*", choices=INTERMEDIATES, default=[], help="Intermediate products to write as well")
+    parser.add_argument("--WORKERS", type=int, default=16, help="No of timestamps processed concurrently")
+    args = parser.parse_args()
+
+    # unique timestamps of the years to process (GEO_DL_YEARS)
+    timestamps = get_timestamps()
+
+    finalized = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.WORKERS) as executor:
+        futures = {executor.submit(process_timestamp, timestamp, args.INTERMEDIATES): timestamp for timestamp in timestamps}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                finalized += future.result()
+            except Exception as e:
+                log.error(f"Error finalizing the labels for {futures[future]}: {e}")
+
+    log.info(f"Finalized labels for {finalized} of {len(timestamps)} timestamps")
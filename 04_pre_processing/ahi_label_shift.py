@@ -0,0 +1,113 @@
+"""
+Alignment of the AHI labels with the B07 band
+
+Every labeled fire (8-connected) is shifted inside its bounding box expanded by two pixels to the offset that
+maximizes the cross-correlation of the labels with B07. The cross-correlation is computed with FFTs and batched over
+features whose expanded boxes have the same shape. Features whose expanded boxes overlap are processed one after the
+other in label order, so the result is the same as shifting the features sequentially on one raster. A NaN in B07
+(disk edge, no data) would turn the whole FFT result into NaN, the boxes with NaN are correlated directly.
+"""
+import numpy as np
+from scipy import fft
+from scipy.signal import correlate2d
+from scipy.ndimage import label, generate_binary_structure, find_objects
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# consider the diagonal pixels as well for label clustering
+STRUCTURE = generate_binary_structure(2,2)
+# no of rows and columns added around the bounding box of a feature (16 neighborhood)
+BOX_PADDING = 2
+
+
+def get_shifts(fldk_slices: np.ndarray, labels_slices: np.ndarray) -> tuple:
+    """
+    Returns the (y, x) shifts of a batch of label slices (n, h, w) onto the fldk slices (n, h, w). Same result as the
+    peak of scipy.signal.correlate2d(fldk_slice, labels_slice) (full mode, first peak in row-major order)
+    """
+    n, height, width = fldk_slices.shape
+    out_shape = (2 * height - 1, 2 * width - 1)
+    fft_shape = [fft.next_fast_len(size, real=True) for size in out_shape]
+
+    # cross-correlation is the convolution with the flipped labels
+    cross_corr = fft.irfftn(
+        fft.rfftn(fldk_slices.astype(np.float64), fft_shape, axes=(1, 2)) * fft.rfftn(labels_slices[:, ::-1, ::-1].astype(np.float64), fft_shape, axes=(1, 2)),
+        fft_shape, axes=(1, 2)
+    )[:, :out_shape[0], :out_shape[1]].reshape(n, -1)
+
+    # values within the FFT round-off of the maximum are ties, the first one wins as with np.argmax on the direct result
+    peak = cross_corr.max(axis=1, keepdims=True)
+    tolerance = 1e-9 * np.maximum(np.abs(cross_corr).max(axis=1, keepdims=True), 1.0)
+    peaks = np.argmax(cross_corr >= peak - tolerance, axis=1)
+
+    # a NaN spreads over the whole FFT result but only over the overlapping positions of the direct one
+    for i in np.flatnonzero(np.isnan(fldk_slices).any(axis=(1, 2))):
+        peaks[i] = np.argmax(correlate2d(fldk_slices[i], labels_slices[i]))
+    y_shift, x_shift = np.unravel_index(peaks, out_shape)
+
+    # relative to the center
+    return y_shift - (height - 1), x_shift - (width - 1)
+
+def calculate_shift(fldk_slice,labels_slice)-> np.array:
+    """
+    Calculate the shift between two arrays using cross-correlation and returns the shifted labels
+    """
+    y_shifts, x_shifts = get_shifts(fldk_slice[None], labels_slice[None])
+    return np.roll(np.roll(labels_slice, y_shifts[0], axis=0), x_shifts[0], axis=1)
+
+def get_feature_boxes(labeled_array: np.ndarray) -> list:
+    """
+    Returns the bounding boxes of all the features expanded by BOX_PADDING, computed with a single find_objects
+    """
+    boxes = []
+    for feature_slices in find_objects(labeled_array):
+        boxes.append((
+            slice(max(0, feature_slices[0].start - BOX_PADDING), min(labeled_array.shape[0], feature_slices[0].stop + BOX_PADDING)),
+            slice(max(0, feature_slices[1].start - BOX_PADDING), min(labeled_array.shape[1], feature_slices[1].stop + BOX_PADDING))
+        ))
+    return boxes
+
+def get_overlap_groups(boxes: list) -> np.ndarray:
+    """
+    Returns the group id of every box, boxes overlapping directly or through other boxes share the group id
+    """
+    bounds = np.array([[box[0].start, box[0].stop, box[1].start, box[1].stop] for box in boxes])
+    overlaps = (
+        (bounds[:, None, 0] < bounds[None, :, 1]) & (bounds[None, :, 0] < bounds[:, None, 1]) &
+        (bounds[:, None, 2] < bounds[None, :, 3]) & (bounds[None, :, 2] < bounds[:, None, 3])
+    )
+    rows, cols = np.nonzero(overlaps)
+    _, groups = connected_components(coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(boxes), len(boxes))), directed=False)
+    return groups
+
+def shift_labels(labels: np.ndarray, fldk: np.ndarray) -> tuple:
+    """
+    Returns the labels with every feature shifted onto fldk (B07) and the no of features
+    """
+    labels = labels.copy()
+    labeled_array, num_features = label(labels, structure=STRUCTURE)
+    if num_features == 0:
+        return labels, 0
+
+    boxes = get_feature_boxes(labeled_array)
+    groups = get_overlap_groups(boxes)
+    group_sizes = np.bincount(groups)
+
+    # features with their own box are independent of each other and batched by box shape
+    batches = {}
+    for feature, box in enumerate(boxes):
+        if group_sizes[groups[feature]] == 1:
+            batches.setdefault((box[0].stop - box[0].start, box[1].stop - box[1].start), []).append(box)
+    for batch_boxes in batches.values():
+        fldk_slices = np.stack([fldk[box] for box in batch_boxes])
+        labels_slices = np.stack([labels[box] for box in batch_boxes])
+        y_shifts, x_shifts = get_shifts(fldk_slices, labels_slices)
+        for box, labels_slice, y_shift, x_shift in zip(batch_boxes, labels_slices, y_shifts, x_shifts):
+            labels[box] = np.roll(np.roll(labels_slice, y_shift, axis=0), x_shift, axis=1)
+
+    # features with overlapping boxes see the shifts of the previous features of their group
+    for feature, box in enumerate(boxes):
+        if group_sizes[groups[feature]] > 1:
+            labels[box] = calculate_shift(fldk[box], labels[box])
+
+    return labels, num_features
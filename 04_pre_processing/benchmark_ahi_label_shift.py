@@ -0,0 +1,239 @@
+"""
+Benchmark and regression check of the AHI label shift (ahi_label_shift.shift_labels)
+
+Synthetic B07 scenes are generated with hot fire blobs of varying size and count, and labels that are offset from the
+blobs by a known shift inside the expanded feature box. Some B07 pixels are NaN (disk edge and no data). Every
+implementation is run on the same scenes and reports throughput (features/s, dates/s), shift recovery accuracy and
+the no of features that np.roll wraps around the edge of their box.
+
+    python 04_pre_processing/benchmark_ahi_label_shift.py --SAVE_BASELINE data/benchmarks/ahi_label_shift.json
+    python 04_pre_processing/benchmark_ahi_label_shift.py --CHECK data/benchmarks/ahi_label_shift.json
+
+A baseline stores the metrics and a hash of the output of every scene, --CHECK exits with 1 if the outputs of an
+implementation differ from the baseline on more scenes than allowed or if its accuracy dropped. The script exits with
+1 as well if fft and direct differ on more scenes than allowed.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from scipy.ndimage import label, find_objects
+from scipy.signal import correlate2d
+from ahi_label_shift import STRUCTURE, BOX_PADDING, shift_labels, get_feature_boxes, get_overlap_groups, get_shifts
+
+
+def calculate_shift_direct(fldk_slice,labels_slice)-> np.array:
+    """
+    Former implementation of calculate_shift with the direct cross-correlation
+    """
+    cross_corr = correlate2d(fldk_slice, labels_slice)
+    y_shift, x_shift = np.unravel_index(np.argmax(cross_corr), cross_corr.shape)
+    y_shift -= fldk_slice.shape[0] - 1
+    x_shift -= fldk_slice.shape[1] - 1
+    return np.roll(np.roll(labels_slice, y_shift, axis=0), x_shift, axis=1)
+
+def shift_labels_direct(labels: np.ndarray, fldk: np.ndarray) -> tuple:
+    """
+    Former feature loop of 002_apply_shift_ahi_labels.py, the reference for the regression check
+    """
+    labels = labels.copy()
+    labeled_array, num_features = label(labels, structure=STRUCTURE)
+    for feature in range(1,num_features+1):
+        labeled_feature_indices = find_objects(labeled_array == feature)[0]
+        expanded_indices = (
+            slice(max(0, labeled_feature_indices[0].start - BOX_PADDING), min(labeled_array.shape[0], labeled_feature_indices[0].stop + BOX_PADDING)),
+            slice(max(0, labeled_feature_indices[1].start - BOX_PADDING), min(labeled_array.shape[1], labeled_feature_indices[1].stop + BOX_PADDING))
+        )
+        labels[expanded_indices] = calculate_shift_direct(fldk[expanded_indices],labels[expanded_indices])
+    return labels, num_features
+
+IMPLEMENTATIONS = {
+    "direct": shift_labels_direct,
+    "fft": shift_labels,
+}
+
+
+def generate_scene(rng: np.random.Generator, size: int, no_of_features: int, max_radius: int, max_offset: int, nan_fraction: float = 0.0, clustered_fraction: float = 0.0) -> tuple:
+    """
+    Returns (B07, labels, true labels) of a synthetic scene. The true labels are blobs that are hotter than the
+    background in B07, the labels are the same blobs moved by a random offset of at most max_offset pixels.
+    nan_fraction of the B07 pixels are NaN, half in a strip along the left edge (disk edge) and half scattered (no data).
+    clustered_fraction of the blobs are placed next to a previous blob, so that their expanded boxes overlap or the
+    blobs touch (the features of overlapping boxes are shifted one after the other)
+    """
+    fldk = rng.normal(295.0, 2.0, (size, size)).astype(np.float32)
+    truth = np.zeros((size, size), dtype=np.uint8)
+    labels = np.zeros((size, size), dtype=np.uint8)
+    margin = max_radius + max_offset + BOX_PADDING + 1
+    # the other blobs are kept apart so that their expanded boxes do not overlap
+    min_distance = 2 * (max_radius + max_offset + BOX_PADDING) + 2
+
+    centers = []
+    for _ in range(no_of_features * 20):
+        if len(centers) == no_of_features:
+            break
+        if centers and rng.random() < clustered_fraction:
+            center = centers[rng.integers(len(centers))] + rng.integers(-2 * BOX_PADDING, 2 * BOX_PADDING + 1, 2)
+            centers.append(np.clip(center, margin, size - margin - 1))
+            continue
+        center = rng.integers(margin, size - margin, 2)
+        if all(np.abs(center - other).max() >= min_distance for other in centers):
+            centers.append(center)
+
+    rows, cols = np.ogrid[:size, :size]
+    for center in centers:
+        radius_y, radius_x = rng.integers(0, max_radius + 1, 2)
+        blob = ((rows - center[0]) / (radius_y + 0.5)) ** 2 + ((cols - center[1]) / (radius_x + 0.5)) ** 2 <= 1
+        truth[blob] = 1
+        fldk[blob] += rng.uniform(10.0, 40.0)
+        offset_y, offset_x = rng.integers(-max_offset, max_offset + 1, 2)
+        labels[np.roll(np.roll(blob, offset_y, axis=0), offset_x, axis=1)] = 1
+
+    if nan_fraction > 0:
+        fldk[:, :max(1, int(size * nan_fraction / 2))] = np.nan
+        no_of_pixels = int(size * size * nan_fraction / 2)
+        fldk[rng.integers(0, size, no_of_pixels), rng.integers(0, size, no_of_pixels)] = np.nan
+    return fldk, labels, truth
+
+def count_overlapping(labels: np.ndarray) -> int:
+    """
+    Returns the no of features whose expanded box overlaps the box of another feature
+    """
+    labeled_array, num_features = label(labels, structure=STRUCTURE)
+    if num_features == 0:
+        return 0
+    groups = get_overlap_groups(get_feature_boxes(labeled_array))
+    return int(np.count_nonzero(np.bincount(groups)[groups] > 1))
+
+def count_wraparounds(labels: np.ndarray, fldk: np.ndarray) -> int:
+    """
+    Returns the no of features whose shift moves label pixels past the edge of their box, np.roll puts those pixels
+    back on the opposite side of the box
+    """
+    labeled_array, _ = label(labels, structure=STRUCTURE)
+    wraparounds = 0
+    for box in get_feature_boxes(labeled_array):
+        y_shifts, x_shifts = get_shifts(fldk[box][None], labels[box][None])
+        rows, cols = np.nonzero(labels[box])
+        height, width = labels[box].shape
+        if ((rows + y_shifts[0] < 0) | (rows + y_shifts[0] >= height) | (cols + x_shifts[0] < 0) | (cols + x_shifts[0] >= width)).any():
+            wraparounds += 1
+    return wraparounds
+
+def get_accuracy(output: np.ndarray, truth: np.ndarray) -> tuple:
+    """
+    Returns (no of true blobs recovered exactly, no of true blobs, pixel IoU)
+    """
+    labeled_truth, num_blobs = label(truth, structure=STRUCTURE)
+    recovered = 0
+    for box in find_objects(labeled_truth):
+        region = (
+            slice(max(0, box[0].start - BOX_PADDING * 2), box[0].stop + BOX_PADDING * 2),
+            slice(max(0, box[1].start - BOX_PADDING * 2), box[1].stop + BOX_PADDING * 2)
+        )
+        recovered += int(np.array_equal(output[region], truth[region]))
+    union = np.count_nonzero(output | truth)
+    iou = np.count_nonzero(output & truth) / union if union else 1.0
+    return recovered, num_blobs, iou
+
+def get_hash(array: np.ndarray) -> str:
+    return hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest()[:16]
+
+def run(scenes: list, implementation) -> dict:
+    """
+    Runs the implementation on all the scenes and returns its metrics and the hashes of its outputs
+    """
+    outputs = []
+    no_of_features = 0
+    start = time.perf_counter()
+    for fldk, labels, _ in scenes:
+        output, num_features = implementation(labels, fldk)
+        outputs.append(output)
+        no_of_features += num_features
+    seconds = time.perf_counter() - start
+
+    recovered, num_blobs, ious = 0, 0, []
+    for output, (_, _, truth) in zip(outputs, scenes):
+        scene_recovered, scene_blobs, iou = get_accuracy(output, truth)
+        recovered += scene_recovered
+        num_blobs += scene_blobs
+        ious.append(iou)
+    return {
+        "seconds": seconds,
+        "features": no_of_features,
+        "features_per_second": no_of_features / seconds,
+        "dates_per_second": len(scenes) / seconds,
+        "recovered_fraction": recovered / max(num_blobs, 1),
+        "mean_iou": float(np.mean(ious)),
+        "hashes": [get_hash(output) for output in outputs],
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--SCENES", type=int, default=20, help="No of synthetic dates")
+    parser.add_argument("--SIZE", type=int, default=512, help="Height and width of the synthetic scenes")
+    parser.add_argument("--MIN_FEATURES", type=int, default=10, help="Minimum no of fires per scene")
+    parser.add_argument("--MAX_FEATURES", type=int, default=300, help="Maximum no of fires per scene")
+    parser.add_argument("--MAX_RADIUS", type=int, default=4, help="Maximum radius of a fire blob in pixels")
+    parser.add_argument("--MAX_OFFSET", type=int, default=BOX_PADDING, help="Maximum offset of the labels from the blobs in pixels")
+    parser.add_argument("--CLUSTERED_FRACTION", type=float, default=0.2, help="Fraction of the fires placed next to another fire so that their boxes overlap")
+    parser.add_argument("--NAN_FRACTION", type=float, default=0.01, help="Fraction of NaN B07 pixels (disk edge strip and scattered no data)")
+    parser.add_argument("--SEED", type=int, default=0, help="Seed of the synthetic scenes")
+    parser.add_argument("--IMPLEMENTATIONS", nargs="+", choices=list(IMPLEMENTATIONS), default=list(IMPLEMENTATIONS))
+    parser.add_argument("--SAVE_BASELINE", type=str, default=None, help="Write the results as baseline to this json file")
+    parser.add_argument("--CHECK", type=str, default=None, help="Compare the outputs with the baseline of this json file")
+    parser.add_argument("--MAX_CHANGED_SCENES", type=int, default=0, help="No of scenes whose output may differ from the baseline")
+    parser.add_argument("--ACCURACY_TOLERANCE", type=float, default=0.0, help="Allowed drop of the recovered fraction")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.SEED)
+    scenes = [
+        generate_scene(rng, args.SIZE, int(rng.integers(args.MIN_FEATURES, args.MAX_FEATURES + 1)), args.MAX_RADIUS, args.MAX_OFFSET, args.NAN_FRACTION, args.CLUSTERED_FRACTION)
+        for _ in range(args.SCENES)
+    ]
+    wraparounds = sum(count_wraparounds(labels, fldk) for fldk, labels, _ in scenes)
+    overlapping = sum(count_overlapping(labels) for _, labels, _ in scenes)
+    print(f"{len(scenes)} scenes of {args.SIZE}x{args.SIZE}, {wraparounds} features wrapped around their box by np.roll, {overlapping} features with overlapping boxes")
+
+    results = {}
+    for name in args.IMPLEMENTATIONS:
+        results[name] = run(scenes, IMPLEMENTATIONS[name])
+        result = results[name]
+        print(
+            f"{name:>8}: {result['seconds']:8.2f}s {result['features_per_second']:10.1f} features/s {result['dates_per_second']:8.2f} dates/s "
+            f"recovered {result['recovered_fraction']:.3f} mean IoU {result['mean_iou']:.3f}"
+        )
+    # fft has to give the same output as direct, also for the overlapping boxes and the NaN pixels
+    failed = False
+    if "direct" in results and "fft" in results:
+        changed = sum(a != b for a, b in zip(results["direct"]["hashes"], results["fft"]["hashes"]))
+        print(f"fft output differs from direct output on {changed} of {len(scenes)} scenes")
+        failed = changed > args.MAX_CHANGED_SCENES
+
+    if args.SAVE_BASELINE is not None:
+        os.makedirs(os.path.dirname(args.SAVE_BASELINE) or ".", exist_ok=True)
+        with open(args.SAVE_BASELINE, "w") as f:
+            json.dump({"args": {key: value for key, value in vars(args).items() if key not in ["SAVE_BASELINE", "CHECK"]}, "wraparounds": wraparounds, "results": results}, f, indent=2)
+        print(f"Saved baseline to {args.SAVE_BASELINE}")
+
+    if args.CHECK is not None:
+        with open(args.CHECK) as f:
+            baseline = json.load(f)
+        if any(baseline["args"].get(key) != getattr(args, key) for key in ["SCENES", "SIZE", "MIN_FEATURES", "MAX_FEATURES", "MAX_RADIUS", "MAX_OFFSET", "NAN_FRACTION", "CLUSTERED_FRACTION", "SEED"]):
+            sys.exit("The scenes of the baseline were generated with other arguments")
+        # every implementation is compared with the first implementation of the baseline (the reference output)
+        reference_name = next(iter(baseline["results"]))
+        reference = baseline["results"][reference_name]
+        for name, result in results.items():
+            changed = sum(a != b for a, b in zip(reference["hashes"], result["hashes"]))
+            accuracy_drop = reference["recovered_fraction"] - result["recovered_fraction"]
+            speedup = reference["seconds"] / result["seconds"]
+            print(f"{name:>8}: {changed} scenes differ from {reference_name}, accuracy drop {accuracy_drop:.3f}, {speedup:.1f}x the baseline speed")
+            if changed > args.MAX_CHANGED_SCENES or accuracy_drop > args.ACCURACY_TOLERANCE:
+                failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,78 @@
+"""
+Regression check of the windowed rasterization of the fire labels (label_rasterization.py)
+
+Random fire points and small polygons are placed close to the pixel edges (and the edges of the grid) of the empty
+AOI raster. The windowed rasterization of 001_reproject_rasterize_labels.py is compared with the rasterization of the
+whole grid on every case.
+
+    python 04_pre_processing/check_label_rasterization.py --CASES 1000
+
+The script exits with 1 if any case differs.
+"""
+import sys
+import time
+import argparse
+import rasterio
+import numpy as np
+from rasterio.errors import WindowError
+from shapely.geometry import Point, box
+from label_rasterization import get_labels_window, rasterize_geometries
+
+EMPTY_RASTER_PATH = "data/himawari8/empty_mask_h8_aoi_updated.tif"
+# fractions of a pixel close to its edges
+FRACTIONS = np.array([0.001, 0.1, 0.5, 0.9, 0.999])
+
+
+def generate_case(rng: np.random.Generator, meta: dict) -> list:
+    """
+    Returns 1 to 5 random points and boxes (0.1 to 3 pixels wide) close to the pixel edges, some outside of the grid
+    """
+    transform = meta["transform"]
+    geometries = []
+    for _ in range(rng.integers(1, 6)):
+        col = rng.integers(-2, meta["width"] + 2) + rng.choice(FRACTIONS)
+        row = rng.integers(-2, meta["height"] + 2) + rng.choice(FRACTIONS)
+        x, y = transform * (col, row)
+        if rng.random() < 0.5:
+            geometries.append(Point(x, y))
+        else:
+            size = rng.uniform(0.1, 3.0) * abs(transform.a)
+            geometries.append(box(x, y - size, x + size, y))
+    return geometries
+
+def compare(geometries: list, meta: dict) -> tuple:
+    """
+    Returns the (missing, extra) pixels of the windowed rasterization compared to the rasterization of the whole grid
+    """
+    full = set(zip(*rasterize_geometries(geometries, meta)))
+    try:
+        windowed = set(zip(*rasterize_geometries(geometries, meta, get_labels_window(geometries, meta))))
+    except WindowError:
+        # all the geometries are outside of the grid
+        windowed = set()
+    return full - windowed, windowed - full
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--CASES", type=int, default=1000, help="No of random cases")
+    parser.add_argument("--SEED", type=int, default=0, help="Seed of the random cases")
+    parser.add_argument("--RASTER", type=str, default=EMPTY_RASTER_PATH, help="Raster of the grid (the empty AOI raster of 001_reproject_rasterize_labels.py)")
+    args = parser.parse_args()
+
+    with rasterio.open(args.RASTER) as src:
+        meta = src.meta.copy()
+
+    rng = np.random.default_rng(args.SEED)
+    failed = 0
+    start = time.perf_counter()
+    for case in range(args.CASES):
+        geometries = generate_case(rng, meta)
+        missing, extra = compare(geometries, meta)
+        if missing or extra:
+            failed += 1
+            print(f"Case {case}: {len(missing)} pixels missing and {len(extra)} extra in the window of {[geometry.wkt for geometry in geometries]}")
+
+    print(f"Windowed rasterization differs from the full rasterization in {failed} of {args.CASES} cases ({time.perf_counter() - start:.1f}s)")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,44 @@
+"""
+Windowed rasterization of the fire labels on the AOI grid
+
+The geometries of a date are rasterized inside the window of the grid covering their bounds (padded by one pixel)
+instead of the whole grid, the fire pixels are the same as with the rasterization of the whole grid.
+"""
+import math
+import numpy as np
+import geopandas as gpd
+from rasterio.features import rasterize
+from rasterio.windows import Window, from_bounds, transform as window_transform
+
+
+def get_labels_window(geometries, meta: dict) -> Window:
+    """
+    Returns the window of the grid (meta of the AOI raster) covering the bounds of the geometries (padded by one
+    pixel). Raises WindowError if the geometries are outside of the grid
+    """
+    bounds = gpd.GeoSeries(geometries).total_bounds
+    window = from_bounds(*bounds, transform=meta["transform"])
+    # first and last pixel of the bounds, the start is rounded down and the end up (rounding the offsets and lengths
+    # separately can end the window before the pixel of the max bound)
+    col_start, row_start = math.floor(window.col_off), math.floor(window.row_off)
+    col_end, row_end = math.ceil(window.col_off + window.width), math.ceil(window.row_off + window.height)
+    window = Window(col_start - 1, row_start - 1, col_end - col_start + 2, row_end - row_start + 2)
+    return window.intersection(Window(0, 0, meta["width"], meta["height"]))
+
+def rasterize_geometries(geometries, meta: dict, window: Window = None) -> tuple:
+    """
+    Returns the (rows, cols) of the fire pixels of the geometries on the grid, rasterized inside the window (the
+    whole grid if None)
+    """
+    if window is None:
+        window = Window(0, 0, meta["width"], meta["height"])
+    rasterized = rasterize(
+        shapes=geometries,
+        out_shape=(int(window.height), int(window.width)),
+        fill=0,
+        transform=window_transform(window, meta["transform"]),
+        default_value=1,
+        dtype=np.uint8
+    )
+    rows, cols = np.nonzero(rasterized)
+    return rows + int(window.row_off), cols + int(window.col_off)
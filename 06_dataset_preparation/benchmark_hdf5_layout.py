@@ -0,0 +1,151 @@
+"""
+Benchmark of the chunk layout and compression profiles (hdf5_layout.py) of the dynamic feature HDF5 files
+
+Synthetic timestamps of RASTER_WINDOWS samples (smooth brightness temperature fields with noise for the AHI bands,
+sparse fire and cloud masks) are written with DynamicHDF5Writer once per profile. Every profile reports the file size,
+the write time and the read time of the access patterns of typical training loaders:
+
+    random batch   batches of random samples (ahi_data, cloud_mask_binary, labels_data and the scalars)
+    band subset    random samples of only --BANDS of ahi_data
+    scalars        full columns of the per sample scalars (ex: filtering the samples by fire or cloud fraction)
+
+    python 06_dataset_preparation/benchmark_hdf5_layout.py --TIMESTAMPS 20 --OUTPUT data/benchmarks/hdf5_layout.json
+
+The read times are measured on a freshly opened file but with a warm page cache. The zstd profiles are only
+benchmarked if hdf5plugin is installed.
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import h5py
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from hdf5_layout import PROFILES, is_profile_available
+from dynamic_hdf5_writer import DATASETS, DynamicHDF5Writer, allocate_samples
+from raster_windows import RASTER_WINDOWS
+
+SCALARS = [name for name, (_, _, _, kind, _) in DATASETS.items() if kind == "scalar" and name != "timestamps_str"]
+
+
+def generate_timestamp(rng: np.random.Generator, no_of_samples: int, timestamp_index: int) -> dict:
+    """
+    Returns name -> array of the no_of_samples synthetic samples of a timestamp
+    """
+    samples = allocate_samples(no_of_samples)
+    shape = samples["ahi_data"].shape
+    # spatially correlated fields like the AHI bands, compressors do much better on those than on white noise
+    field = gaussian_filter(rng.normal(0.0, 1.0, shape[:-2] + (shape[-2] // 8, shape[-1] // 8)), sigma=(0, 0, 0, 1, 1))
+    field = np.repeat(np.repeat(field, 8, axis=-2), 8, axis=-1)
+    samples["ahi_data"][:] = 290.0 + 10.0 * field + rng.normal(0.0, 0.5, shape)
+
+    clouds = gaussian_filter(rng.normal(0.0, 1.0, samples["cloud_mask_binary"].shape), sigma=(0, 8, 8)) > 0.05
+    samples["cloud_mask_binary"][:] = clouds
+    samples["labels_data"][:] = rng.random(samples["labels_data"].shape) < 0.001
+
+    samples["timestamps_str"][:] = f"2022/01/01/{timestamp_index:04d}/".encode()
+    samples["ahi_stat_p"][:] = rng.normal(0.0, 1.0, samples["ahi_stat_p"].shape)
+    samples["ahi_stat_p_c"][:] = rng.normal(0.0, 1.0, samples["ahi_stat_p_c"].shape)
+    samples["fire_fraction"][:] = samples["labels_data"].mean(axis=(1, 2))[:, None]
+    samples["cloud_fraction"][:] = samples["cloud_mask_binary"].mean(axis=(1, 2))[:, None]
+    samples["raster_window_id"][:] = np.arange(no_of_samples)[:, None]
+    return samples
+
+def write(directory: str, profile: str, timestamps: list) -> tuple:
+    """
+    Writes the timestamps to one file with the profile. Returns (path, seconds)
+    """
+    start = time.perf_counter()
+    with DynamicHDF5Writer(directory, profile, profile=profile) as writer:
+        for samples in timestamps:
+            no_of_samples = len(samples["ahi_data"])
+            base = writer.begin(no_of_samples)
+            writer.write(list(range(base, base + no_of_samples)), samples)
+            writer.end()
+    return writer.paths[0], time.perf_counter() - start
+
+def read_random_batches(path: str, rng: np.random.Generator, no_of_batches: int, batch_size: int) -> float:
+    start = time.perf_counter()
+    with h5py.File(path, "r") as f:
+        no_of_samples = len(f["labels/labels_data"])
+        for _ in range(no_of_batches):
+            # h5py needs increasing indices
+            indices = np.sort(rng.choice(no_of_samples, batch_size, replace=False))
+            f["input_features/ahi_data"][indices]
+            f["input_features/cloud_mask_binary"][indices]
+            f["labels/labels_data"][indices]
+            for name in SCALARS:
+                f[f"input_features/{name}"][indices]
+    return time.perf_counter() - start
+
+def read_band_subset(path: str, rng: np.random.Generator, no_of_samples: int, bands: list) -> float:
+    start = time.perf_counter()
+    with h5py.File(path, "r") as f:
+        ahi_data = f["input_features/ahi_data"]
+        for index in rng.choice(len(ahi_data), no_of_samples, replace=False):
+            ahi_data[index, :, bands]
+    return time.perf_counter() - start
+
+def read_scalars(path: str) -> float:
+    start = time.perf_counter()
+    with h5py.File(path, "r") as f:
+        for name in SCALARS:
+            f[f"input_features/{name}"][:]
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--TIMESTAMPS", type=int, default=10, help=f"No of synthetic timestamps of {len(RASTER_WINDOWS)} samples")
+    parser.add_argument("--PROFILES", nargs="+", choices=list(PROFILES), default=[profile for profile in PROFILES if is_profile_available(profile)])
+    parser.add_argument("--BATCHES", type=int, default=20, help="No of random batches read")
+    parser.add_argument("--BATCH_SIZE", type=int, default=32, help="No of samples of a random batch")
+    parser.add_argument("--BANDS", type=int, nargs="+", default=[2, 5], help="Bands of ahi_data read by the band subset reads")
+    parser.add_argument("--BAND_SAMPLES", type=int, default=200, help="No of random samples of the band subset reads")
+    parser.add_argument("--SEED", type=int, default=0, help="Seed of the synthetic samples and of the read indices")
+    parser.add_argument("--DIRECTORY", type=str, default=None, help="Directory of the benchmark files, a temporary one by default")
+    parser.add_argument("--OUTPUT", type=str, default=None, help="Write the results to this json file")
+    args = parser.parse_args()
+    unavailable = [profile for profile in args.PROFILES if not is_profile_available(profile)]
+    if unavailable:
+        parser.error(f"Profiles {unavailable} use zstd and need hdf5plugin")
+
+    rng = np.random.default_rng(args.SEED)
+    timestamps = [generate_timestamp(rng, len(RASTER_WINDOWS), index) for index in range(args.TIMESTAMPS)]
+    no_of_samples = args.TIMESTAMPS * len(RASTER_WINDOWS)
+    raw_bytes = sum(array.nbytes for samples in timestamps for array in samples.values())
+    print(f"{no_of_samples} samples, {raw_bytes / 1024**2:.0f} MB uncompressed")
+
+    directory = args.DIRECTORY or tempfile.mkdtemp(prefix="hdf5_layout_")
+    results = {}
+    try:
+        for profile in args.PROFILES:
+            path, write_seconds = write(directory, profile, timestamps)
+            # same read indices for every profile
+            read_rng = np.random.default_rng(args.SEED)
+            results[profile] = {
+                "file_mb": os.path.getsize(path) / 1024**2,
+                "compression_ratio": raw_bytes / os.path.getsize(path),
+                "write_seconds": write_seconds,
+                "random_batch_seconds": read_random_batches(path, read_rng, args.BATCHES, args.BATCH_SIZE),
+                "band_subset_seconds": read_band_subset(path, read_rng, args.BAND_SAMPLES, args.BANDS),
+                "scalars_seconds": read_scalars(path),
+            }
+            result = results[profile]
+            print(
+                f"{profile:>12}: {result['file_mb']:8.1f} MB ({result['compression_ratio']:.2f}x) write {result['write_seconds']:7.2f}s "
+                f"random batches {result['random_batch_seconds']:6.2f}s band subset {result['band_subset_seconds']:6.2f}s scalars {result['scalars_seconds']:6.3f}s"
+            )
+            os.remove(path)
+    finally:
+        if args.DIRECTORY is None:
+            shutil.rmtree(directory)
+
+    if args.OUTPUT is not None:
+        os.makedirs(os.path.dirname(args.OUTPUT) or ".", exist_ok=True)
+        with open(args.OUTPUT, "w") as f:
+            json.dump({"args": {key: value for key, value in vars(args).items() if key not in ["DIRECTORY", "OUTPUT"]}, "results": results}, f, indent=2)
+        print(f"Saved results to {args.OUTPUT}")
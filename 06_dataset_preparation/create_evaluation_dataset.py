@@ -4,7 +4,6 @@ import numpy as np
 import pathlib
 import os
 import json
-import glob
 import shutil
 import h5py
 import rasterio
@@ -12,8 +11,12 @@ import rasterio.mask
 from datetime import datetime
 from shapely.geometry import shape, MultiPolygon
 from rasterio.features import rasterize, geometry_mask
-from utils import get_h8_proj4_string, get_2022_timestamps
+from utils import get_h8_proj4_string, get_timestamps
 from utils import create_empty_h8_mask
+from sparse_labels import read_sparse_labels
+from manifest import get_manifest
+from raster_windows import RASTER_WINDOWS
+from hdf5_layout import get_dataset_options
 import logging as log
 WORKDIR = os.getcwd()
 log_file = f"{WORKDIR}/06_dataset_preparation/create_evaluation_dataset.txt"  # Path to the log file
@@ -30,7 +33,6 @@ log.basicConfig(
 def create_input_ahi_cmsk_h8_fp_data(window, fire: gpd.GeoDataFrame):
     # create the input_ahi_data for the fire using the timestamps
     # Convert start and end date strings to datetime objects
-    base_dir = "data/himawari8/"
     start_date_obj = datetime.strptime(fire["ignition_date"], "%Y/%m/%d/%H%M/")
     end_date_obj = datetime.strptime(fire["extinguish_date"], "%Y/%m/%d/%H%M/")
 
@@ -42,31 +44,31 @@ def create_input_ahi_cmsk_h8_fp_data(window, fire: gpd.GeoDataFrame):
     h8_fire_product_data = np.zeros((len(available_dates), 256, 256),  dtype=np.int8)
 
     # now iterat through the available dates and create the ahi_data, cmsk_data, and h8_fire_product_data for the window
+    raster_window = rasterio.windows.Window(window[1], window[0], 256, 256)
     for i, date in enumerate(available_dates):
         # read the ahi data
-        stacked_masked = glob.glob(f"{base_dir}{date}{date.split('/')[-2]}/*_stacked_masked.tif")
-        if len(stacked_masked) == 0 or len(stacked_masked) > 1:
+        stacked_masked = MANIFEST.get(date, date.split('/')[-2], "stacked_masked")
+        if stacked_masked is None:
             # raise an error
             raise ValueError(f"Error reading stacked_masked for date {date}")
-        stacked_masked_file = rasterio.open(stacked_masked[0])
-        ahi_data[i] = stacked_masked_file.read(window=rasterio.windows.Window(window[1], window[0], 256, 256))
+        with rasterio.open(stacked_masked) as stacked_masked_file:
+            stacked_masked_file.read(window=raster_window, out=ahi_data[i])
 
         # read the cmsk data
-        cmsk_binary = glob.glob(f"{base_dir}{date}{date.split('/')[-2]}/cd_mask_*.tif")
-        if len(cmsk_binary) == 0 or len(cmsk_binary) > 1:
+        cmsk_binary = MANIFEST.get(date, date.split('/')[-2], "cd_mask")
+        if cmsk_binary is None:
             # raise an error
             raise ValueError(f"Error reading cd_mask for date {date}")
-        cmsk_binary_file = rasterio.open(cmsk_binary[0])
-        cloud_mask_binary[i] = cmsk_binary_file.read(2, window=rasterio.windows.Window(window[1], window[0], 256, 256))
+        with rasterio.open(cmsk_binary) as cmsk_binary_file:
+            cloud_mask_binary[i] = cmsk_binary_file.read(2, window=raster_window)
 
         # read the h8 fire product data
-        h8_fire_product = glob.glob(f"{base_dir}{date}/*_{date.split('/')[-2]}_ahi_labels.tif")
-        if len(h8_fire_product) == 0:
+        h8_fire_product = read_sparse_labels(date, "ahi_labels")
+        if h8_fire_product is None:
             # np ahi labels for this date hence fill the window with zeros
             h8_fire_product_data[i] = np.zeros((256, 256), dtype=np.int8)
         else:
-            h8_fire_product_file = rasterio.open(h8_fire_product[0])
-            h8_fire_product_data[i] = h8_fire_product_file.read(1, window=rasterio.windows.Window(window[1], window[0], 256, 256))
+            h8_fire_product_data[i] = h8_fire_product.to_dense(window=raster_window)
 
     return ahi_data, cloud_mask_binary, h8_fire_product_data, available_dates
     
@@ -212,20 +214,25 @@ def create_h5py(bushfire_gdf: gpd.GeoDataFrame, h5py_path: str):
             
             # break
 
-        # concatenate all the lists and create the datasets
-        f.create_dataset("fire_id", data=np.concatenate(fire_id_lists, axis=0), chunks=(1,1), compression="lzf")
-        f.create_dataset("raster_window_id", data=np.concatenate(raster_window_id_lists, axis=0), chunks=(1,1), compression="lzf")
-        f.create_dataset("fire_type", data=np.concatenate(fire_type_lists, axis=0), chunks=(1,1), compression="lzf")
-        f.create_dataset("ignition_date", data=np.concatenate(ignition_date_lists, axis=0), chunks=(1,1), compression="lzf")
-        f.create_dataset("extinguish_date", data=np.concatenate(extinguish_date_lists, axis=0), chunks=(1,1), compression="lzf")
-        f.create_dataset("area_ha", data=np.concatenate(area_ha_lists, axis=0), chunks=(1,1), compression="lzf")
-        f.create_dataset("fire_life", data=np.concatenate(fire_life_lists, axis=0), chunks=(1,1), compression="lzf")
-        f.create_dataset("bushfire_label_data", data=np.concatenate(bushfire_label_data_lists, axis=0), chunks=(1,256,256), compression="lzf")
-        f.create_dataset("ahi_data", data=np.concatenate(ahi_data_lists, axis=0), chunks=(1,6,256,256), compression="lzf")
-        f.create_dataset("cloud_mask_binary", data=np.concatenate(cloud_mask_binary_lists, axis=0), chunks=(1,256,256), compression="lzf")
-        f.create_dataset("h8_fire_product_data", data=np.concatenate(h8_fire_product_data_lists, axis=0), chunks=(1,256,256), compression="lzf")
-        f.create_dataset("timestamps", data=np.concatenate(timestamps_lists, axis=0), chunks=(1,1), compression="lzf")
-        f.create_dataset("timestamps_index", data=np.concatenate(timestamps_index_lists, axis=0), chunks=(1,1), compression="lzf")
+        # concatenate all the lists and create the datasets, chunked and compressed by the layout profile (kind of dataset)
+        datasets = {
+            "fire_id": (fire_id_lists, "scalar"),
+            "raster_window_id": (raster_window_id_lists, "scalar"),
+            "fire_type": (fire_type_lists, "scalar"),
+            "ignition_date": (ignition_date_lists, "scalar"),
+            "extinguish_date": (extinguish_date_lists, "scalar"),
+            "area_ha": (area_ha_lists, "scalar"),
+            "fire_life": (fire_life_lists, "scalar"),
+            "bushfire_label_data": (bushfire_label_data_lists, "mask"),
+            "ahi_data": (ahi_data_lists, "bands"),
+            "cloud_mask_binary": (cloud_mask_binary_lists, "mask"),
+            "h8_fire_product_data": (h8_fire_product_data_lists, "mask"),
+            "timestamps": (timestamps_lists, "scalar"),
+            "timestamps_index": (timestamps_index_lists, "scalar"),
+        }
+        for name, (data_lists, kind) in datasets.items():
+            dataset = np.concatenate(data_lists, axis=0)
+            f.create_dataset(name, data=dataset, **get_dataset_options(kind, dataset.shape[1:], dataset.dtype, LAYOUT_PROFILE, no_of_samples=len(dataset)))
 
 
 if __name__ == '__main__':
@@ -245,13 +252,16 @@ if __name__ == '__main__':
     TRANSFORM = EMPTY_RASTER.transform
     CRS = EMPTY_RASTER.crs
 
-    RASTER_WINDOWS = [(1024, 256), (1280, 256), (1536, 256), (1792, 256), (2048, 256), (2304, 256), (2560, 256), (512, 512), (768, 512), (1024, 512), (1536, 512), (1792, 512), (2048, 512), (2304, 512), (2560, 512), (3072, 512), (3328, 512), (3584, 512), (256, 768), (512, 768), (768, 768), (1024, 768), (1280, 768), (1536, 768), (1792, 768), (2048, 768), (2304, 768), (2560, 768), (3072, 768), (3328, 768), (3584, 768), (3840, 768), (256, 1024), (512, 1024), (768, 1024), (1024, 1024), (1280, 1024), (1536, 1024), (1792, 1024), (2048, 1024), (2304, 1024), (2560, 1024), (2816, 1024), (3072, 1024), (3328, 1024), (3584, 1024), (3840, 1024), (256, 1280), (512, 1280), (768, 1280), (2048, 1280), (2304, 1280), (2560, 1280), (2816, 1280), (3072, 1280), (3328, 1280), (3584, 1280), (3840, 1280), (256, 1536), (512, 1536), (1792, 1536), (2048, 1536), (2304, 1536), (2560, 1536), (2816, 1536), (3072, 1536), (3328, 1536), (3584, 1536), (3840, 1536), (256, 1792), (512, 1792), (1536, 1792), (2048, 1792), (2304, 1792), (2560, 1792), (2816, 1792), (3072, 1792), (3328, 1792), (3584, 1792), (3840, 1792), (4096, 1792), (1280, 2048), (2048, 2048), (2304, 2048), (2560, 2048), (2816, 2048), (3072, 2048), (3328, 2048), (3584, 2048), (3840, 2048), (4096, 2048), (2048, 2304), (2304, 2304), (2560, 2304), (3072, 2304), (3328, 2304), (3584, 2304), (3840, 2304), (4352, 2304), (2304, 2560), (2560, 2560), (2816, 2560), (3328, 2560), (3584, 2560), (1792, 2816), (2560, 2816), (2816, 2816)]
 
     # delete the .h5 file
     if os.path.exists(EVALUATION_H5PY_PATH):
         os.remove(EVALUATION_H5PY_PATH)
 
-    TIMESTAMPS_2022 = get_2022_timestamps()
+    # chunk layout and compression profile of the datasets (see hdf5_layout.py)
+    LAYOUT_PROFILE = "balanced"
+
+    TIMESTAMPS_2022 = get_timestamps()
+    MANIFEST = get_manifest()
 
     # convert the ignition_date,  extinguish_datecolumn to datetime
     data["ignition_date"] = pd.to_datetime(data["ignition_date"], format="ISO8601")
@@ -1,12 +1,20 @@
 from datetime import datetime, timedelta
-import glob
 import rasterio
 import numpy as np
-import h5py
-import json
 import logging as log
 import warnings
 import os
+import re
+import sys
+import argparse
+import contextlib
+import concurrent.futures
+from sparse_labels import read_sparse_labels
+from manifest import get_manifest
+from utils import get_timestamps
+from raster_windows import RASTER_WINDOWS, WindowExtractor
+from dynamic_hdf5_writer import DynamicHDF5Writer, BufferedWriter, get_sample_nbytes, get_shard_path, get_shard_plan, write_shard_checksum, is_shard_complete, write_virtual_index
+from hdf5_layout import PROFILES, DEFAULT_PROFILE, is_profile_available
 
 WORKDIR = os.getcwd()
 log_file = f"{WORKDIR}/06_dataset_preparation/create_testing_dynamic_features_hdf5_files.txt"  # Path to the log file
@@ -38,188 +46,180 @@ def get_child_timestamps(timestamp_str:str) -> list[str]:
     return sorted(intervals)
 
 
-def write_to_hdf5(timestamp_batch, sample_size):
-
-    no_of_samples= sample_size
-    no_of_bands = 6
-    timeseries_length = 4
-    sample_width,sample_height = 256,256   
-    timestamps_str = np.empty((no_of_samples, timeseries_length, 1), dtype='S20')
-    ahi_data = np.empty((no_of_samples, timeseries_length, no_of_bands, sample_width,sample_height), dtype=np.float32)
-    cloud_mask_binary = np.empty((no_of_samples, sample_width,sample_height), dtype=np.int8)
-    ahi_stat_p = np.empty((no_of_samples, no_of_bands, 2), dtype=np.float32)
-    ahi_stat_p_c = np.empty((no_of_samples, timeseries_length, no_of_bands, 2), dtype=np.float32)
-    fire_fraction = np.empty((no_of_samples, 1), dtype=np.float32)
-    cloud_fraction = np.empty((no_of_samples, 1), dtype=np.float32)
-    raster_window_id = np.empty((no_of_samples, 1), dtype=np.int8)
-    labels_data = np.empty((no_of_samples, sample_width, sample_height), dtype=np.int8)
-
-    log.info(f"Allocated memory for all the arrays in this timestamp batch: timestamps_str: {timestamps_str.shape}, ahi_data: {ahi_data.shape}, cloud_mask_binary: {cloud_mask_binary.shape}, ahi_stat_p: {ahi_stat_p.shape}, ahi_stat_p_c: {ahi_stat_p_c.shape}, fire_fraction: {fire_fraction.shape}, cloud_fraction: {cloud_fraction.shape}, raster_window_id: {raster_window_id.shape}")
-
-    sample_count = 0
-    for timestamp in timestamp_batch:
-
-        # get ahi_data and timestamps_data (as minute of the year)
-        child_timestamps = get_child_timestamps(timestamp)
-        # reversing the order so the parent timestamp comes first
-        child_timestamps = child_timestamps[::-1]
-
-        ahi_filenames=[]
-        timestamps_data = []
-        for child_timestamp in child_timestamps:
-            timestamp_str_tmp = f"{timestamp}{child_timestamp.split('/')[-2]}"
-            stacked_masked = sorted(glob.glob(f"data/himawari8/{timestamp_str_tmp}/*_stacked_masked.tif"))
-            if stacked_masked:
-                ahi_filenames.append(stacked_masked[0])
-
-                # write the timestamp so that it is used as timestamp_str (product name)
-                timestamps_data.append(timestamp_str_tmp)
-       
-        for timeseries, ahi_filename in enumerate(ahi_filenames):
-            ahi_stacked_data = rasterio.open(ahi_filename)
-            count=sample_count
-            for window in RASTER_WINDOWS:
+def extract_timestamp(timestamp: str, writer: BufferedWriter) -> int:
+    """
+    Extracts the samples of all the raster windows of the timestamp block row by block row into the buffers of the
+    writer. Returns the no of samples
+    """
+    # get ahi_data and timestamps_data (as minute of the year)
+    child_timestamps = get_child_timestamps(timestamp)
+    # reversing the order so the parent timestamp comes first
+    child_timestamps = child_timestamps[::-1]
+
+    ahi_filenames=[]
+    timestamps_data = []
+    for child_timestamp in child_timestamps:
+        timestamp_str_tmp = f"{timestamp}{child_timestamp.split('/')[-2]}"
+        stacked_masked = MANIFEST.get(timestamp, child_timestamp.split('/')[-2], "stacked_masked")
+        if stacked_masked is not None:
+            ahi_filenames.append(stacked_masked)
+
+            # write the timestamp so that it is used as timestamp_str (product name)
+            timestamps_data.append(timestamp_str_tmp)
+
+    cmsk_filename = MANIFEST.get(timestamp, timestamp.split('/')[-2], "cd_mask")
+
+    # NaN outside the study area, densified once for all the windows
+    fire_labels = read_sparse_labels(timestamp, "cmsk_applied_labels")
+    fire_labels = fire_labels.to_dense(nan_outside_space=True) if fire_labels is not None else None
+
+    writer.begin(len(EXTRACTOR))
+    with contextlib.ExitStack() as stack:
+        ahi_files = [stack.enter_context(rasterio.open(ahi_filename)) for ahi_filename in ahi_filenames]
+        cmsk_file = stack.enter_context(rasterio.open(cmsk_filename)) if cmsk_filename is not None else None
+
+        # every raster is read once per block row of the windows, the tiles are read into the buffer of the writer
+        for strip in EXTRACTOR.strips:
+            window_ids = strip[0]
+            n = len(window_ids)
+            samples = writer.get_buffer(n)
+
+            for timeseries, ahi_stacked_data in enumerate(ahi_files):
+                # write ahi_data
+                tiles = EXTRACTOR.read_strip(ahi_stacked_data, strip, samples["ahi_data"][:n, timeseries])
 
                 # write timestamp_str
-                timestamps_str[count,timeseries,:] = np.array(timestamps_data[timeseries], dtype='S20')
-
-                # write ahi_data
-                tile = ahi_stacked_data.read(window=rasterio.windows.Window(window[1], window[0], 256, 256))
-                ahi_data[count,timeseries,:,:,:] = tile
+                samples["timestamps_str"][:n,timeseries,:] = np.array(timestamps_data[timeseries], dtype='S20')
 
                 # write ahi_stat_p, ahi_stat_p_c
-                ahi_stat = np.transpose([np.mean(tile, axis=(1,2)), np.std(tile, axis=(1,2))])
+                ahi_stat = np.stack([np.mean(tiles, axis=(2,3)), np.std(tiles, axis=(2,3))], axis=-1)
                 if timeseries==0:
-                    ahi_stat_p[count,:,:] = ahi_stat
-                ahi_stat_p_c[count,timeseries,:,:] = ahi_stat
-                count+=1
+                    samples["ahi_stat_p"][:n,:,:] = ahi_stat
+                samples["ahi_stat_p_c"][:n,timeseries,:,:] = ahi_stat
 
-                
-                
-        cmsk_filename = glob.glob(f"data/himawari8/{timestamp}{timestamp.split('/')[-2]}/cd_mask_*.tif")
-        if cmsk_filename:
-            cmsk_file = rasterio.open(cmsk_filename[0])
-            count = sample_count
-            for window_id,window in enumerate(RASTER_WINDOWS):
-                tile = cmsk_file.read(2, window=rasterio.windows.Window(window[1], window[0], 256, 256))
-
-                # change the dtype to int8
-                tile = tile.astype(np.int8)
-
-                # write cloud_mask_binary
-                cloud_mask_binary[count,:,:] = tile
+            if cmsk_file is not None:
+                # write cloud_mask_binary, the dtype changes to int8
+                tiles = EXTRACTOR.read_strip(cmsk_file, strip, samples["cloud_mask_binary"][:n], indexes=2)
 
                 # write cloud_fraction
-                cloud_fraction[count,:] = np.count_nonzero(tile==1)/(256*256)
+                samples["cloud_fraction"][:n,0] = np.count_nonzero(tiles==1, axis=(1,2))/(256*256)
 
                 # write raster_window_id
-                raster_window_id[count,:] = window_id
-                count+=1
+                samples["raster_window_id"][:n,0] = window_ids
 
-        # calculate fire_fraction
-        fire_file = glob.glob(f"data/himawari8/{timestamp}*_cmsk_applied_labels_with_nan.tif")
-        if fire_file:
-            fire_labels = rasterio.open(fire_file[0])
-            count = sample_count
-            for window in RASTER_WINDOWS:
-                tile = fire_labels.read(1, window=rasterio.windows.Window(window[1], window[0], 256, 256))
+            if fire_labels is not None:
+                tiles = EXTRACTOR.slice(fire_labels, np.empty((n, 256, 256), dtype=np.float32), window_ids)
 
                 # write to labels
-                labels_data[count,:,:] = tile
+                samples["labels_data"][:n,:,:] = tiles
 
                 # write to fire_fraction
-                fire_fraction[count,:] = np.count_nonzero(tile==1)/(256*256)
-                count+=1
-                
-        sample_count+=len(RASTER_WINDOWS)
-
-    # write log warning if sample_coubt is not equal to no_of_samples
-    if sample_count != no_of_samples:
-        log.warning(f"Sample count: {sample_count} is not equal to no_of_samples: {no_of_samples}")
-        # raise exception and stop the execution
-        raise Exception(f"Sample count: {sample_count} is not equal to no_of_samples: {no_of_samples}")
-    
-    # print all the shapes
-    log.info(f"Shape of all the arrays: timestamps_str: {timestamps_str.shape}, ahi_data: {ahi_data.shape}, cloud_mask_binary: {cloud_mask_binary.shape}, ahi_stat_p: {ahi_stat_p.shape}, ahi_stat_p_c: {ahi_stat_p_c.shape}, fire_fraction: {fire_fraction.shape}, cloud_fraction: {cloud_fraction.shape}, raster_window_id: {raster_window_id.shape}, labels_data: {labels_data.shape}")
-    return timestamps_str, ahi_data, cloud_mask_binary, ahi_stat_p, ahi_stat_p_c, fire_fraction, cloud_fraction, raster_window_id, labels_data
-    
-
-
-# get the timestamps
-with open("data/fire_masks/unique_dates_ten_minute_finalized.json") as json_file:
-    timestamps = json.load(json_file)
-
-testing_timestamps = []
-for timestamp in timestamps:
-    if timestamp.startswith("2022"):
-        testing_timestamps.append(timestamp) #due to storage constraints processing 2022 timestamps and later (2020 and 2021) timestamps separately
-
-RASTER_WINDOWS = [(1024, 256), (1280, 256), (1536, 256), (1792, 256), (2048, 256), (2304, 256), (2560, 256), (512, 512), (768, 512), (1024, 512), (1536, 512), (1792, 512), (2048, 512), (2304, 512), (2560, 512), (3072, 512), (3328, 512), (3584, 512), (256, 768), (512, 768), (768, 768), (1024, 768), (1280, 768), (1536, 768), (1792, 768), (2048, 768), (2304, 768), (2560, 768), (3072, 768), (3328, 768), (3584, 768), (3840, 768), (256, 1024), (512, 1024), (768, 1024), (1024, 1024), (1280, 1024), (1536, 1024), (1792, 1024), (2048, 1024), (2304, 1024), (2560, 1024), (2816, 1024), (3072, 1024), (3328, 1024), (3584, 1024), (3840, 1024), (256, 1280), (512, 1280), (768, 1280), (2048, 1280), (2304, 1280), (2560, 1280), (2816, 1280), (3072, 1280), (3328, 1280), (3584, 1280), (3840, 1280), (256, 1536), (512, 1536), (1792, 1536), (2048, 1536), (2304, 1536), (2560, 1536), (2816, 1536), (3072, 1536), (3328, 1536), (3584, 1536), (3840, 1536), (256, 1792), (512, 1792), (1536, 1792), (2048, 1792), (2304, 1792), (2560, 1792), (2816, 1792), (3072, 1792), (3328, 1792), (3584, 1792), (3840, 1792), (4096, 1792), (1280, 2048), (2048, 2048), (2304, 2048), (2560, 2048), (2816, 2048), (3072, 2048), (3328, 2048), (3584, 2048), (3840, 2048), (4096, 2048), (2048, 2304), (2304, 2304), (2560, 2304), (3072, 2304), (3328, 2304), (3584, 2304), (3840, 2304), (4352, 2304), (2304, 2560), (2560, 2560), (2816, 2560), (3328, 2560), (3584, 2560), (1792, 2816), (2560, 2816), (2816, 2816)]
-log.info(f"Succesfully loaded the timestamps and raster windows")
-
-log.info(f"Chuncking the timestamps with chunk size of 120 and writing to hdf5 files")
-# read 120 timestamps at a time
-file_naming_start = 0
-file_naming_end = 0
-for i in range(0, len(testing_timestamps), 120):
-    timestamp_batch = testing_timestamps[i:i+120]
-
-    # just have one timestamp for testing
-    # timestamp_batch = timestamp_batch[:1]
-
-    sample_size = len(timestamp_batch) * 107
-
-
-    file_naming_end = file_naming_start + sample_size
-    log.info(f"file_naming_start: {file_naming_start}, file_naming_end: {file_naming_end}")
-    log.info(f"Timestamp batch start and end: {timestamp_batch[0]} and {timestamp_batch[-1]}")
-
-    # # check if the .h5 file already exists
-    # if glob.glob(f'train_test_split_data_files/train_split/dynamic_files/training_dynamic_data_{file_naming_start}_{file_naming_end}.h5'):
-    #     log.info(f"File training_dynamic_data_{file_naming_start}_{file_naming_end}.h5 already exists. Skipping this batch")
-    #     continue
-    
-    timestamps_str, ahi_data, cloud_mask_binary, ahi_stat_p, ahi_stat_p_c, fire_fraction, cloud_fraction, raster_window_id, labels_data = write_to_hdf5(timestamp_batch, sample_size)
-    log.info(f"Finished creating all data arrays for this timestamp batch")
-    
-    # write to hdf5
-    filename = f'data/train_test_split_data_files/test_split/dynamic_files/testing_dynamic_data_{file_naming_start}_{file_naming_end}.h5'
-    # mnt_filename = f'/mnt/research/datasets/thesis-jayendra/testing_hdf_files/testing_dynamic_data_{file_naming_start}_{file_naming_end}.h5'
-
-    with h5py.File(filename, 'w') as f:
-
-        # create input features group
-        input_features = f.create_group('input_features')
-
-        input_features.create_dataset('timestamps_str', data=timestamps_str, chunks = (1,4,1), compression="lzf")
-        input_features.create_dataset('ahi_data', data=ahi_data, chunks = (1,4,6,256,256), compression="lzf")
-        input_features.create_dataset('cloud_mask_binary', data=cloud_mask_binary, chunks = (1,256,256), compression="lzf")
-        input_features.create_dataset('ahi_stat_p', data=ahi_stat_p, chunks = (1,6,2), compression="lzf")
-        input_features.create_dataset('ahi_stat_p_c', data=ahi_stat_p_c, chunks = (1,4,6,2), compression="lzf")
-        input_features.create_dataset('fire_fraction', data=fire_fraction, chunks = (1,1), compression="lzf")
-        input_features.create_dataset('cloud_fraction', data=cloud_fraction, chunks = (1,1), compression="lzf")
-        input_features.create_dataset('raster_window_id', data=raster_window_id, chunks = (1,1), compression="lzf")
-        # also write description for each dataset 
-        input_features['timestamps_str'].attrs['description'] = "Timestamps for each sample. Includes Parents timestamp at index 0 and children timestamps at index 1,2,3"
-        input_features['ahi_data'].attrs['description'] = "AHI data for each sample. Includes 6 bands for each timestamp"
-        input_features['cloud_mask_binary'].attrs['description'] = "Cloud mask binary for each sample. Cloud mask indicates the mask for parent timestamp"
-        input_features['ahi_stat_p'].attrs['description'] = "AHI statistics for parent timestamp. Includes mean and standard deviation for each band"
-        input_features['ahi_stat_p_c'].attrs['description'] = "AHI statistics for parent and child timestamp. Includes mean and standard deviation for each band"
-        input_features['fire_fraction'].attrs['description'] = "Fire fraction for each sample. Fire fraction indicates the fraction of fire pixels in the parent timestamp"
-        input_features['cloud_fraction'].attrs['description'] = "Cloud fraction for each sample. Cloud fraction indicates the fraction of cloud pixels in the parent timestamp"
-        input_features['raster_window_id'].attrs['description'] = "Raster window id for each sample. Raster window id indicates the window id in the raster image and used as foregin key to get the static features for each sample"
-
-        # create labels group
-        labels_group = f.create_group('labels')
-        labels_group.create_dataset('labels_data', data=labels_data, chunks = (1,256,256), compression="lzf")
-        labels_group['labels_data'].attrs['description'] = "Labels for each sample. Labels indicate the presence of fire pixels in the parent timestamp"
-
-    log.info(f"Finished writing to hdf5 file for this timestamp batch: testing_dynamic_data_{file_naming_start}_{file_naming_end}.h5")
-    file_naming_start = file_naming_end 
-
-   
-    # break
+                samples["fire_fraction"][:n,0] = np.count_nonzero(tiles==1, axis=(1,2))/(256*256)
+
+            writer.submit(list(window_ids))
+    writer.end()
+    return len(EXTRACTOR)
+
+
+def init_worker():
+    """
+    Sets the globals of a shard builder process
+    """
+    global MANIFEST, EXTRACTOR
+    # file lookups of the stacked rasters and cloud masks, every process has its own connection
+    MANIFEST = get_manifest()
+    # windows of the samples, their indexing is computed once
+    EXTRACTOR = WindowExtractor(RASTER_WINDOWS)
+
+def build_shard(shard: tuple, directory: str, prefix: str, profile: str, resume: bool) -> bool:
+    """
+    Writes the samples of the timestamps of the shard to {prefix}_{start}_{end}.h5. The file is renamed from its
+    temporary name once complete and its checksum sidecar is written last. Returns False if the shard was skipped
+    """
+    start, end, timestamps = shard
+    path = get_shard_path(directory, prefix, start, end)
+    # check if the .h5 file already exists
+    if resume and is_shard_complete(path, timestamps, profile):
+        log.info(f"File {os.path.basename(path)} already exists and matches its checksum. Skipping this shard")
+        return False
+    log.info(f"Timestamp shard {start}_{end} start and end: {timestamps[0]} and {timestamps[-1]}")
+
+    # the samples of every timestamp are appended as they are extracted, only two block rows of samples are in memory
+    buffer_size = max(len(strip[0]) for strip in EXTRACTOR.strips)
+    with DynamicHDF5Writer(directory, prefix, start=start, profile=profile) as hdf5_writer:
+        writer = BufferedWriter(hdf5_writer, buffer_size)
+        try:
+            for timestamp in timestamps:
+                extract_timestamp(timestamp, writer)
+        finally:
+            writer.close()
+
+    if hdf5_writer.paths != [path]:
+        raise Exception(f"Wrote {hdf5_writer.paths} instead of {path}")
+    write_shard_checksum(path, timestamps, profile)
+    return True
+
+def remove_stale_shards(directory: str, prefix: str, paths: list):
+    """
+    Removes the files of the prefix (shards, sidecars and temporary files) that are not part of the shard plan, ex:
+    of a run with other timestamps, as their sample ranges overlap with the ones of the plan
+    """
+    pattern = re.compile(rf"\.?{re.escape(prefix)}_\d+(_\d+)?\.h5(\.sha256)?(\.tmp)?")
+    keep = {os.path.basename(path) for path in paths} | {f"{os.path.basename(path)}.sha256" for path in paths}
+    for filename in os.listdir(directory):
+        if pattern.fullmatch(filename) and filename not in keep:
+            os.remove(f"{directory}/{filename}")
+            log.info(f"Removed {filename}, it is not part of the shard plan")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--OUTPUT_DIR", type=str, default="data/train_test_split_data_files/test_split/dynamic_files", help="Directory of the HDF5 files")
+    parser.add_argument("--PREFIX", type=str, default="testing_dynamic_data", help="File name prefix of the HDF5 files")
+    parser.add_argument("--TIMESTAMPS_PER_SHARD", type=int, default=120, help="No of timestamps of every HDF5 file")
+    parser.add_argument("--LAYOUT", choices=list(PROFILES), default=DEFAULT_PROFILE, help="Chunk layout and compression profile (see hdf5_layout.py)")
+    parser.add_argument("--WORKERS", type=int, default=os.cpu_count(), help="No of processes building shards")
+    parser.add_argument("--RESUME", action="store_true", help="Skip the shards that exist and match their checksum")
+    args = parser.parse_args()
+    if not is_profile_available(args.LAYOUT):
+        parser.error(f"--LAYOUT {args.LAYOUT} uses zstd and needs hdf5plugin, install it or use another layout")
+
+    # get the timestamps
+    #due to storage constraints processing 2022 timestamps and later (2020 and 2021) timestamps separately, see GEO_DL_YEARS
+    testing_timestamps = get_timestamps()
+
+    # every timestamp has a sample for every raster window, so the sample range of every shard is known up front
+    shards = get_shard_plan(testing_timestamps, args.TIMESTAMPS_PER_SHARD, len(RASTER_WINDOWS))
+    os.makedirs(args.OUTPUT_DIR, exist_ok=True)
+    remove_stale_shards(args.OUTPUT_DIR, args.PREFIX, [get_shard_path(args.OUTPUT_DIR, args.PREFIX, start, end) for start, end, _ in shards])
+    log.info(f"Succesfully loaded the timestamps and raster windows")
+
+    buffer_size = max(len(strip[0]) for strip in WindowExtractor(RASTER_WINDOWS).strips)
+    log.info(f"Writing {len(testing_timestamps)} timestamps to {len(shards)} hdf5 files with {args.WORKERS} processes, buffers of {2 * buffer_size * get_sample_nbytes() / 1024**2:.0f} MB per process")
+    written, skipped, failed = 0, 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.WORKERS, initializer=init_worker) as executor:
+        futures = {executor.submit(build_shard, shard, args.OUTPUT_DIR, args.PREFIX, args.LAYOUT, args.RESUME): shard for shard in shards}
+        for future in concurrent.futures.as_completed(futures):
+            start, end, _ = futures[future]
+            try:
+                if future.result():
+                    written += 1
+                    log.info(f"Finished writing to hdf5 file for this timestamp shard: {args.PREFIX}_{start}_{end}.h5")
+                else:
+                    skipped += 1
+            except Exception as e:
+                failed += 1
+                log.error(f"Error writing the hdf5 file of the timestamp shard {start}_{end}: {e}")
+
+    log.info(f"Finished {len(shards)} hdf5 files: {written} written, {skipped} already complete, {failed} failed")
+    # the sample ranges of the file names are only valid if every shard is complete
+    if failed:
+        sys.exit(1)
+
+    # one file with all the samples, the shards are read through it
+    write_virtual_index(args.OUTPUT_DIR, args.PREFIX, shards)
 
 # filename explanation:
 # training_dynamic_data_0_12840.h5: This filenaming mean that the samples from 0 to 12840 are stored in this file (generally there is no sample 0 but here it indicates sample 1 as we apply numpy index naming convention). So to get samle 4352, we need to open the file training_dynamic_data_0_12840.h5 and get the sample at index 4351.
-
+# Instead of decoding the file names, open training_dynamic_data_index.h5 and read sample 4351 of its datasets (ex: input_features/ahi_data[4351]), they are virtual datasets over all the files. shards/start, shards/end and shards/filename have the sample range of every file.
@@ -0,0 +1,301 @@
+"""
+Streaming writer of the dynamic feature HDF5 files
+
+The datasets are created resizable (maxshape None along the samples) when a file is opened. Every timestamp reserves
+its samples with begin() and its samples are written as they are extracted, so only a few samples are held in memory
+instead of a whole batch of timestamps. Files are written under a temporary name and renamed to
+{prefix}_{start}_{end}.h5 (sample range) when closed, optionally a file is closed and the next one opened once it
+reaches a byte target.
+
+Every timestamp has a sample for every raster window, so the sample ranges of shards of a fixed no of timestamps are
+known up front (get_shard_plan) and the shards can be written independently. A json sidecar {file}.sha256 with the
+sha256 of a finished shard, its timestamps and layout profile marks it as complete (is_shard_complete).
+
+write_virtual_index writes {prefix}_index.h5 once all the shards are complete. It has the datasets of the shards as
+virtual datasets over all the samples, so a loader opens one file and sample N is input_features/ahi_data[N] etc.
+HDF5 only opens the shards the read samples are in. The shards are referenced by their file name, relative to the
+index, so the directory can be moved as a whole.
+
+BufferedWriter runs the writes in a background thread on two alternating buffers, so the next samples are extracted
+while the previous ones are compressed and written.
+"""
+import os
+import json
+import h5py
+import hashlib
+import concurrent.futures
+import numpy as np
+import logging as log
+from hdf5_layout import DEFAULT_PROFILE, get_dataset_options
+
+NO_OF_BANDS = 6
+TIMESERIES_LENGTH = 4
+SAMPLE_SIZE = 256
+
+# name -> (group, shape of a sample, dtype, kind (see hdf5_layout.py), description)
+DATASETS = {
+    "timestamps_str": ("input_features", (TIMESERIES_LENGTH, 1), "S20", "scalar", "Timestamps for each sample. Includes Parents timestamp at index 0 and children timestamps at index 1,2,3"),
+    "ahi_data": ("input_features", (TIMESERIES_LENGTH, NO_OF_BANDS, SAMPLE_SIZE, SAMPLE_SIZE), np.float32, "bands", "AHI data for each sample. Includes 6 bands for each timestamp"),
+    "cloud_mask_binary": ("input_features", (SAMPLE_SIZE, SAMPLE_SIZE), np.int8, "mask", "Cloud mask binary for each sample. Cloud mask indicates the mask for parent timestamp"),
+    "ahi_stat_p": ("input_features", (NO_OF_BANDS, 2), np.float32, "scalar", "AHI statistics for parent timestamp. Includes mean and standard deviation for each band"),
+    "ahi_stat_p_c": ("input_features", (TIMESERIES_LENGTH, NO_OF_BANDS, 2), np.float32, "scalar", "AHI statistics for parent and child timestamp. Includes mean and standard deviation for each band"),
+    "fire_fraction": ("input_features", (1,), np.float32, "scalar", "Fire fraction for each sample. Fire fraction indicates the fraction of fire pixels in the parent timestamp"),
+    "cloud_fraction": ("input_features", (1,), np.float32, "scalar", "Cloud fraction for each sample. Cloud fraction indicates the fraction of cloud pixels in the parent timestamp"),
+    "raster_window_id": ("input_features", (1,), np.int8, "scalar", "Raster window id for each sample. Raster window id indicates the window id in the raster image and used as foregin key to get the static features for each sample"),
+    "labels_data": ("labels", (SAMPLE_SIZE, SAMPLE_SIZE), np.int8, "mask", "Labels for each sample. Labels indicate the presence of fire pixels in the parent timestamp"),
+}
+
+
+def allocate_samples(no_of_samples: int) -> dict:
+    """
+    Returns name -> zeroed array of no_of_samples samples for every dataset
+    """
+    return {name: np.zeros((no_of_samples, *shape), dtype=dtype) for name, (_, shape, dtype, _, _) in DATASETS.items()}
+
+def get_shard_path(directory: str, prefix: str, start: int, end: int) -> str:
+    return f"{directory}/{prefix}_{start}_{end}.h5"
+
+def get_shard_plan(timestamps: list, timestamps_per_shard: int, no_of_windows: int) -> list:
+    """
+    Splits the timestamps into shards of timestamps_per_shard timestamps. Returns (start, end, timestamps) of every
+    shard, where start and end is the sample range of the shard
+    """
+    shards = []
+    for i in range(0, len(timestamps), timestamps_per_shard):
+        shard_timestamps = timestamps[i:i+timestamps_per_shard]
+        start = i * no_of_windows
+        shards.append((start, start + len(shard_timestamps) * no_of_windows, shard_timestamps))
+    return shards
+
+def get_file_sha256(path: str, chunk_size: int = 16 * 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_shard_info(timestamps: list, profile: str) -> dict:
+    """
+    Returns what a shard is built from, a shard written from other timestamps or with another layout is not complete
+    """
+    return {"timestamps_sha256": hashlib.sha256("".join(timestamps).encode()).hexdigest(), "layout_profile": profile}
+
+def write_shard_checksum(path: str, timestamps: list, profile: str):
+    """
+    Writes the sidecar of a finished shard
+    """
+    checksum = {"sha256": get_file_sha256(path), **get_shard_info(timestamps, profile)}
+    with open(f"{path}.sha256.tmp", "w") as f:
+        json.dump(checksum, f)
+    os.replace(f"{path}.sha256.tmp", f"{path}.sha256")
+
+def is_shard_complete(path: str, timestamps: list, profile: str, verify: bool = True) -> bool:
+    """
+    Returns True if the shard and its sidecar exist, the sidecar matches the timestamps and profile and (if verify)
+    the sha256 of the file
+    """
+    if not os.path.exists(path) or not os.path.exists(f"{path}.sha256"):
+        return False
+    try:
+        with open(f"{path}.sha256") as f:
+            checksum = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if any(checksum.get(key) != value for key, value in get_shard_info(timestamps, profile).items()):
+        return False
+    return not verify or checksum.get("sha256") == get_file_sha256(path)
+
+def get_index_path(directory: str, prefix: str) -> str:
+    return f"{directory}/{prefix}_index.h5"
+
+def write_virtual_index(directory: str, prefix: str, shards: list) -> str:
+    """
+    Writes the virtual datasets over the shards of the plan (see get_shard_plan) and their sample ranges
+    (shards/start, shards/end, shards/filename). Returns the path of the index
+    """
+    no_of_samples = shards[-1][1] if shards else 0
+    path = get_index_path(directory, prefix)
+    tmp_path = f"{directory}/.{prefix}_index.h5.tmp"
+    with h5py.File(tmp_path, "w") as f:
+        for name, (group, shape, dtype, _, description) in DATASETS.items():
+            layout = h5py.VirtualLayout(shape=(no_of_samples, *shape), dtype=dtype)
+            for start, end, _ in shards:
+                filename = os.path.basename(get_shard_path(directory, prefix, start, end))
+                layout[start:end] = h5py.VirtualSource(filename, f"{group}/{name}", shape=(end - start, *shape))
+            dataset = f.require_group(group).create_virtual_dataset(name, layout)
+            dataset.attrs["description"] = description
+
+        f.create_dataset("shards/start", data=np.array([start for start, _, _ in shards], dtype=np.int64))
+        f.create_dataset("shards/end", data=np.array([end for _, end, _ in shards], dtype=np.int64))
+        f.create_dataset("shards/filename", data=np.array([os.path.basename(get_shard_path(directory, prefix, start, end)) for start, end, _ in shards], dtype="S"))
+        f.attrs["no_of_samples"] = no_of_samples
+    os.replace(tmp_path, path)
+    log.info(f"Wrote the index of {len(shards)} shards ({no_of_samples} samples) to {path}")
+    return path
+
+def get_sample_nbytes() -> int:
+    """
+    Returns the uncompressed size of one sample of all the datasets
+    """
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype, _, _ in DATASETS.values())
+
+
+class DynamicHDF5Writer():
+    def __init__(self, directory: str, prefix: str, target_bytes: int = None, start: int = 0, profile: str = DEFAULT_PROFILE):
+        """
+        args:
+            directory: str (directory of the files)
+            prefix: str (file name prefix, ex: testing_dynamic_data)
+            target_bytes: int (a file is closed once it is at least this large, None writes a single file)
+            start: int (index of the first sample, used for the sample range in the file names)
+            profile: str (chunk layout and compression profile, see hdf5_layout.py)
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.target_bytes = target_bytes
+        self.profile = profile
+        self.start = start
+        self.no_of_samples = 0
+        self.file = None
+        self.paths = []
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        self.tmp_path = f"{self.directory}/.{self.prefix}_{self.start}.h5.tmp"
+        self.file = h5py.File(self.tmp_path, "w")
+        for group in sorted({group for group, _, _, _, _ in DATASETS.values()}):
+            self.file.create_group(group)
+        for name, (group, shape, dtype, kind, description) in DATASETS.items():
+            dataset = self.file[group].create_dataset(name, shape=(0, *shape), maxshape=(None, *shape), dtype=dtype, **get_dataset_options(kind, shape, dtype, self.profile))
+            dataset.attrs["layout_profile"] = self.profile
+            dataset.attrs["description"] = description
+        self.no_of_samples = 0
+
+    def _close(self):
+        self.file.close()
+        self.file = None
+        end = self.start + self.no_of_samples
+        path = get_shard_path(self.directory, self.prefix, self.start, end)
+        os.replace(self.tmp_path, path)
+        self.paths.append(path)
+        log.info(f"Finished writing to hdf5 file {path}")
+        self.start = end
+
+    def begin(self, no_of_samples: int) -> int:
+        """
+        Reserves no_of_samples samples (ex: the windows of a timestamp) in the open file. Returns the index of the
+        first one in the file
+        """
+        if self.file is None:
+            self._open()
+        base = self.no_of_samples
+        self.no_of_samples += no_of_samples
+        for name, (group, _, _, _, _) in DATASETS.items():
+            self.file[group][name].resize(self.no_of_samples, axis=0)
+        return base
+
+    def write(self, positions: list, samples: dict):
+        """
+        Writes the first len(positions) samples of name -> array to the increasing positions of the open file
+        """
+        for name, (group, _, _, _, _) in DATASETS.items():
+            self.file[group][name][positions] = samples[name][:len(positions)]
+
+    def end(self):
+        """
+        Ends the reserved samples and rolls over to the next file once the target size is reached
+        """
+        self.file.flush()
+        if self.target_bytes is not None and self.file.id.get_filesize() >= self.target_bytes:
+            self._close()
+
+    def close(self):
+        """
+        Closes the last file, an empty file is removed
+        """
+        if self.file is None:
+            return
+        if self.no_of_samples == 0:
+            self.file.close()
+            self.file = None
+            os.remove(self.tmp_path)
+            return
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.file is not None:
+            # an incomplete file keeps its temporary name
+            self.file.close()
+            self.file = None
+            return
+        self.close()
+
+
+class BufferedWriter():
+    def __init__(self, writer: DynamicHDF5Writer, buffer_size: int):
+        """
+        args:
+            writer: DynamicHDF5Writer (only used from the background thread, in the order of the calls)
+            buffer_size: int (maximum no of samples written at once)
+        """
+        self.writer = writer
+        self.buffers = [allocate_samples(buffer_size), allocate_samples(buffer_size)]
+        self.writes = [None, None]
+        self.current = 0
+        self.base = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def _submit(self, fn, *args) -> concurrent.futures.Future:
+        # errors of earlier calls are raised in the calling thread
+        for future in [future for future in self.pending if future.done()]:
+            self.pending.remove(future)
+            future.result()
+        future = self.executor.submit(fn, *args)
+        self.pending.append(future)
+        return future
+
+    def _begin(self, no_of_samples: int):
+        self.base = self.writer.begin(no_of_samples)
+
+    def _write(self, positions: list, samples: dict):
+        self.writer.write([self.base + position for position in positions], samples)
+
+    def begin(self, no_of_samples: int):
+        """
+        Reserves the samples of a timestamp, the positions of the following writes are relative to them
+        """
+        self._submit(self._begin, no_of_samples)
+
+    def get_buffer(self, no_of_samples: int) -> dict:
+        """
+        Returns the next buffer with its first no_of_samples samples zeroed, after its previous write finished
+        """
+        if self.writes[self.current] is not None:
+            self.writes[self.current].result()
+        samples = self.buffers[self.current]
+        for array in samples.values():
+            array[:no_of_samples] = 0
+        return samples
+
+    def submit(self, positions: list):
+        """
+        Writes the buffer returned by the last get_buffer to the (increasing) positions in the background
+        """
+        self.writes[self.current] = self._submit(self._write, positions, self.buffers[self.current])
+        self.current = 1 - self.current
+
+    def end(self):
+        self._submit(self.writer.end)
+
+    def close(self):
+        """
+        Waits for the pending calls and raises the first error
+        """
+        self.executor.shutdown(wait=True)
+        for future in self.pending:
+            future.result()
+        self.pending = []
@@ -0,0 +1,90 @@
+"""
+Chunk layout and compression profiles of the training and evaluation HDF5 datasets
+
+Every dataset is one of three kinds:
+    scalar    per sample values and metadata (fractions, ids, timestamps, statistics), chunked over many samples
+              instead of one chunk per sample
+    mask      int8 images (cloud masks, labels), one chunk per sample
+    bands     float32 images with the band axis before height and width (ahi_data), one chunk per sample or, with
+              band_chunks, one chunk per sample and band so that loaders reading a subset of the bands only
+              decompress those
+
+Profiles:
+    legacy       layout of the files written before the profiles (chunks of one sample for everything, lzf)
+    balanced     scalars chunked by 4096 samples, lzf (readable with plain h5py), the default
+    zstd         Blosc/zstd with byte shuffle for the float bands and zstd for the rest
+    band_subset  zstd with one chunk per band
+
+zstd needs the optional hdf5plugin package (extra "zstd" of pyproject.toml), to write and to read the files (import
+hdf5plugin before opening them with h5py). The zstd profiles raise an ImportError without it instead of writing another
+codec than the one of the profile recorded in the files.
+"""
+import numpy as np
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+PROFILES = {
+    "legacy": {"scalar_chunk": 1, "scalars": "lzf", "masks": "lzf", "bands": "lzf", "band_chunks": False},
+    "balanced": {"scalar_chunk": 4096, "scalars": "lzf", "masks": "lzf", "bands": "lzf", "band_chunks": False},
+    "zstd": {"scalar_chunk": 4096, "scalars": "zstd", "masks": "zstd", "bands": "zstd", "band_chunks": False},
+    "band_subset": {"scalar_chunk": 4096, "scalars": "zstd", "masks": "zstd", "bands": "zstd", "band_chunks": True},
+}
+DEFAULT_PROFILE = "balanced"
+ZSTD_LEVEL = 5
+GZIP_LEVEL = 4
+
+
+def is_profile_available(profile: str) -> bool:
+    """
+    Returns False if the profile uses zstd and hdf5plugin is not installed
+    """
+    layout = PROFILES[profile]
+    return hdf5plugin is not None or "zstd" not in [layout["scalars"], layout["masks"], layout["bands"]]
+
+def get_compression(codec: str, shuffle: bool) -> dict:
+    """
+    Returns the compression keyword arguments of h5py create_dataset for the codec (lzf, gzip or zstd)
+    """
+    if codec == "zstd" and hdf5plugin is None:
+        raise ImportError("zstd compression needs hdf5plugin, install it (pip install hdf5plugin) or use a profile without zstd")
+
+    if codec == "lzf":
+        return {"compression": "lzf"}
+    if codec == "gzip":
+        return {"compression": "gzip", "compression_opts": GZIP_LEVEL, "shuffle": shuffle}
+    if codec == "zstd":
+        return dict(hdf5plugin.Blosc(cname="zstd", clevel=ZSTD_LEVEL, shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    raise ValueError(f"Unknown codec {codec}")
+
+def get_dataset_options(kind: str, sample_shape: tuple, dtype, profile: str = DEFAULT_PROFILE, no_of_samples: int = None) -> dict:
+    """
+    Returns the chunks and compression keyword arguments of h5py create_dataset for a dataset of samples of
+    sample_shape. no_of_samples limits the chunks of a dataset that is not resizable
+    """
+    layout = PROFILES[profile]
+    sample_shape = tuple(sample_shape)
+
+    if kind == "scalar":
+        samples_per_chunk = layout["scalar_chunk"]
+        if no_of_samples is not None:
+            samples_per_chunk = max(1, min(samples_per_chunk, no_of_samples))
+        chunks = (samples_per_chunk, *sample_shape)
+        codec = layout["scalars"]
+    elif kind == "mask":
+        chunks = (1, *sample_shape)
+        codec = layout["masks"]
+    elif kind == "bands":
+        chunks = [1, *sample_shape]
+        if layout["band_chunks"]:
+            # band axis is the one before height and width
+            chunks[-3] = 1
+        chunks = tuple(chunks)
+        codec = layout["bands"]
+    else:
+        raise ValueError(f"Unknown dataset kind {kind}")
+
+    # byte shuffle only helps multi byte types
+    return {"chunks": chunks, **get_compression(codec, shuffle=np.dtype(dtype).itemsize > 1)}
@@ -0,0 +1,74 @@
+"""
+The 256 x 256 raster windows of the samples on the AOI grid and their window-major extraction
+
+The windows lie on a regular 256 pixel grid. WindowExtractor groups them by block row once and reads every block row
+of a raster with a single windowed read (the columns spanned by its windows), the tiles are then sliced from the
+strip into the batch arrays. This replaces one GDAL window read per tile with one read per block row.
+"""
+import numpy as np
+from rasterio.windows import Window
+
+TILE_SIZE = 256
+# (row offset, column offset) of every window on the AOI grid, the index in this list is the raster_window_id
+RASTER_WINDOWS = [(1024, 256), (1280, 256), (1536, 256), (1792, 256), (2048, 256), (2304, 256), (2560, 256), (512, 512), (768, 512), (1024, 512), (1536, 512), (1792, 512), (2048, 512), (2304, 512), (2560, 512), (3072, 512), (3328, 512), (3584, 512), (256, 768), (512, 768), (768, 768), (1024, 768), (1280, 768), (1536, 768), (1792, 768), (2048, 768), (2304, 768), (2560, 768), (3072, 768), (3328, 768), (3584, 768), (3840, 768), (256, 1024), (512, 1024), (768, 1024), (1024, 1024), (1280, 1024), (1536, 1024), (1792, 1024), (2048, 1024), (2304, 1024), (2560, 1024), (2816, 1024), (3072, 1024), (3328, 1024), (3584, 1024), (3840, 1024), (256, 1280), (512, 1280), (768, 1280), (2048, 1280), (2304, 1280), (2560, 1280), (2816, 1280), (3072, 1280), (3328, 1280), (3584, 1280), (3840, 1280), (256, 1536), (512, 1536), (1792, 1536), (2048, 1536), (2304, 1536), (2560, 1536), (2816, 1536), (3072, 1536), (3328, 1536), (3584, 1536), (3840, 1536), (256, 1792), (512, 1792), (1536, 1792), (2048, 1792), (2304, 1792), (2560, 1792), (2816, 1792), (3072, 1792), (3328, 1792), (3584, 1792), (3840, 1792), (4096, 1792), (1280, 2048), (2048, 2048), (2304, 2048), (2560, 2048), (2816, 2048), (3072, 2048), (3328, 2048), (3584, 2048), (3840, 2048), (4096, 2048), (2048, 2304), (2304, 2304), (2560, 2304), (3072, 2304), (3328, 2304), (3584, 2304), (3840, 2304), (4352, 2304), (2304, 2560), (2560, 2560), (2816, 2560), (3328, 2560), (3584, 2560), (1792, 2816), (2560, 2816), (2816, 2816)]
+
+
+class WindowExtractor():
+    def __init__(self, windows: list = RASTER_WINDOWS, size: int = TILE_SIZE):
+        """
+        args:
+            windows: list ((row offset, column offset) of the windows)
+            size: int (height and width of the windows)
+        """
+        self.windows = windows
+        self.size = size
+        offsets = np.array(windows)
+
+        # block row offset -> (window ids, column offsets relative to the strip, strip window)
+        self.strips = []
+        for row_off in np.unique(offsets[:, 0]):
+            window_ids = np.flatnonzero(offsets[:, 0] == row_off)
+            col_offs = offsets[window_ids, 1]
+            col_start = int(col_offs.min())
+            strip_window = Window(col_start, int(row_off), int(col_offs.max()) + size - col_start, size)
+            self.strips.append((window_ids, col_offs - col_start, strip_window))
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    def get_window(self, window_id: int) -> Window:
+        row_off, col_off = self.windows[window_id]
+        return Window(col_off, row_off, self.size, self.size)
+
+    def read_strip(self, src, strip: tuple, out: np.ndarray, indexes=None) -> np.ndarray:
+        """
+        Reads the tiles of the windows of one block row (an item of self.strips) from the open rasterio dataset src
+        into out (windows of the strip first, then the bands if indexes is a list or None, then size x size)
+        """
+        window_ids, col_offs, strip_window = strip
+        data = src.read(indexes, window=strip_window)
+        for i, col_off in enumerate(col_offs):
+            out[i] = data[..., col_off:col_off + self.size]
+        return out
+
+    def read(self, src, out: np.ndarray, indexes=None) -> np.ndarray:
+        """
+        Reads the tiles of all the windows from the open rasterio dataset src into out (no of windows first, then
+        the bands if indexes is a list or None, then size x size) with one read per block row
+        """
+        for strip in self.strips:
+            window_ids, col_offs, strip_window = strip
+            data = src.read(indexes, window=strip_window)
+            for window_id, col_off in zip(window_ids, col_offs):
+                out[window_id] = data[..., col_off:col_off + self.size]
+        return out
+
+    def slice(self, array: np.ndarray, out: np.ndarray, window_ids=None) -> np.ndarray:
+        """
+        Copies the tiles of the windows (default all) of an array of the whole AOI grid (bands first if any) into out
+        """
+        window_ids = range(len(self.windows)) if window_ids is None else window_ids
+        for i, window_id in enumerate(window_ids):
+            row_off, col_off = self.windows[window_id]
+            out[i] = array[..., row_off:row_off + self.size, col_off:col_off + self.size]
+        return out
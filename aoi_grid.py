@@ -0,0 +1,147 @@
+"""
+Crop window, transform and mask of the AOI on the full disk 2 km grid of himawari8
+
+The AOI polygon is rasterized once on the grid of the sample full disk scene. The result is persisted next to the
+empty AOI mask (data/himawari8/empty_mask_h8_aoi_updated_grid.npz), so every step that crops full disk rasters
+(decoded bands, cloud masks, the empty mask) only slices arrays. The window and the mask are the same as the ones
+of rasterio.mask.mask(crop=True).
+"""
+import os
+import hashlib
+import threading
+import numpy as np
+import rasterio
+import geopandas as gpd
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.mask import raster_geometry_mask
+from rasterio.windows import Window
+import logging as log
+
+AOI_PATH = "02_input_data/aoi_h8_updated.geojson"
+# full disk 2 km sample scene defining the grid on which the AOI is cropped
+REFERENCE_RASTER_PATH = "data/himawari8/sample_data_B05_20220101_004000.tif"
+GRID_PATH = "data/himawari8/empty_mask_h8_aoi_updated_grid.npz"
+
+_grids = {}
+_grids_lock = threading.Lock()
+
+
+def get_file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class AOIGrid():
+    def __init__(self, outside: np.ndarray, window: Window, transform: Affine, crs: CRS, full_shape: tuple, nodata: float = None):
+        """
+        args:
+            outside: np.ndarray (boolean (H, W) mask, True for the pixels of the window outside the AOI)
+            window: rasterio Window (AOI window on the full disk grid)
+            transform: Affine (transform of the cropped rasters)
+            crs: rasterio CRS (crs of the full disk grid)
+            full_shape: tuple (height, width of the full disk grid)
+            nodata: float (nodata value of the reference raster, None if it has none)
+        """
+        self.outside = outside
+        self.window = window
+        self.transform = transform
+        self.crs = crs
+        self.full_shape = tuple(full_shape)
+        self.nodata = nodata
+        self.rows = slice(int(window.row_off), int(window.row_off + window.height))
+        self.cols = slice(int(window.col_off), int(window.col_off + window.width))
+
+    @property
+    def shape(self) -> tuple:
+        return self.outside.shape
+
+    @classmethod
+    def compute(cls, aoi_path: str = AOI_PATH, reference_path: str = REFERENCE_RASTER_PATH):
+        """
+        Rasterizes the AOI polygon on the grid of the reference raster
+        """
+        aoi_geom = gpd.read_file(aoi_path)["geometry"]
+        with rasterio.open(reference_path) as src:
+            outside, transform, window = raster_geometry_mask(src, aoi_geom, crop=True)
+            return cls(outside, window, transform, src.crs, (src.height, src.width), src.nodata)
+
+    def save(self, path: str, aoi_sha256: str):
+        tmp_path = f"{os.path.dirname(path) or '.'}/.{os.path.basename(path)}.tmp.npz"
+        np.savez(
+            tmp_path,
+            outside=self.outside,
+            window=np.array([self.window.col_off, self.window.row_off, self.window.width, self.window.height]),
+            transform=np.array(self.transform[:6]),
+            crs=np.array(self.crs.to_wkt()),
+            full_shape=np.array(self.full_shape),
+            nodata=np.array([] if self.nodata is None else [self.nodata], dtype=np.float64),
+            aoi_sha256=np.array(aoi_sha256)
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, aoi_sha256: str = None):
+        """
+        Returns the persisted grid or None if it was computed for another AOI
+        """
+        with np.load(path) as data:
+            if aoi_sha256 is not None and str(data["aoi_sha256"]) != aoi_sha256:
+                return None
+            nodata = float(data["nodata"][0]) if len(data["nodata"]) else None
+            return cls(data["outside"], Window(*data["window"]), Affine(*data["transform"]), CRS.from_wkt(str(data["crs"])), tuple(data["full_shape"]), nodata)
+
+    def crop(self, array: np.ndarray, fill = None) -> np.ndarray:
+        """
+        Returns the AOI window of a full disk array (..., height, width). If fill is given the pixels outside the AOI
+        are set to it (on a copy), like rasterio.mask.mask does with the nodata value
+        """
+        if array.shape[-2:] != self.full_shape:
+            raise ValueError(f"Array of shape {array.shape} is not on the full disk grid {self.full_shape}")
+        cropped = array[..., self.rows, self.cols]
+        if fill is not None:
+            cropped = np.array(cropped)
+            cropped[..., self.outside] = fill
+        return cropped
+
+    def get_meta(self, meta: dict) -> dict:
+        """
+        Returns a copy of the rasterio meta of a full disk raster updated for the cropped raster
+        """
+        meta = meta.copy()
+        meta.update({
+            "driver": "GTiff",
+            "height": self.shape[0],
+            "width": self.shape[1],
+            "transform": self.transform,
+            "crs": self.crs
+        })
+        return meta
+
+
+def get_aoi_grid(path: str = GRID_PATH, aoi_path: str = AOI_PATH, reference_path: str = REFERENCE_RASTER_PATH) -> AOIGrid:
+    """
+    Returns the AOI grid. It is loaded from path, computed and persisted if path does not exist or belongs to another
+    AOI, and kept in memory for the next calls of the process
+    """
+    with _grids_lock:
+        if path in _grids:
+            return _grids[path]
+
+        aoi_sha256 = get_file_sha256(aoi_path)
+        grid = AOIGrid.load(path, aoi_sha256) if os.path.exists(path) else None
+        if grid is None:
+            grid = AOIGrid.compute(aoi_path, reference_path)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            grid.save(path, aoi_sha256)
+            log.info(f"Computed the AOI grid {grid.window} and saved it to {path}")
+        _grids[path] = grid
+        return grid
+
+
+if __name__ == "__main__":
+
+    # computes and persists the grid and writes the empty AOI raster used as reference by the later steps
+    from utils import create_empty_h8_mask
+    get_aoi_grid()
+    create_empty_h8_mask()
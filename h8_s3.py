@@ -0,0 +1,215 @@
+"""
+Helpers for the public noaa-himawari8 S3 bucket
+
+H8BucketIndex keeps a local SQLite table of the objects of the bucket. Every day prefix of a product is listed once
+with a paginated list_objects_v2 and the availability of a timestamp is then answered from the table. The index is
+shared by the availability check (01_fire_masks) and the downloader (02_input_data) and is reused by reruns.
+
+download_object downloads into a .part file (resuming it with a ranged GET), checks it against the size and ETag of
+the index and renames it atomically, so a killed run never leaves a truncated file under the final name.
+"""
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+import boto3
+from botocore.client import Config
+from botocore import UNSIGNED
+import logging as log
+
+# Define the S3 bucket and directory
+BUCKET_NAME = 'noaa-himawari8'
+FLDK_DIR = 'AHI-L1b-FLDK'
+CLOUD_PRODUCT_DIR = 'AHI-L2-FLDK-Clouds'
+FLDK_BANDS = ["B07", "B11", "B12", "B13", "B14", "B15"]
+# every band of a full disk scene is split into 10 horizontal segments (S0110 ... S1010)
+NO_OF_SEGMENTS = 10
+INDEX_PATH = "data/himawari8/s3_index.sqlite"
+# every object is downloaded once into this store and hard linked into the timestamp directories
+OBJECT_STORE_DIR = "data/himawari8/objects"
+
+
+def get_s3_client():
+    """
+    Returns an unsigned S3 client for the public himawari8 bucket
+    """
+    return boto3.client("s3",config=Config(signature_version=UNSIGNED),region_name='us-east-1')
+
+def is_fldk_band_key(key: str) -> bool:
+    """
+    Returns True if the FLDK object belongs to one of the bands we use
+    """
+    return any(f"_{band}_" in key for band in FLDK_BANDS)
+
+def is_cloud_mask_key(key: str) -> bool:
+    """
+    Returns True if the cloud product object is a cloud mask
+    """
+    return '-CMSK_' in key or '_CLOUD_MASK_' in key
+
+def get_key_segment(key: str) -> int:
+    """
+    Returns the segment number of an HSD file (ex: 3 for "HS_H08_20200101_0000_B07_FLDK_R20_S0310.DAT.bz2")
+    """
+    return int(re.search(r"_S(\d{2})\d{2}\.DAT", key).group(1))
+
+def get_object_store_path(key: str) -> str:
+    """
+    Returns the path of the object in the local object store. File names of the bucket are unique (they contain the
+    date, time, band and segment) so the store is flat
+    """
+    return f"{OBJECT_STORE_DIR}/{key.split('/')[-1]}"
+
+def release_object(filename: str):
+    """
+    Removes the object store copy of a downloaded file once no timestamp directory links to it anymore
+    """
+    store_path = f"{OBJECT_STORE_DIR}/{os.path.basename(filename)}"
+    try:
+        if os.stat(store_path).st_nlink == 1:
+            os.remove(store_path)
+    except FileNotFoundError:
+        pass
+
+
+class TransferGovernor():
+    """
+    Global limit on the number of concurrent downloads and on the total bandwidth (token bucket) shared by all threads
+    """
+    def __init__(self, max_concurrent: int = 32, max_bytes_per_second: float = None):
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.max_bytes_per_second = max_bytes_per_second
+        self._lock = threading.Lock()
+        self._tokens = max_bytes_per_second or 0
+        self._last = time.monotonic()
+
+    def consume(self, no_of_bytes: int):
+        """
+        Blocks until no_of_bytes can be transferred within the bandwidth limit
+        """
+        if self.max_bytes_per_second is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_bytes_per_second, self._tokens + (now - self._last) * self.max_bytes_per_second)
+            self._last = now
+            self._tokens -= no_of_bytes
+            wait = -self._tokens / self.max_bytes_per_second if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_md5(path: str, chunk_size: int = 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def download_object(s3, bucket: str, key: str, local_file_path: str, size: int, etag: str, governor: TransferGovernor, chunk_size: int = 1024 * 1024):
+    """
+    Downloads the object to local_file_path. The data is written to local_file_path.part which is resumed if it
+    already exists, verified against size and ETag (md5 for single part uploads) and then renamed atomically.
+    Raises IOError if the verification fails
+    """
+    part_path = f"{local_file_path}.part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > size:
+        os.remove(part_path)
+        offset = 0
+
+    with governor.slots:
+        if offset < size or not os.path.exists(part_path):
+            # resume the partial download from where it stopped
+            kwargs = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+            response = s3.get_object(Bucket=bucket, Key=key, **kwargs)
+            with open(part_path, "ab") as f:
+                for chunk in response["Body"].iter_chunks(chunk_size):
+                    governor.consume(len(chunk))
+                    f.write(chunk)
+
+    downloaded_size = os.path.getsize(part_path)
+    if downloaded_size != size:
+        raise IOError(f"Size of {key} is {downloaded_size} instead of {size}")
+    # multipart ETags are not the md5 of the object, those objects are only checked by size
+    if "-" not in etag and get_md5(part_path) != etag:
+        os.remove(part_path)
+        raise IOError(f"Checksum of {key} does not match its ETag {etag}")
+
+    os.replace(part_path, local_file_path)
+
+
+class H8BucketIndex():
+    def __init__(self, index_path: str = INDEX_PATH, s3 = None, bucket: str = BUCKET_NAME):
+        """
+        args:
+            index_path: str (path of the SQLite file)
+            s3: boto3 S3 client (defaults to an unsigned client, can be a moto client for testing)
+            bucket: str (bucket name)
+        """
+        self.bucket = bucket
+        self.s3 = s3 if s3 is not None else get_s3_client()
+        if os.path.dirname(index_path):
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+
+        # one connection shared by all the threads, access is serialized with a lock
+        self._connection = sqlite3.connect(index_path, check_same_thread=False, timeout=60)
+        self._lock = threading.Lock()
+        self._prefix_locks = {}
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, prefix TEXT NOT NULL, size INTEGER, etag TEXT)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS objects_prefix ON objects (prefix)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS listed_prefixes (prefix TEXT PRIMARY KEY, listed_at REAL)")
+
+    def _is_listed(self, prefix: str) -> bool:
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM listed_prefixes WHERE prefix = ?", (prefix,)).fetchone()
+        return row is not None
+
+    def _prefix_lock(self, prefix: str) -> threading.Lock:
+        with self._lock:
+            return self._prefix_locks.setdefault(prefix, threading.Lock())
+
+    def ensure_day(self, product_dir: str, day: str):
+        """
+        Lists the day prefix (ex: "AHI-L1b-FLDK/2020/01/01/") once and stores all its objects in the index
+        """
+        prefix = f"{product_dir}/{day}"
+        if self._is_listed(prefix):
+            return
+
+        # only one thread lists a given day, the others wait for it
+        with self._prefix_lock(prefix):
+            if self._is_listed(prefix):
+                return
+            rows = []
+            paginator = self.s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    key = obj["Key"]
+                    rows.append((key, key.rsplit("/", 1)[0] + "/", obj["Size"], obj["ETag"].strip('"')))
+
+            with self._lock, self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", rows)
+                self._connection.execute("INSERT OR REPLACE INTO listed_prefixes VALUES (?, ?)", (prefix, time.time()))
+            log.info(f"Indexed {len(rows)} objects of {prefix}")
+
+    def list_keys(self, product_dir: str, timestamp: str) -> list:
+        """
+        Returns the sorted object keys of the product for the timestamp (ex: "2020/01/01/0500/")
+        """
+        day = "/".join(timestamp.split("/")[:3]) + "/"
+        self.ensure_day(product_dir, day)
+        with self._lock:
+            rows = self._connection.execute("SELECT key FROM objects WHERE prefix = ? ORDER BY key", (f"{product_dir}/{timestamp}",)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_object(self, key: str) -> tuple:
+        """
+        Returns (size, etag) of an indexed object or None if the object is not in the index
+        """
+        with self._lock:
+            return self._connection.execute("SELECT size, etag FROM objects WHERE key = ?", (key,)).fetchone()
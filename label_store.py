@@ -0,0 +1,195 @@
+"""
+Date partitioned GeoParquet store for the fire labels
+
+Layout of a store (one per seed):
+    data/fire_masks/labels_{seed}/year=2020/2020-01-01.parquet
+    data/fire_masks/labels_{seed}/_completed/2020-01-01
+
+A day is written as soon as it is processed and marked as completed afterwards (also if it has no fires), so an
+interrupted run can resume from the last completed day. Files starting with "_" or "." are ignored by the parquet
+reader. Combining years only writes a small json manifest pointing to the store.
+"""
+import os
+import json
+import datetime
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import logging as log
+
+# datetime columns that are kept as strings by the API preprocessing and stored as UTC timestamps
+DATETIME_COLUMNS = ["acquisition_time", "cluster_newest_acquisition", "cluster_oldest_acquisition"]
+# numeric columns that can come as int or float depending on the day and are stored with one dtype
+FLOAT_COLUMNS = ["gsd", "frp", "confidence"]
+
+
+def get_store_path(seed: int) -> str:
+    """
+    Returns the directory of the label store for the given seed
+    """
+    return f"data/fire_masks/labels_{seed}"
+
+def get_day_path(store: str, date: datetime.date) -> str:
+    return f"{store}/year={date.year}/{date.isoformat()}.parquet"
+
+def get_day_marker(store: str, date: datetime.date) -> str:
+    return f"{store}/_completed/{date.isoformat()}"
+
+def is_day_complete(store: str, date: datetime.date) -> bool:
+    """
+    Returns True if the day was already written to the store
+    """
+    return os.path.exists(get_day_marker(store, date))
+
+def write_day(store: str, date: datetime.date, labels: pd.DataFrame):
+    """
+    Writes the labels of one day atomically and marks the day as completed. labels can be None for days without fires
+    """
+    if labels is not None and len(labels) > 0:
+        labels = gpd.GeoDataFrame(labels, geometry="geometry", crs="EPSG:4326")
+        for column in DATETIME_COLUMNS:
+            if column in labels.columns:
+                labels[column] = pd.to_datetime(labels[column], format="ISO8601", utc=True)
+        for column in FLOAT_COLUMNS:
+            if column in labels.columns:
+                labels[column] = labels[column].astype("float64")
+
+        path = get_day_path(store, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{os.path.dirname(path)}/.{os.path.basename(path)}.tmp"
+        labels.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    marker = get_day_marker(store, date)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    open(marker, "w").close()
+
+def combine_years(store: str, years: list, manifest_path: str):
+    """
+    Writes a manifest exposing the given years of the store as one dataset. Nothing is copied
+    """
+    with open(manifest_path, "w") as f:
+        json.dump({"store": store, "years": [int(year) for year in years]}, f)
+    log.info(f"Combined years {years} of {store} into {manifest_path}")
+
+class LabelFilter():
+    """
+    Declarative row filter for the fire labels. It is turned into a pyarrow expression so that rows are skipped
+    by the parquet reader before any geometry is decoded
+    """
+    def __init__(self, satellite_deny:list = None, algorithm_deny:list = None, type_allow:list = None, date_min:datetime.datetime = None, date_max:datetime.datetime = None):
+        """
+        args:
+            satellite_deny: list (satellites to drop)
+            algorithm_deny: list (algorithms to drop)
+            type_allow: list (cluster types to keep, all if None)
+            date_min, date_max: datetime (keep dates in [date_min, date_max), unbounded if None)
+        """
+        self.satellite_deny = satellite_deny or []
+        self.algorithm_deny = algorithm_deny or []
+        self.type_allow = type_allow
+        self.date_min = date_min
+        self.date_max = date_max
+
+    def to_expression(self) -> ds.Expression:
+        """
+        Returns the filter as pyarrow dataset expression
+        """
+        expression = ds.scalar(True)
+        # a null satellite/algorithm is not in the deny-list, same as the != comparison in pandas
+        if self.satellite_deny:
+            expression &= ~ds.field("satellite").isin(self.satellite_deny) | ds.field("satellite").is_null()
+        if self.algorithm_deny:
+            expression &= ~ds.field("algorithm").isin(self.algorithm_deny) | ds.field("algorithm").is_null()
+        if self.type_allow is not None:
+            expression &= ds.field("types").isin(self.type_allow)
+        if self.date_min is not None:
+            expression &= ds.field("date") >= pa.scalar(self.date_min, type=pa.timestamp("us"))
+        if self.date_max is not None:
+            expression &= ds.field("date") < pa.scalar(self.date_max, type=pa.timestamp("us"))
+        return expression
+
+
+def _open_dataset(path: str) -> tuple:
+    """
+    Returns the pyarrow dataset and the partition expression for a manifest, a store directory or a GeoParquet file
+    """
+    expression = ds.scalar(True)
+    if path.endswith(".json"):
+        with open(path) as f:
+            manifest = json.load(f)
+        path = manifest["store"]
+        expression = ds.field("year").isin(manifest["years"])
+    partitioning = "hive" if os.path.isdir(path) else None
+    return ds.dataset(path, format="parquet", partitioning=partitioning), expression
+
+def filter_labels(path: str, label_filter: LabelFilter, output_path: str, transform = None, batch_size: int = 65536) -> list:
+    """
+    Streams the labels at path (a manifest, a store directory or a GeoParquet file) through the filter into a
+    GeoParquet file at output_path in a single pass without decoding the geometries. Returns the unique dates
+    ("%Y/%m/%d/%H%M/") of the filtered rows in order of appearance
+    args:
+        transform: callable (optional pa.Table -> pa.Table applied to every filtered batch, ex: to add derived columns)
+    """
+    if path.endswith(".geojson"):
+        raise ValueError(f"filter_labels reads GeoParquet labels, {path} is a legacy GeoJSON file")
+    dataset, partition_expression = _open_dataset(path)
+    if len(dataset.files) == 0:
+        # days without fires have no file, so there is no schema to write an empty output with
+        raise FileNotFoundError(f"No label files in {path} (no fires in the stored days?), nothing to filter")
+
+    # keep the columns of the files (not the partition column) and the GeoParquet metadata of the input
+    first_file_schema = pq.read_schema(dataset.files[0])
+    scanner = dataset.scanner(columns=first_file_schema.names, filter=partition_expression & label_filter.to_expression(), batch_size=batch_size)
+
+    empty_table = scanner.projected_schema.empty_table()
+    if transform is not None:
+        empty_table = transform(empty_table)
+    schema = empty_table.schema.with_metadata(first_file_schema.metadata)
+
+    unique_dates = {}
+    no_of_rows = 0
+    tmp_path = f"{os.path.dirname(output_path) or '.'}/.{os.path.basename(output_path)}.tmp"
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for batch in scanner.to_batches():
+            if batch.num_rows == 0:
+                continue
+            table = pa.Table.from_batches([batch])
+            if transform is not None:
+                table = transform(table)
+            writer.write_table(table.cast(schema))
+            no_of_rows += table.num_rows
+            dates = pd.Series(table["date"].unique().to_pandas()).dt.strftime("%Y/%m/%d/%H%M/")
+            unique_dates.update(dict.fromkeys(dates))
+    os.replace(tmp_path, output_path)
+
+    log.info(f"Filtered {no_of_rows} rows from {path} into {output_path}")
+    return list(unique_dates)
+
+def read_labels(path: str, columns: list = None, filters: list = None) -> gpd.GeoDataFrame:
+    """
+    Returns the labels stored at path which can be a manifest (.json), a store directory, a GeoParquet file or a legacy GeoJSON file
+    args:
+        columns: list (columns to read, all if None)
+        filters: list (pyarrow filters applied before the geometries are decoded, ex: [("algorithm", "==", "GA-AHI-SRSS")])
+    """
+    if path.endswith(".geojson"):
+        labels = gpd.read_file(path)
+        if columns is not None:
+            labels = labels[columns]
+        return labels
+
+    filters = list(filters) if filters is not None else []
+    if path.endswith(".json"):
+        with open(path) as f:
+            manifest = json.load(f)
+        path = manifest["store"]
+        filters.append(("year", "in", manifest["years"]))
+
+    labels = gpd.read_parquet(path, columns=columns, filters=filters if filters else None)
+    if "year" in labels.columns and (columns is None or "year" not in columns) and os.path.isdir(path):
+        # partition column added by the hive layout of the store
+        labels = labels.drop(columns="year")
+    return labels
@@ -0,0 +1,182 @@
+"""
+Timestamp keyed manifest of the files of data/himawari8
+
+Every stage registers the files it writes as (parent timestamp, child, product) -> path in a SQLite table, so the
+later stages find their inputs with an indexed lookup instead of scanning the directories with glob. The child is the
+"%H%M" of the child scene for the products of a scene (ex: "0430" for stacked_masked) and "" for the products of the
+parent timestamp (ex: the labels).
+
+Products:
+    stacked_masked    cropped stack of the bands of a child scene (02_input_data/002_unzip_crop_fldk.py)
+    cloud_nc          downloaded cloud product of the parent timestamp (02_input_data/001_generate_h8_fldk_clouds.py)
+    cd_mask           cropped cloud mask (04_pre_processing/004_reproject_crop_cloud_masks.py)
+    *_labels          sparse labels (see sparse_labels.py)
+
+A tree written before the manifest existed is registered once with `python manifest.py --BACKFILL`,
+`python manifest.py --STATUS` prints the no of timestamps that have each product.
+"""
+import os
+import re
+import time
+import sqlite3
+import argparse
+import threading
+
+MANIFEST_PATH = "data/himawari8/manifest.sqlite"
+DATA_DIR = "data/himawari8"
+
+# (directory, file name) patterns of the registered products, used to backfill an existing tree
+PATH_PATTERN = re.compile(r"^(?P<timestamp>\d{4}/\d{2}/\d{2}/\d{4}/)(?:(?P<child>\d{4})/)?(?P<name>[^/]+)$")
+PRODUCT_PATTERNS = [
+    ("stacked_masked", True, re.compile(r".*_stacked_masked\.tif$")),
+    ("cd_mask", True, re.compile(r"^cd_mask_.*\.tif$")),
+    ("cloud_nc", True, re.compile(r".*\.nc$")),
+    (None, False, re.compile(r"^\d{4}_\d{2}_\d{2}_\d{4}_(?P<product>[a-z0-9_]+_labels)\.npz$")),
+]
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def parse_path(path: str) -> tuple:
+    """
+    Returns (parent timestamp, child) of a path in data/himawari8, ex: ("2022/01/01/0500/", "0430")
+    """
+    match = PATH_PATTERN.match(os.path.relpath(path, DATA_DIR).replace(os.sep, "/"))
+    if match is None:
+        raise ValueError(f"{path} is not in a timestamp directory of {DATA_DIR}")
+    return match.group("timestamp"), match.group("child") or ""
+
+def get_product(path: str) -> str:
+    """
+    Returns the product of a file of a timestamp directory or None if it is not a registered product
+    """
+    _, child = parse_path(path)
+    name = os.path.basename(path)
+    for product, is_child_product, pattern in PRODUCT_PATTERNS:
+        match = pattern.match(name)
+        if match is not None and is_child_product == (child != ""):
+            return product if product is not None else match.group("product")
+    return None
+
+
+class FileManifest():
+    def __init__(self, manifest_path: str = MANIFEST_PATH):
+        """
+        args:
+            manifest_path: str (path of the SQLite file)
+        """
+        if os.path.dirname(manifest_path):
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+        # one connection shared by all the threads of a process, access is serialized with a lock
+        self._connection = sqlite3.connect(manifest_path, check_same_thread=False, timeout=60)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS files (timestamp TEXT NOT NULL, child TEXT NOT NULL, product TEXT NOT NULL, path TEXT NOT NULL, registered_at REAL, PRIMARY KEY (timestamp, child, product))")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS files_product ON files (product, timestamp)")
+
+    def register(self, timestamp: str, child: str, product: str, path: str):
+        """
+        Registers the path of the product, replacing an earlier registration
+        """
+        self.register_many([(timestamp, child, product, path)])
+
+    def register_path(self, path: str, product: str = None):
+        """
+        Registers a file of a timestamp directory, the keys are parsed from the path
+        """
+        timestamp, child = parse_path(path)
+        self.register(timestamp, child, product or get_product(path), path)
+
+    def register_many(self, rows: list):
+        """
+        Registers (timestamp, child, product, path) rows in one transaction
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", [(*row, now) for row in rows])
+
+    def unregister(self, timestamp: str, child: str, product: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM files WHERE timestamp = ? AND child = ? AND product = ?", (timestamp, child, product))
+
+    def get(self, timestamp: str, child: str, product: str) -> str:
+        """
+        Returns the registered path of the product or None
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT path FROM files WHERE timestamp = ? AND child = ? AND product = ?", (timestamp, child, product)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_products(self, timestamp: str, product: str) -> dict:
+        """
+        Returns child -> path of the product for all the children of the timestamp
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT child, path FROM files WHERE timestamp = ? AND product = ? ORDER BY child", (timestamp, product)).fetchall()
+        return dict(rows)
+
+    def get_missing(self, timestamps: list, product: str, child: str = None) -> list:
+        """
+        Returns the timestamps that have no registered product (for the given child if child is not None)
+        """
+        with self._lock:
+            if child is None:
+                rows = self._connection.execute("SELECT DISTINCT timestamp FROM files WHERE product = ?", (product,)).fetchall()
+            else:
+                rows = self._connection.execute("SELECT DISTINCT timestamp FROM files WHERE product = ? AND child = ?", (product, child)).fetchall()
+        available = {row[0] for row in rows}
+        return [timestamp for timestamp in timestamps if timestamp not in available]
+
+    def get_completeness(self) -> dict:
+        """
+        Returns product -> (no of timestamps, no of files)
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT product, COUNT(DISTINCT timestamp), COUNT(*) FROM files GROUP BY product ORDER BY product").fetchall()
+        return {product: (no_of_timestamps, no_of_files) for product, no_of_timestamps, no_of_files in rows}
+
+    def backfill(self, data_dir: str = DATA_DIR) -> int:
+        """
+        Registers all the products found in the timestamp directories of data_dir. Returns the no of files registered
+        """
+        rows = []
+        for directory, _, filenames in os.walk(data_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    product = get_product(path)
+                except ValueError:
+                    continue
+                if product is not None:
+                    rows.append((*parse_path(path), product, path))
+        self.register_many(rows)
+        return len(rows)
+
+
+def get_manifest(manifest_path: str = MANIFEST_PATH) -> FileManifest:
+    """
+    Returns the manifest of the process (worker processes open their own connection)
+    """
+    key = (os.getpid(), manifest_path)
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = FileManifest(manifest_path)
+        return _manifests[key]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--BACKFILL", action="store_true", help="Register the files already written to data/himawari8")
+    parser.add_argument("--STATUS", action="store_true", help="Print the no of timestamps and files of every product")
+    args = parser.parse_args()
+
+    manifest = get_manifest()
+    if args.BACKFILL:
+        print(f"Registered {manifest.backfill()} files")
+    if args.STATUS:
+        for product, (no_of_timestamps, no_of_files) in manifest.get_completeness().items():
+            print(f"{product}: {no_of_timestamps} timestamps, {no_of_files} files")
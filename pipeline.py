@@ -0,0 +1,441 @@
+"""
+DAG runner of the numbered pipeline scripts with incremental rebuilds
+
+Every stage is one script with its upstream stages, input and output files and, for the stages that work per
+timestamp, the manifest products (see manifest.py) it reads and writes. For every stage and timestamp the runner
+records a key in data/pipeline.sqlite: the sha256 of the script, the modules of the repository it imports (ex:
+ahi_label_shift.py, sparse_labels.py), its arguments and the contents of its inputs. A
+stage only runs for the timestamps whose key changed or whose outputs are missing, the script gets them through the
+GEO_DL_TIMESTAMPS environment variable (see utils.get_timestamps). A rerun that writes the same contents does not
+invalidate the downstream stages. Stages run in separate processes as soon as their upstream stages are done, so
+independent stages (ex: the aux data and the labels) run at the same time.
+
+    python pipeline.py --DRY_RUN                      # out of date timestamps of every stage
+    python pipeline.py                                # run everything that is out of date
+    python pipeline.py --STAGES finalize_labels       # only a stage and its upstream stages
+    python pipeline.py --FORCE cloud_mask             # ignore the recorded keys of a stage
+
+The years are set with GEO_DL_YEARS (ex: GEO_DL_YEARS=2020,2021,2022), the default is 2022. File hashes are cached
+by (size, mtime), so only new or modified files are read.
+"""
+import os
+import ast
+import sys
+import json
+import glob
+import time
+import hashlib
+import sqlite3
+import argparse
+import threading
+import subprocess
+import concurrent.futures
+import numpy as np
+import logging as log
+from manifest import get_manifest
+from utils import TIMESTAMPS_PATH, get_timestamps, get_years
+
+WORKDIR = os.getcwd()
+log_file = f"{WORKDIR}/pipeline.txt"  # Path to the log file
+
+log.basicConfig(
+    filename=log_file,
+    level=log.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+
+STATE_PATH = "data/pipeline.sqlite"
+# timestamps passed to the per timestamp stages
+SELECTION_DIR = "data/pipeline"
+SEED = "1703273207"
+LABELS_PATH = f"data/fire_masks/2020_2021_2022_combined_{SEED}_ten_minute_preprocessed_finalized.parquet"
+EMPTY_MASK_PATH = "data/himawari8/empty_mask_h8_aoi_updated.tif"
+# days of the label store of 001_generate_fire_labels.py (see label_store.py)
+LABEL_STORE_FILES = [f"data/fire_masks/labels_{SEED}/year=*/*.parquet", f"data/fire_masks/labels_{SEED}/_completed/*"]
+
+
+class Stage():
+    def __init__(self, name: str, script: str, deps: list = (), args: list = (), files_in: list = (), files_out: list = (), products_in: list = (), products_out: list = (), rebuild: bool = True):
+        """
+        args:
+            name: str (name of the stage)
+            script: str (path of the script)
+            deps: list (names of the upstream stages)
+            args: list (command line arguments of the script)
+            files_in: list (paths or glob patterns of the input files, a change reruns all the timestamps)
+            files_out: list (paths or glob patterns of the output files)
+            products_in: list (manifest products read per timestamp, a tuple of products means any of them. The stage
+                only runs for the timestamps that have all of them)
+            products_out: list (manifest products written per timestamp, the stage runs per timestamp if given. A
+                timestamp is done if any of them is registered)
+            rebuild: bool (the outputs of out of date timestamps, or the files_out of a stage that does not run per
+                timestamp, are deleted before the rerun. False for the stages whose inputs are consumed, they only run
+                for the timestamps whose outputs are missing, and for the stages that resume their outputs)
+        """
+        self.name = name
+        self.script = script
+        self.deps = list(deps)
+        self.args = list(args)
+        self.files_in = list(files_in)
+        self.files_out = list(files_out)
+        self.products_in = list(products_in)
+        self.products_out = list(products_out)
+        self.rebuild = rebuild
+
+    @property
+    def per_timestamp(self) -> bool:
+        return len(self.products_out) > 0
+
+
+STAGES = [
+    # the label store is resumed day by day (the API requests are expensive), so it is not rebuilt. Its partitions and
+    # completed markers are outputs, so new or resumed days invalidate the filter
+    Stage("fire_labels", "01_fire_masks/001_generate_fire_labels.py", args=["--SEED", SEED],
+          files_in=["config/fire_labels_auth.yml"], files_out=[f"data/fire_masks/2020_2021_2022_combined_{SEED}.json", *LABEL_STORE_FILES], rebuild=False),
+    Stage("filter_fire_labels", "01_fire_masks/002_filter_fire_lables.py", deps=["fire_labels"],
+          files_in=[f"data/fire_masks/2020_2021_2022_combined_{SEED}.json", *LABEL_STORE_FILES],
+          files_out=[f"data/fire_masks/2020_2021_2022_combined_{SEED}_ten_minute_preprocessed.parquet", "data/fire_masks/unique_dates_ten_minute.json"]),
+    Stage("availability", "01_fire_masks/003_finalized_labels_with_fldk_cmsk_availability.py", deps=["filter_fire_labels"],
+          files_in=[f"data/fire_masks/2020_2021_2022_combined_{SEED}_ten_minute_preprocessed.parquet", "data/fire_masks/unique_dates_ten_minute.json"],
+          files_out=[LABELS_PATH, TIMESTAMPS_PATH]),
+    Stage("aoi", "aoi_grid.py", files_in=["02_input_data/aoi_h8_updated.geojson", "data/himawari8/sample_data_B05_20220101_004000.tif"],
+          files_out=["data/himawari8/empty_mask_h8_aoi_updated_grid.npz", EMPTY_MASK_PATH]),
+    # the band files are consumed by decode_crop, so the downloads are not rebuilt
+    Stage("download", "02_input_data/001_generate_h8_fldk_clouds.py", deps=["availability"], products_out=["cloud_nc"], rebuild=False),
+    Stage("decode_crop", "02_input_data/002_unzip_crop_fldk.py", deps=["download", "aoi"], files_in=["02_input_data/aoi_h8_updated.geojson"],
+          products_out=["stacked_masked"], rebuild=False),
+    Stage("rasterize_labels", "04_pre_processing/001_reproject_rasterize_labels.py", deps=["availability", "aoi"], files_in=[LABELS_PATH, EMPTY_MASK_PATH],
+          products_out=["ahi_labels", "non_ahi_labels"]),
+    Stage("shift_labels", "04_pre_processing/002_apply_shift_ahi_labels.py", deps=["rasterize_labels", "decode_crop"],
+          products_in=["ahi_labels", "stacked_masked"], products_out=["updated_ahi_labels"]),
+    Stage("cloud_mask", "04_pre_processing/004_reproject_crop_cloud_masks.py", deps=["download", "aoi"], files_in=["02_input_data/aoi_h8_updated.geojson"],
+          products_in=["cloud_nc"], products_out=["cd_mask"]),
+    Stage("finalize_labels", "04_pre_processing/010_finalize_labels.py", deps=["shift_labels", "cloud_mask"],
+          products_in=["cd_mask", ("non_ahi_labels", "updated_ahi_labels")], products_out=["cmsk_applied_labels"]),
+    Stage("aux_biomes", "04_pre_processing/007_reproject_rasterize_crop_biomes.py", deps=["aoi"], files_in=["03_aux_data/biomes/Ecoregions2017.*", EMPTY_MASK_PATH],
+          files_out=["data/aux_data/biomes/biomes_2017_aoi_reprojected_rasterized.tif"]),
+    Stage("aux_copdem", "04_pre_processing/008_reproject_resample_copdem.py", deps=["aoi"], files_in=["03_aux_data/copdem/copdem_90m_clipped.tif", EMPTY_MASK_PATH],
+          files_out=["data/aux_data/copdem/reprojected_resampled/r_r_copdem_90m_clipped.tif"]),
+    Stage("aux_landcover", "04_pre_processing/009_reproject_resample_landcover.py", deps=["aoi"], files_in=["03_aux_data/land_cover/*/*.tif", EMPTY_MASK_PATH],
+          files_out=["data/aux_data/land_cover/2021/reprojected_resampled/r_r_*.tif"]),
+    Stage("hdf5_dynamic", "06_dataset_preparation/create_training_testing_dynamic_features_hdf5_files.py", deps=["decode_crop", "finalize_labels"],
+          products_in=["stacked_masked", "cd_mask", "cmsk_applied_labels"], files_out=["data/train_test_split_data_files/test_split/dynamic_files/*.h5"]),
+    Stage("hdf5_static", "06_dataset_preparation/create_training_testing_static_features_hdf5_file.py", deps=["aux_biomes", "aux_copdem", "aux_landcover"],
+          files_in=["data/aux_data/*/reprojected_resampled/*_finalized.tif", "data/aux_data/land_cover/*/reprojected_resampled/*_finalized.tif"],
+          files_out=["data/train_test_split_data_files/train_split/static_files/training_static_data.h5"]),
+    Stage("hdf5_evaluation", "06_dataset_preparation/create_evaluation_dataset.py", deps=["decode_crop", "cloud_mask", "rasterize_labels"],
+          files_in=["05_evaluation_data/bushfires_gad_preprocessed_2022.geojson"], products_in=["stacked_masked", "cd_mask", "ahi_labels"],
+          files_out=["data/evaluation_data/bushfires_gad_preprocessed_flat_2022.h5"]),
+]
+
+
+def get_content_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Returns the sha256 of the contents of a file. The arrays of .npz files are hashed instead of the zip file, as
+    the zip entries carry the time they were written
+    """
+    sha256 = hashlib.sha256()
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            for name in sorted(data.files):
+                sha256.update(name.encode())
+                sha256.update(np.ascontiguousarray(data[name]).tobytes())
+        return sha256.hexdigest()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_local_modules(script: str) -> list:
+    """
+    Returns the paths of the modules of the repository the script imports, directly or through other modules of the
+    repository. They are looked up like the scripts import them, in the directory of the script and the repository root
+    """
+    directories = [os.path.dirname(script) or ".", WORKDIR]
+    modules, pending = set(), [script]
+    while pending:
+        with open(pending.pop()) as f:
+            tree = ast.parse(f.read())
+        names = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names += [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names.append(node.module)
+        for name in names:
+            for directory in directories:
+                path = os.path.relpath(os.path.join(directory, *name.split(".")) + ".py", WORKDIR)
+                if os.path.exists(path):
+                    if path not in modules and path != script:
+                        modules.add(path)
+                        pending.append(path)
+                    break
+    return sorted(modules)
+
+def expand(patterns: list) -> list:
+    """
+    Returns the sorted paths matching the paths or glob patterns
+    """
+    return sorted(path for pattern in patterns for path in glob.glob(pattern))
+
+
+class PipelineState():
+    def __init__(self, state_path: str = STATE_PATH):
+        """
+        args:
+            state_path: str (path of the SQLite file with the file hashes and the keys of the completed stages)
+        """
+        if os.path.dirname(state_path):
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+
+        # one connection shared by the stage threads, access is serialized with a lock
+        self._connection = sqlite3.connect(state_path, check_same_thread=False, timeout=60)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS stage_runs (stage TEXT NOT NULL, timestamp TEXT NOT NULL, key TEXT NOT NULL, finished_at REAL, PRIMARY KEY (stage, timestamp))")
+
+    def get_file_hash(self, path: str) -> str:
+        """
+        Returns the content hash of a file, None if it does not exist. Only read if its size or mtime changed
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            row = self._connection.execute("SELECT size, mtime_ns, sha256 FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        sha256 = get_content_sha256(path)
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, sha256))
+        return sha256
+
+    def get_keys(self, stage: str) -> dict:
+        """
+        Returns timestamp -> key of the recorded runs of the stage ("" for the stages that do not run per timestamp)
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT timestamp, key FROM stage_runs WHERE stage = ?", (stage,)).fetchall()
+        return dict(rows)
+
+    def record(self, stage: str, keys: dict):
+        """
+        Records timestamp -> key of a completed run of the stage
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO stage_runs VALUES (?, ?, ?, ?)", [(stage, timestamp, key, now) for timestamp, key in keys.items()])
+
+    def forget(self, stage: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM stage_runs WHERE stage = ?", (stage,))
+
+
+class Pipeline():
+    def __init__(self, stages: list, state: PipelineState, max_parallel: int = 4, dry_run: bool = False):
+        """
+        args:
+            stages: list (Stage objects)
+            state: PipelineState
+            max_parallel: int (maximum no of stages running at the same time)
+            dry_run: bool (only log the out of date timestamps of every stage)
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.state = state
+        self.manifest = get_manifest()
+        self.max_parallel = max_parallel
+        self.dry_run = dry_run
+
+    def get_stage_hash(self, stage: Stage) -> str:
+        """
+        Returns the hash of the script, the modules it imports, the arguments and the input files of the stage
+        """
+        sha256 = hashlib.sha256()
+        sha256.update(self.state.get_file_hash(stage.script).encode())
+        # the logic of most stages is in the shared modules (ex: ahi_label_shift.py for shift_labels)
+        for path in get_local_modules(stage.script):
+            sha256.update(f"{path}={self.state.get_file_hash(path)}".encode())
+        sha256.update(json.dumps(stage.args).encode())
+        for path in expand(stage.files_in):
+            sha256.update(f"{path}={self.state.get_file_hash(path)}".encode())
+        return sha256.hexdigest()
+
+    def get_products_hash(self, timestamp: str, products: list) -> str:
+        """
+        Returns the hash of the registered input products of a timestamp, None if a product is missing
+        """
+        sha256 = hashlib.sha256()
+        for alternatives in products:
+            alternatives = alternatives if isinstance(alternatives, tuple) else (alternatives,)
+            found = False
+            for product in alternatives:
+                for child, path in self.manifest.get_products(timestamp, product).items():
+                    sha256.update(f"{product}/{child}={self.state.get_file_hash(path)}".encode())
+                    found = True
+            if not found:
+                return None
+        return sha256.hexdigest()
+
+    def is_done(self, stage: Stage, timestamp: str) -> bool:
+        """
+        Returns True if the outputs of the stage exist (for the timestamp if the stage runs per timestamp)
+        """
+        if stage.per_timestamp:
+            return any(self.manifest.get_products(timestamp, product) for product in stage.products_out)
+        return all(glob.glob(pattern) for pattern in stage.files_out)
+
+    def get_out_of_date(self, stage: Stage) -> dict:
+        """
+        Returns timestamp -> key of the timestamps the stage has to run for ({"": key} for the stages that do not
+        run per timestamp)
+        """
+        stage_hash = self.get_stage_hash(stage)
+        recorded = self.state.get_keys(stage.name)
+
+        if not stage.per_timestamp:
+            sha256 = hashlib.sha256(f"{stage_hash}/{get_years()}".encode())
+            # the stages reading products of all the timestamps depend on every product
+            for timestamp in get_timestamps() if stage.products_in else []:
+                sha256.update(f"{timestamp}={self.get_products_hash(timestamp, stage.products_in)}".encode())
+            key = sha256.hexdigest()
+            return {"": key} if recorded.get("") != key or not self.is_done(stage, "") else {}
+
+        out_of_date = {}
+        for timestamp in get_timestamps():
+            products_hash = self.get_products_hash(timestamp, stage.products_in) if stage.products_in else ""
+            if products_hash is None:
+                # the upstream stages did not write the inputs of this timestamp
+                continue
+            key = hashlib.sha256(f"{stage_hash}/{products_hash}".encode()).hexdigest()
+            if recorded.get(timestamp) != key or not self.is_done(stage, timestamp):
+                out_of_date[timestamp] = key
+        return out_of_date
+
+    def remove_outputs(self, stage: Stage, timestamps: list):
+        """
+        Deletes the registered outputs of the timestamps, so that the script does not skip them as already done
+        """
+        for timestamp in timestamps:
+            for product in stage.products_out:
+                for child, path in self.manifest.get_products(timestamp, product).items():
+                    if os.path.exists(path):
+                        os.remove(path)
+                    self.manifest.unregister(timestamp, child, product)
+
+    def remove_files(self, stage: Stage):
+        """
+        Deletes the output files of a stage that does not run per timestamp, its script skips the outputs that exist
+        """
+        for path in expand(stage.files_out):
+            os.remove(path)
+
+    def run_stage(self, stage: Stage) -> bool:
+        """
+        Runs the stage for its out of date timestamps and records their keys. Returns False if the script failed
+        """
+        out_of_date = self.get_out_of_date(stage)
+        if len(out_of_date) == 0:
+            log.info(f"{stage.name}: up to date")
+            return True
+        log.info(f"{stage.name}: {len(out_of_date)} timestamps out of date" if stage.per_timestamp else f"{stage.name}: out of date")
+        if self.dry_run:
+            return True
+
+        env = dict(os.environ)
+        # the scripts import the shared modules of the repository root
+        env["PYTHONPATH"] = os.pathsep.join([WORKDIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+        if stage.per_timestamp:
+            if stage.rebuild:
+                self.remove_outputs(stage, list(out_of_date))
+            os.makedirs(SELECTION_DIR, exist_ok=True)
+            selection_path = f"{SELECTION_DIR}/{stage.name}_timestamps.json"
+            with open(selection_path, "w") as f:
+                json.dump(sorted(out_of_date), f)
+            env["GEO_DL_TIMESTAMPS"] = selection_path
+        else:
+            if stage.rebuild:
+                self.remove_files(stage)
+            env.pop("GEO_DL_TIMESTAMPS", None)
+
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, stage.script, *stage.args], env=env, cwd=WORKDIR)
+        if process.returncode != 0:
+            log.error(f"{stage.name}: {stage.script} exited with {process.returncode}")
+            return False
+
+        # timestamps whose outputs are still missing are retried by the next run
+        keys = {timestamp: key for timestamp, key in out_of_date.items() if self.is_done(stage, timestamp)}
+        self.state.record(stage.name, keys)
+        log.info(f"{stage.name}: done in {(time.perf_counter()-start)/60:.1f} minutes, {len(keys)} of {len(out_of_date)} completed")
+        return True
+
+    def get_upstream(self, names: list) -> list:
+        """
+        Returns the names of the stages and all their upstream stages
+        """
+        selected = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.stages[name].deps)
+        return [name for name in self.stages if name in selected]
+
+    def run(self, names: list = None) -> dict:
+        """
+        Runs the stages (default all) as soon as their upstream stages succeeded. Returns name -> status
+        """
+        names = self.get_upstream(names or list(self.stages))
+        status = {name: "pending" for name in names}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            running = {}
+            while True:
+                for name in names:
+                    if status[name] != "pending":
+                        continue
+                    deps = [status[dep] for dep in self.stages[name].deps if dep in status]
+                    if any(dep in ["failed", "skipped"] for dep in deps):
+                        status[name] = "skipped"
+                        log.warning(f"{name}: skipped as an upstream stage failed")
+                    elif all(dep == "succeeded" for dep in deps):
+                        status[name] = "running"
+                        running[executor.submit(self.run_stage, self.stages[name])] = name
+                if len(running) == 0:
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = "succeeded" if future.result() else "failed"
+                    except Exception as e:
+                        log.error(f"{name}: {e}")
+                        status[name] = "failed"
+        return status
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--STAGES", nargs="+", choices=[stage.name for stage in STAGES], default=None, help="Run only these stages and their upstream stages")
+    parser.add_argument("--FORCE", nargs="+", choices=[stage.name for stage in STAGES], default=[], help="Rerun these stages for all the timestamps")
+    parser.add_argument("--MAX_PARALLEL", type=int, default=4, help="Maximum no of stages running at the same time")
+    parser.add_argument("--DRY_RUN", action="store_true", help="Only log the out of date timestamps of every stage")
+    args = parser.parse_args()
+
+    state = PipelineState()
+    for name in args.FORCE:
+        state.forget(name)
+
+    log.info(f"Running the pipeline for the years {get_years()}")
+    pipeline = Pipeline(STAGES, state, max_parallel=args.MAX_PARALLEL, dry_run=args.DRY_RUN)
+    status = pipeline.run(args.STAGES)
+    for name, stage_status in status.items():
+        print(f"{name}: {stage_status}")
+    sys.exit(0 if all(stage_status == "succeeded" for stage_status in status.values()) else 1)
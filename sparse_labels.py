@@ -0,0 +1,163 @@
+"""
+Sparse fire label files
+
+A label raster of the AOI is almost empty, so only the fire pixels are stored: their row and column indices in a small
+.npz file per timestamp and product, ex: data/himawari8/2022/01/01/0500/2022_01_01_0500_ahi_labels.npz. The space
+mask is the same for every timestamp, it is band 2 of the empty AOI raster and is read once per process. Labels are
+densified on demand for the whole AOI or only for a window.
+
+Products written by 04_pre_processing: non_ahi_labels, ahi_labels, updated_ahi_labels, finalized_labels,
+cmsk_applied_labels (binary cloud mask) and cmsk4_applied_labels (four category cloud mask).
+"""
+import os
+import datetime
+import threading
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from manifest import get_manifest
+
+EMPTY_RASTER_PATH = "data/himawari8/empty_mask_h8_aoi_updated.tif"
+
+_grid = {}
+_grid_lock = threading.Lock()
+
+
+def get_timestamp_str(timestamp) -> str:
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.strftime("%Y/%m/%d/%H%M/")
+    return timestamp
+
+def get_labels_path(timestamp, product: str) -> str:
+    """
+    Returns the path of the sparse labels of the product for the timestamp ("%Y/%m/%d/%H%M/" or datetime)
+    """
+    timestamp = get_timestamp_str(timestamp)
+    return f"data/himawari8/{timestamp}{timestamp.replace('/','_')}{product}.npz"
+
+def get_grid() -> tuple:
+    """
+    Returns (meta, space mask) of the empty AOI raster, read once per process
+    """
+    with _grid_lock:
+        if not _grid:
+            with rasterio.open(EMPTY_RASTER_PATH) as src:
+                _grid["meta"] = src.meta.copy()
+                _grid["space_mask"] = src.read(2)
+        return _grid["meta"], _grid["space_mask"]
+
+
+class SparseLabels():
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, shape: tuple):
+        """
+        args:
+            rows, cols: np.ndarray (indices of the fire pixels on the AOI grid)
+            shape: tuple (height, width of the AOI grid)
+        """
+        index_dtype = np.uint16 if max(shape) <= np.iinfo(np.uint16).max else np.int32
+        self.rows = np.asarray(rows, dtype=index_dtype)
+        self.cols = np.asarray(cols, dtype=index_dtype)
+        self.shape = tuple(int(x) for x in shape)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @classmethod
+    def from_dense(cls, labels: np.ndarray):
+        """
+        Returns the fire pixels (value 1) of a dense (H, W) label array
+        """
+        rows, cols = np.nonzero(labels == 1)
+        return cls(rows, cols, labels.shape)
+
+    @classmethod
+    def empty(cls, shape: tuple = None):
+        if shape is None:
+            meta, _ = get_grid()
+            shape = (meta["height"], meta["width"])
+        return cls(np.empty(0), np.empty(0), shape)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(data["rows"], data["cols"], tuple(data["shape"]))
+
+    def save(self, path: str):
+        """
+        Writes the labels atomically
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{os.path.dirname(path)}/.{os.path.basename(path)}.tmp.npz"
+        np.savez(tmp_path, rows=self.rows, cols=self.cols, shape=np.array(self.shape))
+        os.replace(tmp_path, path)
+
+    def union(self, other):
+        """
+        Returns the pixels that are fire in either of the labels
+        """
+        flat = np.union1d(self._flat_indices(), other._flat_indices())
+        return SparseLabels(*np.unravel_index(flat, self.shape), self.shape)
+
+    def drop(self, mask: np.ndarray):
+        """
+        Returns the labels without the fire pixels where the dense (H, W) boolean mask is True (ex: cloudy pixels)
+        """
+        keep = ~mask[self.rows, self.cols]
+        return SparseLabels(self.rows[keep], self.cols[keep], self.shape)
+
+    def to_dense(self, window: Window = None, dtype = np.uint8, nan_outside_space: bool = False) -> np.ndarray:
+        """
+        Returns the dense labels of the whole AOI or of the window. With nan_outside_space the labels are float32 and
+        NaN outside the study area (space mask == 0), like the former *_cmsk_applied_labels_with_nan.tif
+        """
+        if window is None:
+            window = Window(0, 0, self.shape[1], self.shape[0])
+        row_start, col_start = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+
+        if nan_outside_space:
+            dtype = np.float32
+        dense = np.zeros((height, width), dtype=dtype)
+        inside = (self.rows >= row_start) & (self.rows < row_start + height) & (self.cols >= col_start) & (self.cols < col_start + width)
+        dense[self.rows[inside].astype(np.intp) - row_start, self.cols[inside].astype(np.intp) - col_start] = 1
+
+        if nan_outside_space:
+            _, space_mask = get_grid()
+            dense[space_mask[row_start:row_start + height, col_start:col_start + width] == 0] = np.nan
+        return dense
+
+    def _flat_indices(self) -> np.ndarray:
+        return np.ravel_multi_index((self.rows.astype(np.intp), self.cols.astype(np.intp)), self.shape)
+
+
+def read_sparse_labels(timestamp, product: str) -> SparseLabels:
+    """
+    Returns the sparse labels of the product for the timestamp or None if they were not written
+    """
+    path = get_labels_path(timestamp, product)
+    return SparseLabels.load(path) if os.path.exists(path) else None
+
+def write_sparse_labels(labels: SparseLabels, timestamp, product: str) -> str:
+    """
+    Saves the labels of the product for the timestamp and registers them in the manifest. Returns the path
+    """
+    path = get_labels_path(timestamp, product)
+    labels.save(path)
+    get_manifest().register(get_timestamp_str(timestamp), "", product, path)
+    return path
+
+def write_dense(labels: SparseLabels, path: str, nan_outside_space: bool = False):
+    """
+    Exports the labels as GeoTIFF on the AOI grid: float32 with NaN outside the study area if nan_outside_space,
+    otherwise uint8 with the space mask as second band (the layout of the former dense label rasters)
+    """
+    meta, space_mask = get_grid()
+    meta = meta.copy()
+    if nan_outside_space:
+        meta.update({"driver": "GTiff", "dtype": rasterio.float32, "count": 1})
+    else:
+        meta.update({"driver": "GTiff", "dtype": rasterio.uint8, "count": 2})
+    with rasterio.open(path, "w", **meta) as dst:
+        dst.write(labels.to_dense(nan_outside_space=nan_outside_space), 1)
+        if not nan_outside_space:
+            dst.write(space_mask.astype(np.uint8), 2)
@@ -1,14 +1,19 @@
+import time
 import random
+import hashlib
+import contextlib
 import pyproj
 import boto3
 import json
 import rasterio
 import numpy as np
-import geopandas as gpd
 from datetime import datetime, timedelta
 from botocore.client import Config
 from botocore import UNSIGNED
 import os
+import shutil
+from h8_s3 import TransferGovernor, download_object
+from aoi_grid import get_aoi_grid
 
 
 def get_time_series(timestamps:int, intervals:list[list],seed:int) -> dict:
@@ -31,13 +36,14 @@ def get_time_series(timestamps:int, intervals:list[list],seed:int) -> dict:
     
     return time_series_indices
 
-def get_random_timestamps(timestamps:int, intervals:list[list]) -> list:
+def get_random_timestamps(timestamps:int, intervals:list[list], rng: random.Random = random) -> list:
 
     """
     Returns random timestamps for each of interval defined in intervals. SEED is set at the top level
+    unless a seeded random.Random is passed as rng
     """
     n = len(intervals)
-    random_indices = [random.randint(0,len(intervals[0])-1) for _ in range(n)]
+    random_indices = [rng.randint(0,len(intervals[0])-1) for _ in range(n)]
     
     time_series_indices = []
     for i,enum in enumerate(intervals):
@@ -51,6 +57,14 @@ def get_random_timestamps(timestamps:int, intervals:list[list]) -> list:
     
     return time_series_indices
 
+def get_day_seed(seed:int, date) -> int:
+    """
+    Returns a seed derived from the run SEED and the date so that every day can be processed independently
+    and still pick the same random timestamps
+    """
+    digest = hashlib.sha256(f"{seed}-{date.isoformat()}".encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
 def get_child_timestamps(timestamp_str:str) -> list[str]:
     """
     Returns the last three 10-minute intervals for the given timestamp
@@ -67,6 +81,30 @@ def get_child_timestamps(timestamp_str:str) -> list[str]:
 
     return sorted(intervals)
 
+def link_file(src: str, dst: str):
+    """
+    Hard links src to dst (replacing dst) and falls back to a copy if hard links are not possible (ex: across devices)
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_dst = f"{dst}.link.tmp"
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+@contextlib.contextmanager
+def timed(timings: dict, stage: str):
+    """
+    Adds the wall time spent in the block to timings[stage] (ignored if timings is None)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
 def get_h8_proj4_string():
     """
     Returns the proj4 string for himawari8 projection
@@ -98,53 +136,61 @@ def get_h8_fldk_data(timestamp: str, path: str):
     bucket_name = 'noaa-himawari8'
     s3 = boto3.client("s3",config=Config(signature_version=UNSIGNED),region_name='us-east-1')
     fldk_response = s3.list_objects(Bucket=bucket_name, Prefix=fldk_url)
-    data_files = [obj['Key'] for obj in fldk_response.get('Contents', [])]
+    data_files = [(obj['Key'], obj['Size'], obj['ETag'].strip('"')) for obj in fldk_response.get('Contents', [])]
+    governor = TransferGovernor()
 
-    for file_key in data_files:
+    for file_key, size, etag in data_files:
         path = path
         if not os.path.exists(path):
             os.makedirs(path)
         local_file_path = path + file_key.split('/')[-1]  # Specify local download path
         if not os.path.exists(local_file_path):
-            s3.download_file(bucket_name, file_key, local_file_path)
+            # downloaded to a .part file, verified and renamed so that a killed run leaves no truncated file
+            download_object(s3, bucket_name, file_key, local_file_path, size, etag, governor)
             print(f"Downloaded {file_key.split('/')[-1]} to {local_file_path}")
         else:
             print(f"File {local_file_path} already exists")
 
     return 
 
-def get_2022_timestamps():
+TIMESTAMPS_PATH = "data/fire_masks/unique_dates_ten_minute_finalized.json"
 
-    # using locally saved unique timestamps 
-    with open("data/fire_masks/unique_dates_ten_minute_finalized.json") as json_file:
+def get_years() -> list[int]:
+    """
+    Returns the years to process, set with the GEO_DL_YEARS environment variable (ex: GEO_DL_YEARS=2020,2021,2022).
+    Defaults to 2022 due to storage constraints
+    """
+    return [int(year) for year in os.environ.get("GEO_DL_YEARS", "2022").split(",") if year.strip()]
+
+def get_timestamps(path: str = TIMESTAMPS_PATH) -> list[str]:
+    """
+    Returns the unique timestamps of the finalized labels in the years of get_years(). If the GEO_DL_TIMESTAMPS
+    environment variable is set (by pipeline.py) only the timestamps listed in that json file are returned
+    """
+    # using locally saved unique timestamps
+    with open(path) as json_file:
         timestamps = json.load(json_file)
 
-    # remove timestamps for 2022 due to storage constraints | processing 2022 timestamps separately
-    timestamps_2022 = []
-    for timestamp in timestamps:
-        if timestamp.split("/")[0] == "2022":
-            timestamps_2022.append(timestamp)
+    years = {str(year) for year in get_years()}
+    timestamps = [timestamp for timestamp in timestamps if timestamp.split("/")[0] in years]
 
-    return timestamps_2022
+    if os.environ.get("GEO_DL_TIMESTAMPS"):
+        with open(os.environ["GEO_DL_TIMESTAMPS"]) as json_file:
+            selected = set(json.load(json_file))
+        timestamps = [timestamp for timestamp in timestamps if timestamp in selected]
+
+    return timestamps
 
 def create_empty_h8_mask():
     """
     Create an empty raster with the same extent as the aoi 
     """
     if not os.path.exists("data/himawari8/empty_mask_h8_aoi_updated.tif"):
-        # read aoi
-        aoi_h8 = gpd.read_file("02_input_data/aoi_h8_updated.geojson")
-
-
-        # mask the raster with aoi extent: take a sample file from himawari8
+        # crop a sample file from himawari8 with the shared aoi window and mask
+        aoi_grid = get_aoi_grid()
         with rasterio.open('data/himawari8/sample_data_B05_20220101_004000.tif') as src:
-            masked_raster, masked_transform = rasterio.mask.mask(src, aoi_h8["geometry"], crop=True)
-            masked_meta = src.meta
-
-        masked_meta.update({"driver": "GTiff",
-                        "height": masked_raster.shape[1],
-                        "width": masked_raster.shape[2],
-                        "transform": masked_transform})
+            masked_raster = aoi_grid.crop(src.read(), fill=src.nodata if src.nodata is not None else 0)
+            masked_meta = aoi_grid.get_meta(src.meta)
 
         # create an empty raster similar to masked raster
         masked_empty_raster = np.zeros_like(masked_raster)